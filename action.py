@@ -160,7 +160,7 @@ class ActionSet(frozenset):
         return ','.join(map(str,self))
 
     def __hash__(self):
-        return hash(str(self))
+        return frozenset.__hash__(self)
 
     def __lt__(self,other):
         return str(self) < str(other)
@@ -2,14 +2,20 @@ import copy
 import math
 import random
 import StringIO
+import time
+import types
 from xml.dom.minidom import Document,Node
 
 from action import Action,ActionSet
 from pwl import *
-from probability import Distribution
+from probability import Distribution,makeGenerator
+from cache import LRUCache
+from mcts import MCTS
 
 class Agent:
     """
+    @cvar estimatorSize: the maximum total size (in state vector entries) of the memoized belief updates of each agent (0 disables memoization)
+    @type estimatorSize: int
     @ivar name: agent name
     @type name: str
     @ivar world: the environment that this agent inhabits
@@ -28,7 +34,12 @@ class Agent:
     @type y: int
     @ivar color: color name to be used in UI
     @type color: str
+    @ivar estimates: the new model names already computed by L{stateEstimator}, indexed by the old model, the old and new real worlds, and the observation (discarded by L{World.invalidate<psychsim.world.World.invalidate>} whenever the world's definition changes)
+    @type estimates: L{LRUCache}
+    @ivar search: the planner used by L{decide} under any model whose C{planner} attribute is C{'mcts'}
+    @type search: L{MCTS}
     """
+    estimatorSize = 1000000
 
     def __init__(self,name):
         self.world = None
@@ -41,6 +52,9 @@ class Agent:
         self.x = None
         self.y = None
         self.color = None
+        self.estimates = LRUCache(self.estimatorSize,weighEstimate)
+        self.search = MCTS(self)
+        self.generators = {}
         if isinstance(name,Document):
             self.parse(name.documentElement)
         elif isinstance(name,Node):
@@ -55,7 +69,7 @@ class Agent:
     """Policy methods"""
     """------------------"""
 
-    def decide(self,vector,horizon=None,others=None,model=None,selection=None,actions=None,keys=None):
+    def decide(self,vector,horizon=None,others=None,model=None,selection=None,actions=None,keys=None,executor=None,deadline=None):
         """
         Generate an action choice for this agent in the given state
         @param vector: the current state in which the agent is making its decision
@@ -75,6 +89,11 @@ class Agent:
         @type selection: str
         @param actions: possible action choices (default is all legal actions)
         @param keys: subset of state features to project over (default is all state features)
+        @param executor: optional pool of processes that evaluates the alternative actions in parallel (default is to evaluate them serially in this process)
+        @type executor: L{WorldPool<psychsim.parallel.WorldPool>}
+        @param deadline: optional time (as returned by C{time.time()}) by which to decide; if given, then evaluate horizons 1, 2, ... up to the given horizon, and return the decision of the deepest one completed in time, along with that horizon (under C{'horizon'}, which is the full horizon whenever no lookahead was needed); under the C{'mcts'} planner, run simulations until then instead (default is no deadline)
+        @type deadline: float
+        @warning: a pass that uses an executor is only interrupted once the workers finish
         """
         if model is None:
             model = self.world.getModel(self.name,vector)
@@ -82,6 +101,8 @@ class Agent:
             selection = self.getAttribute('selection',model)
         # What are my subjective beliefs for this decision?
         belief = self.getBelief(vector,model)
+        if horizon is None:
+            horizon = self.getAttribute('horizon',model)
         # Do I have a policy telling me what to do?
         policy = self.getAttribute('policy',model)
         if policy:
@@ -90,9 +111,10 @@ class Agent:
             if action:
                 if isinstance(action,Action):
                     action = ActionSet([action])
-                return {'action': action}
-        if horizon is None:
-            horizon = self.getAttribute('horizon',model)
+                result = {'action': action}
+                if not deadline is None:
+                    result['horizon'] = horizon
+                return result
         if actions is None:
             # Consider all legal actions (legality determined by my belief, circumscribed by real world)
             actions = self.getActions(vector)
@@ -110,21 +132,71 @@ class Agent:
             raise RuntimeError,msg
         elif len(actions) == 1:
             # Only one possible action
-            return {'action': iter(actions).next()}
-        # Keep track of value function
-        V = {}
+            result = {'action': iter(actions).next()}
+            if not deadline is None:
+                result['horizon'] = horizon
+            return result
+        V = None
+        if self.getAttribute('planner',model) == 'mcts':
+            # Sampling-based search instead of exhaustive lookahead
+            V = self.search.evaluate(belief,actions,horizon,others,model,deadline)
+            if not V:
+                # Nothing to simulate (e.g., no horizon left, or only terminal states), so fall back on lookahead
+                V = None
+        if V is None:
+            if not deadline is None and horizon > 1:
+                # Iterative deepening, always completing the shallowest pass
+                result = self.decide(vector,1,others,model,selection,actions,keys,executor)
+                result['horizon'] = 1
+                previous = self.world.deadline
+                if previous is None or deadline < previous:
+                    self.world.deadline = deadline
+                try:
+                    for depth in range(2,horizon+1):
+                        if time.time() >= deadline:
+                            break
+                        try:
+                            # Deeper passes reuse the values cached by the shallower ones
+                            decision = self.decide(vector,depth,others,model,selection,actions,keys,executor)
+                        except DeadlineExceeded:
+                            if time.time() < deadline:
+                                # Someone else's deadline
+                                raise
+                            break
+                        decision['horizon'] = depth
+                        result = decision
+                finally:
+                    self.world.deadline = previous
+                return result
+            # Compute value of each action across possible worlds
+            requests = []
+            for action in actions:
+                if isinstance(keys,dict):
+                    subkeys = keys[action]
+                else:
+                    subkeys = keys
+                for state in belief.domain():
+                    requests.append((state,action,subkeys))
+            if executor is None or len(requests) < 2:
+                results = [self.value(state,action,horizon,others,model,subkeys)
+                           for state,action,subkeys in requests]
+            else:
+                results = executor.value(self.name,requests,horizon,others,model)
+                for index in range(len(requests)):
+                    # Do the same caching as the serial computation
+                    self.getAttribute('V',model).set(self.name,requests[index][0],requests[index][1],
+                                                     horizon,results[index]['V'],results[index]['variance'])
+            results.reverse()
+            # Keep track of value function
+            V = {}
+            for action in actions:
+                V[action] = {'__EV__': 0.}
+                for state in belief.domain():
+                    V[action][state] = results.pop()
+                    V[action]['__EV__'] += belief[state]*V[action][state]['V']
         best = None
         for action in actions:
-            # Compute value across possible worlds
-            V[action] = {'__EV__': 0.}
-            if isinstance(keys,dict):
-                subkeys = keys[action]
-            else:
-                subkeys = keys
-            for state in belief.domain():
-                V[action][state] = self.value(state,action,horizon,others,model,subkeys)
-                V[action]['__EV__'] += belief[state]*V[action][state]['V']
-            if len(V[action]) > 1:
+            if V.has_key(action) and len(V[action]) > 1:
                 # Determine whether this action is the best
                 if best is None:
                     best = [action]
@@ -155,6 +227,9 @@ class Agent:
             assert selection == 'consistent','Unknown action selection method: %s' % (selection)
             best.sort()
             result['action'] = best[0]
+        if not deadline is None:
+            # A single pass (or a search) covers the whole horizon
+            result['horizon'] = horizon
         return result
                 
     def value(self,vector,action=None,horizon=None,others=None,model=None,keys=None):
@@ -170,12 +245,32 @@ class Agent:
         @type others: strS{->}L{ActionSet}
         @param model: the model of this agent to use (default is C{True})
         @param keys: subset of state features to project over in computing future value (default is all state features)
+        @return: the expected value (under C{'V'}), along with the variance of that estimate due to any sparse sampling of outcomes (under C{'variance'}, see the C{samples} attribute of L{addModel}), and the projection that produced it
+        @rtype: dict
         """
         if model is None:
             model = self.world.getModel(self.name,vector)
         # Determine horizon
         if horizon is None:
             horizon = self.getAttribute('horizon',model)
+        # Check for projection already computed (possibly by another agent or by another action ordering)
+        try:
+            if others is None:
+                index = None
+            else:
+                index = frozenset(others.items())
+            if not keys is None:
+                keys = frozenset(keys)
+            index = (self.name,model,vector,horizon,action,index,keys)
+            # Never hand out the memoized result itself
+            return dict(self.world.transpositions[index])
+        except KeyError:
+            pass
+        except TypeError:
+            # Unhashable argument
+            index = None
+        if not self.world.deadline is None and time.time() >= self.world.deadline:
+            raise DeadlineExceeded,'Out of time when evaluating %s at horizon %d' % (self.name,horizon)
         # Determine discount factor
         discount = self.getAttribute('discount',model)
         # Compute immediate reward
@@ -184,12 +279,14 @@ class Agent:
                   'agent': self.name,
                   'state': vector,
                   'horizon': horizon,
-                  'projection': []}
+                  'projection': [],
+                  'variance': 0.}
         # Check for pre-computed value function
         V = self.getAttribute('V',model).get(self.name,vector,action,horizon,
                                              self.getAttribute('ignore',model))
         if V is not None:
             result['V'] = V
+            result['variance'] = self.getAttribute('V',model).getVariance(self.name,vector,action,horizon)
         else:
             result['V'] = R
             if horizon > 0 and not self.world.terminated(vector):
@@ -206,10 +303,22 @@ class Agent:
                     pass
                 elif isinstance(outcome['new'],Distribution):
                     # Uncertain outcomes
+                    samples = self.getAttribute('samples',model)
+                    if not samples is None:
+                        samples = int(samples)
+                    sampled = not samples is None and len(outcome['new']) > samples
+                    if not sampled:
+                        worlds = [(newVector,outcome['new'][newVector]) for newVector in outcome['new'].domain()]
+                    else:
+                        # Sparse sampling: each sampled outcome stands for an equal share of the probability
+                        counts = {}
+                        for newVector in outcome['new'].sampleN(samples,self.getGenerator(model)):
+                            counts[newVector] = counts.get(newVector,0)+1
+                        worlds = [(newVector,float(count)/float(samples)) for newVector,count in counts.items()]
                     future = Distribution()
-                    for newVector in outcome['new'].domain():
+                    for newVector,prob in worlds:
                         entry = copy.copy(outcome)
-                        entry['probability'] = outcome['new'][newVector]
+                        entry['probability'] = prob
                         Vrest = self.value(newVector,None,horizon-1,None,model,keys)
                         entry.update(Vrest)
                         try:
@@ -225,6 +334,18 @@ class Agent:
                     else:
                         # Accumulate value
                         result['V'] += discount*apply(op,(future,))
+                    # Estimate the variance of the expected future value, starting with that of the outcomes' own estimates
+                    variance = sum([entry['probability']*entry['probability']*entry['variance']
+                                    for entry in result['projection']])
+                    if sampled and samples > 1:
+                        # Plus the variance due to sampling the outcomes themselves
+                        mean = sum([entry['probability']*entry['V'] for entry in result['projection']])
+                        variance += sum([entry['probability']*(entry['V']-mean)*(entry['V']-mean)
+                                         for entry in result['projection']])/float(samples-1)
+                    if discount < -1e-6:
+                        result['variance'] = variance
+                    else:
+                        result['variance'] = discount*discount*variance
                 else:
                     # Deterministic outcome
                     outcome['probability'] = 1.
@@ -233,12 +354,17 @@ class Agent:
                     if discount < -1e-6:
                         # Only final value matters
                         result['V'] = Vrest['V']
+                        result['variance'] = Vrest['variance']
                     else:
                         # Accumulate value
                         result['V'] += discount*Vrest['V']
+                        result['variance'] = discount*discount*Vrest['variance']
                     result['projection'].append(outcome)
             # Do some caching
-            self.getAttribute('V',model).set(self.name,vector,action,horizon,result['V'])
+            self.getAttribute('V',model).set(self.name,vector,action,horizon,result['V'],result['variance'])
+        if not index is None:
+            self.world.transpositions[index] = result
+            result = dict(result)
         return result
 
     def valueIteration(self,horizon=None,ignore=None,model=True,epsilon=1e-6,debug=0,maxIterations=None):
@@ -379,6 +505,26 @@ class Agent:
                     self.setAttribute(name,value,model['name'])
         else:
             self.models[model][name] = value
+            if not self.world is None:
+                # Memoized projections and belief updates may depend on the old value
+                self.world.invalidate()
+            self.search.clear()
+            self.generators.clear()
+
+    def getGenerator(self,model=True):
+        """
+        @return: the random number generator used for sparse sampling under the given model, seeded by the model's C{seed} attribute (if any)
+        @rtype: C{random.Random}
+        """
+        try:
+            return self.generators[model]
+        except KeyError:
+            seed = self.getAttribute('seed',model)
+            if isinstance(seed,float):
+                seed = int(seed)
+            generator = makeGenerator(seed)
+            self.generators[model] = generator
+            return generator
 
     def findAttribute(self,name,model=True):
         """
@@ -467,7 +613,8 @@ class Agent:
         @param tree: the decision tree for the legality of the action
         @type tree: L{KeyedTree}
         """
-        self.legal[action] = tree.desymbolize(self.world.symbols)
+        self.legal[action] = treeFactory.intern(tree.desymbolize(self.world.symbols))
+        self.world.invalidate()
 
     def hasAction(self,atom):
         """
@@ -503,8 +650,10 @@ class Agent:
         if not self.models[model].has_key('R'):
             self.models[model]['R'] = {}
         if not isinstance(tree,str):
-            tree = tree.desymbolize(self.world.symbols)
+            tree = treeFactory.intern(tree.desymbolize(self.world.symbols))
         self.models[model]['R'][tree] = weight
+        self.world.invalidate()
+        self.search.clear()
 
     def reward(self,vector=None,model=True,recurse=True):
         """
@@ -564,7 +713,11 @@ class Agent:
          - rationality: the rationality parameter used in a quantal response function when modeling others (default is 10),float
          - discount: discount factor used in lookahead
          - selection: selection mechanism used in L{decide}
+         - samples: if given, then L{value} projects at most this many outcomes of each stochastic step, sampled in proportion to their probability (default is C{None}, i.e., all outcomes)
+         - seed: the seed for the random number generator used to sample those outcomes (see L{getGenerator})
+         - planner: if C{'mcts'}, then L{decide} estimates the value of actions by Monte Carlo Tree Search (see L{MCTS}), rather than by exhaustive lookahead
          - parent: another model that this model inherits from (default is C{True})
+         - transient: if C{True}, then this model was created by a belief update and may be garbage collected once unreachable (default is C{False})
         @param name: the label for this model
         @type name: sotr
         @return: the model created
@@ -664,7 +817,8 @@ class Agent:
             index = 1
             while self.models.has_key('%s%d' % (parent['name'],index)):
                 index += 1
-            return self.addModel('%s%d' % (parent['name'],index),beliefs=belief,parent=parent['name'])
+            return self.addModel('%s%d' % (parent['name'],index),beliefs=belief,parent=parent['name'],
+                                 transient=True)
 
     def printModel(self,model=True,buf=None,index=None,prefix=''):
         if isinstance(index,int) or isinstance(index,float):
@@ -707,6 +861,9 @@ class Agent:
             raise NotImplementedError,'New implementation of beliefs uses vectors, not matrices. '\
                 'Distorted beliefs have not been re-implemented yet.'
         self.world.setFeature(key,distribution,beliefs)
+        # Any memoized belief updates (and projections) started from the old beliefs
+        self.world.invalidate()
+        self.search.clear()
 
     def getBelief(self,vector,model=None):
         """
@@ -728,16 +885,19 @@ class Agent:
         except KeyError:
             # No beliefs on this model, assume they get updated somewhere else
             return self.model2index(model)
-        # Look for cached estimator value
-        oldBelief = self.getBelief(oldReal,model)
-        if not self.models[model].has_key('SE'):
-            self.models[model]['SE'] = {oldBelief: {newReal: {}}}
-        elif not self.models[model]['SE'].has_key(oldBelief):
-            self.models[model]['SE'][oldBelief] = {newReal: {}}
-        elif not self.models[model]['SE'][oldBelief].has_key(newReal):
-            self.models[model]['SE'][oldBelief][newReal] = {}
-        elif self.models[model]['SE'][oldBelief][newReal].has_key(omega):
-            return self.models[model]['SE'][oldBelief][newReal][omega]
+        # Look for cached estimator value (the old belief is determined by the old real world and model)
+        index = (model,oldReal,newReal,omega)
+        try:
+            label = self.estimates[index]
+        except KeyError:
+            label = False
+        if label is None:
+            return None
+        elif self.models.has_key(label):
+            return self.model2index(label)
+        elif not label is False:
+            # Model has since been garbage collected
+            del self.estimates[index]
         # Start computing possible new worlds
         newBeliefs = VectorDistribution()
         for oldWorld in oldBeliefDiff.domain():
@@ -819,12 +979,13 @@ class Agent:
                         newBeliefs.addProb(newBelief,oldBeliefDiff[oldWorld]*newProb)
         # Find models corresponding to new beliefs
         if len(newBeliefs) == 0:
+            self.estimates[index] = None
             return None
         else:
             newBeliefs.normalize()
-            index = self.belief2model(model,newBeliefs)['index']
-#            self.models[model]['SE'][oldBelief][newReal][omega] = index
-            return index
+            newModel = self.belief2model(model,newBeliefs)
+            self.estimates[index] = newModel['name']
+            return newModel['index']
 
     def printBeliefs(self,model=True):
         raise DeprecationWarning,'Use the "beliefs=True" argument to printState instead'
@@ -846,6 +1007,8 @@ class Agent:
         if not self.O.has_key(omega):
             self.O[omega] = {}
         self.O[omega][actions] = tree.desymbolize(self.world.symbols)
+        # Memoized belief updates depend on the observation function
+        self.world.invalidate()
 
     def observe(self,vector,actions,model=True):
         """
@@ -936,7 +1099,37 @@ class Agent:
     """------------------"""
             
     def __copy__(self):
-        return self.__class__(self.self.__xml__())
+        """
+        @return: a new agent sharing my PWL functions, but with its own action sets, legality conditions, and models (including copies of any belief distributions, reward weights, policies, and ignored features), and with none of my cached values
+        @rtype: L{Agent}
+        """
+        if type(self) is types.InstanceType:
+            # Old-style class, so there is no __new__ (and subclass constructors may take other arguments)
+            result = types.InstanceType(self.__class__)
+        else:
+            result = self.__class__.__new__(self.__class__)
+        result.__dict__.update(self.__dict__)
+        result.actions = set(self.actions)
+        result.legal = dict(self.legal)
+        result.omega = set(self.omega)
+        result.modelList = dict(self.modelList)
+        result.estimates = LRUCache(self.estimates.size,weighEstimate)
+        result.search = MCTS(result,self.search.nodes.size)
+        result.generators = {}
+        result.models = {}
+        for name,model in self.models.items():
+            result.models[name] = dict(model)
+            if isinstance(model.get('beliefs'),Distribution):
+                result.models[name]['beliefs'] = copy.copy(model['beliefs'])
+            for key in ['R','policy']:
+                if isinstance(model.get(key),dict):
+                    result.models[name][key] = dict(model[key])
+            if isinstance(model.get('ignore'),list):
+                result.models[name]['ignore'] = list(model['ignore'])
+            if model.has_key('V'):
+                # Values cached under my reward need not hold under the copy's
+                result.models[name]['V'] = ValueFunction()
+        return result
 
     def __xml__(self):
         doc = Document()
@@ -1001,6 +1194,8 @@ class Agent:
                     node.appendChild(model[key].__xml__().documentElement)
                 elif key == 'selection':
                     node.setAttribute('selection',str(model[key]))
+                elif key == 'planner':
+                    node.setAttribute('planner',str(model[key]))
                 elif key == 'ignore':
                     for key in model['ignore']:
                         subnode = doc.createElement(key)
@@ -1098,6 +1293,9 @@ class Agent:
                         kwargs['selection'] = True
                     elif text:
                         kwargs['selection'] = text
+                    text = str(node.getAttribute('planner'))
+                    if text:
+                        kwargs['planner'] = text
                     subnode = node.firstChild
                     while subnode:
                         if subnode.nodeType == subnode.ELEMENT_NODE:
@@ -1138,7 +1336,7 @@ class Agent:
                                                     kwargs[key] = [text]
                                             elif text == str(True):
                                                 kwargs[key] = True
-                                            elif key == 'horizon':
+                                            elif key in ['horizon','samples','seed','iterations']:
                                                 kwargs[key] = int(text)
                                             elif key == 'projector':
                                                 kwargs[key] = eval('Distribution.%s' % (text))
@@ -1170,9 +1368,14 @@ class Agent:
 class ValueFunction:
     """
     Representation of an agent's value function, either from caching or explicit solution
+    @ivar table: the values, indexed by horizon, state, agent, and action
+    @type table: list
+    @ivar variances: the variances of those values that are estimates (see L{Agent.value}), indexed in the same way
+    @type variances: list
     """
     def __init__(self,xml=None):
         self.table = []
+        self.variances = []
         if xml:
             self.parse(xml)
 
@@ -1198,18 +1401,33 @@ class ValueFunction:
                     pass
         return None
 
-    def set(self,name,state,action,horizon,value):
-        while True:
-            try:
-                V = self.table[horizon]
-                break
-            except IndexError:
-                self.table.append({})
-        if not V.has_key(state):
-            V[state] = {}
-        if not V[state].has_key(name):
-            V[state][name] = {}
-        V[state][name][action] = value
+    def set(self,name,state,action,horizon,value,variance=0.):
+        """
+        @param variance: the variance of the given value, if it is an estimate (default is 0)
+        @type variance: float
+        """
+        for table,entry in [(self.table,value),(self.variances,variance)]:
+            while True:
+                try:
+                    V = table[horizon]
+                    break
+                except IndexError:
+                    table.append({})
+            if not V.has_key(state):
+                V[state] = {}
+            if not V[state].has_key(name):
+                V[state][name] = {}
+            V[state][name][action] = entry
+
+    def getVariance(self,name,state,action,horizon):
+        """
+        @return: the variance of the value stored for the given agent, state, action, and horizon (0 if there is no such value, or if it is exact)
+        @rtype: float
+        """
+        try:
+            return self.variances[horizon][state][name][action]
+        except (IndexError,KeyError):
+            return 0.
 
     def add(self,name,state,action,horizon,value):
         """
@@ -1256,6 +1474,9 @@ class ValueFunction:
                     for action,V in V_s_a.items():
                         subsubnode = doc.createElement('value')
                         subsubnode.setAttribute('agent',name)
+                        variance = self.getVariance(name,state,action,horizon)
+                        if variance:
+                            subsubnode.setAttribute('variance',str(variance))
                         if action:
                             subsubnode.appendChild(action.__xml__().documentElement)
                         subsubnode.appendChild(doc.createTextNode(str(V)))
@@ -1266,6 +1487,7 @@ class ValueFunction:
     def parse(self,element):
         assert element.tagName == 'V',element.tagName
         del self.table[:]
+        del self.variances[:]
         node = element.firstChild
         while node:
             if node.nodeType == node.ELEMENT_NODE:
@@ -1279,6 +1501,11 @@ class ValueFunction:
                         elif subnode.tagName == 'value':
                             action = None
                             agent = str(subnode.getAttribute('agent'))
+                            variance = subnode.getAttribute('variance')
+                            if variance:
+                                variance = float(variance)
+                            else:
+                                variance = 0.
                             subsubnode = subnode.firstChild
                             while subsubnode:
                                 if subsubnode.nodeType == subsubnode.ELEMENT_NODE:
@@ -1295,6 +1522,20 @@ class ValueFunction:
                                     if text:
                                         value = float(text)
                                 subsubnode = subsubnode.nextSibling
-                            self.set(agent,state,action,horizon,value)
+                            self.set(agent,state,action,horizon,value,variance)
                     subnode = subnode.nextSibling
             node = node.nextSibling
+
+class DeadlineExceeded(Exception):
+    """
+    Raised by L{Agent.value} once the time allowed for the current decision (see L{World.deadline<psychsim.world.World.deadline>}) has run out
+    """
+    pass
+
+def weighEstimate(key,value):
+    """
+    @return: the size of a memoized belief update, measured in the state vector entries of its index
+    @rtype: int
+    """
+    model,oldReal,newReal,omega = key
+    return len(oldReal)+len(newReal)+len(omega)+1
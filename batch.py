@@ -0,0 +1,383 @@
+"""
+Class definition for simulating many sampled worlds in lockstep
+"""
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from action import Action,ActionSet
+from probability import Distribution,makeGenerator
+from pwl import *
+from world import modelKey,isModelKey,isTurnKey
+
+class Batch:
+    """
+    A batch of possible worlds, sampled from a world's state, that are simulated in lockstep. The worlds are stored as the rows of a matrix, and each dynamics, termination, and policy tree is compiled (see L{KeyedTree.compile}) so that it is evaluated for all of the rows reaching it at once. Any steps that cannot be batched (e.g., belief updates, or agents without a policy tree) fall back on the usual per-world methods for the rows involved.
+    @ivar world: the world being simulated
+    @type world: L{World<psychsim.world.World>}
+    @ivar index: the assignment of state features to columns
+    @type index: L{VectorIndex}
+    @ivar states: the value of each state feature, one row per world
+    @type states: numpy.ndarray
+    @ivar mask: flags indicating which state features are present in each world
+    @type mask: numpy.ndarray
+    @ivar done: flags indicating which worlds have reached a terminal state
+    @type done: numpy.ndarray
+    @ivar steps: the number of steps each world has taken
+    @type steps: numpy.ndarray
+    @ivar generator: the random number generator used for sampling
+    @type generator: C{random.Random}
+    """
+    def __init__(self,world,size,seed=None):
+        """
+        @param size: the number of worlds to sample from the world's current state
+        @type size: int
+        @param seed: the seed for the random number generator (default is C{None}, i.e., the C{random} module)
+        @type seed: int
+        """
+        if numpy is None:
+            raise ImportError,'NumPy is required for %s' % (self.__class__.__name__)
+        self.world = world
+        self.generator = makeGenerator(seed)
+        self.compiled = {}
+        self.index = VectorIndex()
+        for vector in world.state[None].domain():
+            for key in vector.keys():
+                self.index.add(key)
+        self.states = numpy.zeros((size,len(self.index)))
+        self.mask = numpy.zeros((size,len(self.index)),bool)
+        for row,vector in enumerate(world.state[None].sampleN(size,self.generator)):
+            self.store(row,vector)
+        self.done = numpy.zeros(size,bool)
+        self.steps = numpy.zeros(size,numpy.intp)
+        self.terminate(numpy.arange(size))
+
+    def __len__(self):
+        return len(self.states)
+
+    def fit(self):
+        """
+        Extends my columns to cover any state features added to my index
+        """
+        extra = len(self.index)-self.states.shape[1]
+        if extra > 0:
+            self.states = numpy.hstack((self.states,numpy.zeros((len(self),extra))))
+            self.mask = numpy.hstack((self.mask,numpy.zeros((len(self),extra),bool)))
+
+    def vector(self,row):
+        """
+        @return: the given world as a state vector
+        @rtype: L{KeyedVector}
+        """
+        return KeyedVector(dict([(self.index.keys[slot],self.states.item(row,slot))
+                                 for slot in numpy.flatnonzero(self.mask[row])]))
+
+    def store(self,row,vector):
+        """
+        Overwrites the given world with the given state vector
+        """
+        for key in vector.keys():
+            self.index.add(key)
+        self.fit()
+        self.states[row] = 0.
+        self.mask[row] = False
+        for key,value in vector.items():
+            slot = self.index.slots[key]
+            self.states[row,slot] = value
+            self.mask[row,slot] = True
+
+    def compile(self,tree):
+        """
+        @return: the compiled version of the given tree, or C{None} if it cannot be compiled (e.g., it is still symbolic)
+        @rtype: L{CompiledTree}
+        """
+        try:
+            return self.compiled[id(tree)][1]
+        except KeyError:
+            pass
+        try:
+            compiled = tree.compile(self.index)
+        except ValueError:
+            compiled = None
+        self.fit()
+        # Hold on to the tree itself so that its id is not reused
+        self.compiled[id(tree)] = (tree,compiled)
+        return compiled
+
+    def select(self,compiled,rows):
+        """
+        Routes the given worlds through the given tree, sampling a single outcome at any probabilistic branches
+        @return: the position in the leaf table reached by each of the given worlds
+        @rtype: numpy.ndarray
+        """
+        particles,leaves,prob,stochastic = compiled.route(self.states[rows])
+        if not stochastic.any():
+            return leaves
+        # The outcomes of each world are contiguous, so sample within each run of particles
+        starts = numpy.searchsorted(particles,numpy.arange(len(rows)))
+        total = numpy.cumsum(prob)
+        offset = numpy.concatenate(([0.],total))[starts]
+        cumulative = total-offset[particles]
+        sample = numpy.array([self.generator.random() for row in rows])
+        ends = numpy.concatenate((starts[1:],[len(particles)]))-1
+        choice = ends.copy()
+        hits = numpy.flatnonzero(cumulative > sample[particles])
+        if len(hits) > 0:
+            first = numpy.unique(particles[hits],return_index=True)
+            choice[first[0]] = hits[first[1]]
+        return leaves[choice]
+
+    def apply(self,actions,tree,key,rows,old,new):
+        """
+        Computes the new value of the given state feature in the given worlds, according to the given dynamics tree
+        @param old: the state before this step
+        @param new: the state after this step, which is modified in place
+        """
+        compiled = self.compile(tree)
+        if compiled is None:
+            # Tree can only be evaluated one world at a time
+            for row in rows:
+                vector = self.world.singleDeltaVector(actions,self.vector(row),key,[tree])
+                if isinstance(vector,Distribution):
+                    vector = vector.sample(generator=self.generator)
+                if vector.has_key(key):
+                    slot = self.index.add(key)
+                    if slot >= new[0].shape[1]:
+                        # New state feature
+                        self.fit()
+                        new = self.extend(new)
+                    new[0][row,slot] = vector[key]
+                    new[1][row,slot] = True
+            return new
+        leaves = self.select(compiled,rows)
+        for leaf in numpy.unique(leaves):
+            matrix = compiled.leaves[leaf]
+            if not isinstance(matrix,KeyedMatrix) or not matrix.has_key(key):
+                # Null effect
+                continue
+            subset = rows[leaves == leaf]
+            slots,weights = self.index.gather(matrix[key])
+            slot = self.index.add(key)
+            if slot >= new[0].shape[1] or slots.max() >= old[0].shape[1]:
+                # New state features
+                self.fit()
+                old = self.states,self.mask
+                new = self.extend(new)
+            present = old[1][subset][:,slots].any(axis=1)
+            subset = subset[present]
+            new[0][subset,slot] = old[0][subset][:,slots].dot(weights)
+            new[1][subset,slot] = True
+        return new
+
+    def extend(self,state):
+        """
+        @return: the given copy of my states, widened to match my current index
+        """
+        values,mask = state
+        extra = len(self.index)-values.shape[1]
+        values = numpy.hstack((values,numpy.zeros((len(values),extra))))
+        mask = numpy.hstack((mask,numpy.zeros((len(mask),extra),bool)))
+        state[:] = [values,mask]
+        return state
+
+    def decide(self,rows):
+        """
+        @return: the actions chosen by the agents whose turn it is in each of the given worlds
+        @rtype: strS{->}L{ActionSet}[]
+        """
+        actions = [{} for row in rows]
+        turns = {}
+        for name,key in self.world.turnKeys.items():
+            if self.index.has_key(key):
+                slot = self.index.slots[key]
+                turn = numpy.where(self.mask[rows,slot],numpy.floor(self.states[rows,slot]),numpy.inf)
+                turns[name] = turn
+        if len(turns) == 0:
+            # No turn information
+            return actions
+        first = numpy.min(numpy.array(turns.values()),axis=0)
+        for name,turn in turns.items():
+            agent = self.world.agents[name]
+            acting = numpy.flatnonzero((turn == first) & (turn < numpy.inf))
+            # Group the worlds by the agent's model in each
+            models = {}
+            key = modelKey(name)
+            for position in acting:
+                if self.index.has_key(key) and self.mask[rows[position],self.index.slots[key]]:
+                    model = agent.index2model(self.states[rows[position],self.index.slots[key]])
+                else:
+                    model = True
+                try:
+                    models[model].append(position)
+                except KeyError:
+                    models[model] = [position]
+            for model,positions in models.items():
+                policy = agent.getAttribute('policy',model)
+                if policy and agent.getAttribute('beliefs',model) is True and \
+                        isinstance(policy,KeyedTree):
+                    compiled = self.compile(policy)
+                else:
+                    compiled = None
+                if compiled is None:
+                    choices = [None for position in positions]
+                else:
+                    choices = compiled.evaluate(self.states[rows[positions]])
+                for position,choice in zip(positions,choices):
+                    if isinstance(choice,Distribution):
+                        choice = choice.sample(generator=self.generator)
+                    if not choice:
+                        # No policy, so use the usual decision procedure
+                        decision = agent.decide(self.vector(rows[position]),others=actions[position],
+                                                model=model)
+                        choice = decision['action']
+                        if isinstance(choice,Distribution):
+                            choice = choice.sample(generator=self.generator)
+                    if isinstance(choice,Action):
+                        choice = ActionSet([choice])
+                    actions[position][name] = choice
+        return actions
+
+    def exact(self,rows):
+        """
+        @return: flags indicating which of the given worlds require a belief update, which is not batched
+        @rtype: numpy.ndarray
+        """
+        result = numpy.zeros(len(rows),bool)
+        for name,agent in self.world.agents.items():
+            key = modelKey(name)
+            if self.index.has_key(key):
+                slot = self.index.slots[key]
+                for position in range(len(rows)):
+                    if self.mask[rows[position],slot]:
+                        model = agent.index2model(self.states[rows[position],slot])
+                        beliefs = agent.getAttribute('beliefs',model)
+                        if not beliefs is True and not agent.getAttribute('static',model):
+                            result[position] = True
+        return result
+
+    def step(self):
+        """
+        Advances all of the worlds that have not yet terminated by one step
+        @return: the number of worlds that took a step
+        @rtype: int
+        """
+        rows = numpy.flatnonzero(~self.done)
+        if len(rows) == 0:
+            return 0
+        actions = self.decide(rows)
+        exact = self.exact(rows)
+        # Group the worlds by joint action
+        groups = {}
+        for position in range(len(rows)):
+            if exact[position]:
+                # Full update, including beliefs, one world at a time
+                outcome = self.world.stepFromState(self.vector(rows[position]),actions[position])
+                vector = outcome['new']
+                if isinstance(vector,Distribution):
+                    vector = vector.sample(generator=self.generator)
+                self.store(rows[position],vector)
+            else:
+                joint = frozenset(actions[position].items())
+                try:
+                    groups[joint].append(rows[position])
+                except KeyError:
+                    groups[joint] = [rows[position]]
+        for joint,subset in groups.items():
+            self.transition(dict(joint),numpy.array(subset))
+        self.steps[rows] += 1
+        self.terminate(rows)
+        return len(rows)
+
+    def transition(self,actions,rows):
+        """
+        Applies the effects of the given actions to the given worlds
+        """
+        affected = self.world.getAffected(actions)
+        old = [self.states,self.mask]
+        for keySet in self.world.evaluationOrder:
+            if not affected is None:
+                keySet = keySet & affected
+            if len(keySet) == 0:
+                continue
+            new = [old[0].copy(),old[1].copy()]
+            for key in keySet:
+                dynamics = self.world.getDynamics(key,actions)
+                if len(dynamics) == 1:
+                    new = self.apply(actions,dynamics[0],key,rows,old,new) or new
+                elif len(dynamics) > 1:
+                    # Multiply deltas in sequence
+                    assert self.world.variables[key]['combinator'] == '*',\
+                        'No valid combinator specified for multiple effects on %s' % (key)
+                    for tree in dynamics:
+                        new = self.apply(actions,tree,key,rows,new,[new[0].copy(),new[1].copy()]) or new
+            self.states,self.mask = new
+            old = new
+        # Update turn order (based on the turns before this step)
+        names = [name for name in self.world.turnKeys.keys() if self.index.has_key(self.world.turnKeys[name])]
+        if names:
+            if self.world.maxTurn is None:
+                slots = [self.index.slots[self.world.turnKeys[name]] for name in names]
+                self.world.maxTurn = int(self.states[:,slots].max())
+            if self.world.turnDefaults is None:
+                self.world.compileOrder()
+            old = [self.states,self.mask]
+            new = [self.states.copy(),self.mask.copy()]
+            for name in names:
+                key = self.world.turnKeys[name]
+                dynamics = self.world.getDynamics(key,actions)
+                if len(dynamics) == 0:
+                    dynamics = [self.world.turnDefaults[name][actions.has_key(name)]]
+                slot = self.index.slots[key]
+                present = rows[old[1][rows,slot]]
+                new = self.apply(actions,dynamics[0],key,present,old,new) or new
+            self.states,self.mask = new
+
+    def terminate(self,rows):
+        """
+        Checks the given worlds against the termination conditions
+        """
+        condition = self.world.getTermination()
+        if condition is None:
+            return
+        remaining = rows[~self.done[rows]]
+        compiled = self.compile(condition)
+        if compiled is None:
+            for row in remaining:
+                if condition[self.vector(row)]:
+                    self.done[row] = True
+        else:
+            leaves = self.select(compiled,remaining)
+            for leaf in numpy.unique(leaves):
+                if compiled.leaves[leaf]:
+                    self.done[remaining[leaves == leaf]] = True
+
+    def run(self,horizon=None):
+        """
+        Steps the worlds until they have all terminated
+        @param horizon: the maximum number of steps (default is C{None}, i.e., no limit)
+        @type horizon: int
+        """
+        t = 0
+        while horizon is None or t < horizon:
+            if self.step() == 0:
+                break
+            t += 1
+
+    def summary(self):
+        """
+        @return: the statistics of the numeric state features (excluding turns and models) across the worlds, in the same form as L{rollouts<psychsim.parallel.rollouts>}
+        @rtype: dict
+        """
+        result = {'mean': {},'variance': {},'min': {},'max': {},'steps': self.steps.mean()}
+        for slot in range(len(self.index)):
+            key = self.index.keys[slot]
+            if key == CONSTANT or isModelKey(key) or isTurnKey(key):
+                continue
+            values = self.states[self.mask[:,slot],slot]
+            if len(values) > 0:
+                result['mean'][key] = values.mean()
+                result['variance'][key] = values.var()
+                result['min'][key] = values.min()
+                result['max'][key] = values.max()
+        return result
@@ -0,0 +1,102 @@
+"""
+Class definition for bounded tables of memoized results
+"""
+from collections import OrderedDict
+
+class LRUCache:
+    """
+    Table of memoized results that holds at most a fixed number of entries, evicting the least recently used one when full
+    @ivar size: the maximum number of entries, or total weight if weighing entries (C{None} means unbounded, 0 means nothing is stored)
+    @type size: int
+    @ivar weigh: optional function returning the weight (e.g., estimated memory) of a key and value, which is otherwise 1 per entry
+    @type weigh: lambda key,value: int
+    @ivar weight: the total weight of the entries currently stored
+    @type weight: int
+    @ivar hits: the number of lookups that found an entry
+    @type hits: int
+    @ivar misses: the number of lookups that did not
+    @type misses: int
+    """
+    def __init__(self,size=None,weigh=None):
+        self.table = OrderedDict()
+        self.size = size
+        self.weigh = weigh
+        self.weights = {}
+        self.weight = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __getitem__(self,key):
+        try:
+            value = self.table.pop(key)
+        except KeyError:
+            self.misses += 1
+            raise
+        # Move to the most recently used end
+        self.table[key] = value
+        self.hits += 1
+        return value
+
+    def get(self,key,default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __setitem__(self,key,value):
+        if self.size == 0:
+            return
+        if key in self.table:
+            del self[key]
+        self.table[key] = value
+        if self.weigh is None:
+            self.weight += 1
+        else:
+            self.weights[key] = self.weigh(key,value)
+            self.weight += self.weights[key]
+        self.evict()
+
+    def __delitem__(self,key):
+        del self.table[key]
+        if self.weigh is None:
+            self.weight -= 1
+        else:
+            self.weight -= self.weights.pop(key)
+
+    def __contains__(self,key):
+        return key in self.table
+
+    def __len__(self):
+        return len(self.table)
+
+    def evict(self):
+        """
+        Removes least recently used entries until within my size limit
+        """
+        if not self.size is None:
+            while self.weight > self.size:
+                del self[iter(self.table).next()]
+
+    def resize(self,size):
+        """
+        Changes the maximum number of entries, evicting any in excess of the new limit
+        @type size: int
+        """
+        self.size = size
+        self.evict()
+
+    def clear(self,stats=True):
+        """
+        Removes all entries
+        @param stats: if C{True}, then reset the hit and miss counts as well (default is C{True})
+        @type stats: bool
+        """
+        self.table.clear()
+        self.weights.clear()
+        self.weight = 0
+        if stats:
+            self.hits = 0
+            self.misses = 0
+
+    def __str__(self):
+        return '%d entries (%d/%s), %d hits, %d misses' % (len(self),self.weight,self.size,self.hits,self.misses)
@@ -472,7 +472,7 @@ def fitWorld(world):
                     policy[horizon-1] = policy[horizon-1].map(lambda leaf: leaf['action'] 
                                                               if isinstance(leaf,dict) else leaf)
     #                print 'Unpruned:'
-                    policy[horizon-1].minimizePlanes()
+                    policy[horizon-1] = policy[horizon-1].minimizePlanes()
     #                print policy[horizon-1]
                     pruned = policy[horizon-1].prune()
     #                print 'Pruned:'
@@ -0,0 +1,98 @@
+"""
+Class definition for the record of simulation steps
+"""
+import cPickle
+from collections import deque
+import tempfile
+
+class History:
+    """
+    Record of the outcomes of each simulation step, keeping only the most recent steps in memory and appending any older ones to a file. Supports the list operations used on L{World.history<psychsim.world.World.history>}: C{append}, C{len}, indexing, and iteration (which replays the steps in order, reading any older ones back from the file one at a time).
+    @ivar size: the number of most recent steps kept in memory (default is C{None}, i.e., all of them)
+    @type size: int
+    @ivar filename: the file to which older steps are written (default is C{None}, i.e., an anonymous temporary file)
+    @type filename: str
+    @ivar recent: the most recent steps
+    @type recent: deque
+    @ivar offsets: the position within the file of each of the older steps
+    @type offsets: int[]
+    """
+    def __init__(self,size=None,filename=None):
+        self.size = size
+        self.filename = filename
+        self.recent = deque()
+        self.offsets = []
+        self.file = None
+
+    def append(self,outcomes):
+        self.recent.append(outcomes)
+        if not self.size is None:
+            while len(self.recent) > self.size:
+                self.spill(self.recent.popleft())
+
+    def spill(self,outcomes):
+        """
+        Writes the given step to the end of the file
+        """
+        if self.file is None:
+            if self.filename is None:
+                self.file = tempfile.TemporaryFile()
+            else:
+                self.file = open(self.filename,'w+b')
+        self.file.seek(0,2)
+        self.offsets.append(self.file.tell())
+        cPickle.dump(outcomes,self.file,cPickle.HIGHEST_PROTOCOL)
+
+    def load(self,index):
+        """
+        @return: the given step, read back from the file
+        """
+        self.file.flush()
+        self.file.seek(self.offsets[index])
+        return cPickle.load(self.file)
+
+    def __len__(self):
+        return len(self.offsets)+len(self.recent)
+
+    def __getitem__(self,index):
+        if isinstance(index,slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError,'History index out of range'
+        elif index < len(self.offsets):
+            return self.load(index)
+        else:
+            return self.recent[index-len(self.offsets)]
+
+    def __iter__(self):
+        for index in range(len(self.offsets)):
+            yield self.load(index)
+        for outcomes in list(self.recent):
+            yield outcomes
+
+    def __delitem__(self,index):
+        if isinstance(index,slice) and index.indices(len(self)) == (0,len(self),1):
+            self.clear()
+        else:
+            raise NotImplementedError,'Only the whole history can be deleted'
+
+    def clear(self):
+        """
+        Removes all steps, both in memory and on file
+        """
+        self.recent.clear()
+        del self.offsets[:]
+        if not self.file is None:
+            self.file.seek(0)
+            self.file.truncate()
+
+    def close(self):
+        """
+        Closes the file (after which the older steps are no longer available)
+        """
+        if not self.file is None:
+            self.file.close()
+            self.file = None
+            del self.offsets[:]
@@ -0,0 +1,252 @@
+"""
+Class definition for Monte Carlo Tree Search as an alternative to exhaustive lookahead in L{Agent.decide<psychsim.agent.Agent.decide>}
+"""
+import math
+import random
+import time
+
+from probability import Distribution
+from cache import LRUCache
+
+class MCTS:
+    """
+    Sampling-based planner that estimates the value of an agent's actions by simulating the world forward (using L{World.stepFromState<psychsim.world.World.stepFromState>}) and applying UCT to choose the actions along the way. Every agent acting in a simulated state chooses its own action by UCT over its own reward (i.e., decoupled UCT over the joint actions), and the rest of each simulation beyond the search tree chooses actions uniformly at random. The search tree persists from one decision to the next, so that statistics gathered about a state by previous steps are reused whenever a later search reaches it again with the same remaining horizon (and the same actions already chosen by others).
+
+    Selected for a model by setting its C{planner} attribute to C{'mcts'}, and configured by these model attributes:
+       - iterations: the number of simulations per decision (default is L{iterations}), unless there is a deadline
+       - exploration: the weight of the exploration term in UCT (default is L{exploration})
+    @cvar iterations: the default number of simulations per decision
+    @type iterations: int
+    @cvar exploration: the default weight of the exploration term
+    @type exploration: float
+    @ivar agent: the agent whose decisions are being made
+    @type agent: L{Agent<psychsim.agent.Agent>}
+    @ivar nodes: the visit counts and mean returns of each agent's actions, indexed by the deciding agent's model, state vector, remaining horizon, and other agents' fixed actions (see L{index})
+    @type nodes: L{LRUCache}
+    """
+    iterations = 100
+    exploration = 1.
+
+    def __init__(self,agent,size=100000):
+        """
+        @param size: the maximum number of states in the search tree
+        @type size: int
+        """
+        self.agent = agent
+        self.nodes = LRUCache(size)
+
+    def clear(self):
+        """
+        Discards the search tree
+        """
+        self.nodes.clear(False)
+
+    def evaluate(self,belief,actions,horizon,others=None,model=True,deadline=None):
+        """
+        Estimates the value of each of the given actions, sampling the initial state of each simulation from the given beliefs
+        @param belief: the agent's subjective beliefs
+        @type belief: L{VectorDistribution}
+        @param actions: the agent's possible actions
+        @type actions: {L{ActionSet}}
+        @param others: the actions already chosen by other agents in this time step
+        @type others: strS{->}L{ActionSet}
+        @param deadline: if given, run simulations until this time (as returned by C{time.time()}), instead of for a fixed number of iterations (default is C{None})
+        @type deadline: float
+        @return: a table, indexed by action, of the expected value (under C{'__EV__'}) and number of visits (under C{'__N__'}, which includes any later visits to the same state within a simulation), omitting any actions that were never simulated
+        @rtype: dict
+        """
+        iterations = self.agent.getAttribute('iterations',model)
+        if iterations is None:
+            iterations = self.iterations
+        count = 0
+        while True:
+            if deadline is None:
+                if count >= iterations:
+                    break
+            elif count > 0 and time.time() >= deadline:
+                break
+            self.simulate(belief.sample(),horizon,model,others,actions)
+            count += 1
+        # Combine the statistics across possible worlds
+        V = {}
+        me = self.agent.name
+        for action in actions:
+            total = 0.
+            weight = 0.
+            visits = 0
+            for state in belief.domain():
+                node = self.nodes.get(self.index(state,model,horizon,others))
+                if node and node['n'].get(me,{}).get(action,0) > 0:
+                    total += belief[state]*node['Q'][me][action]
+                    weight += belief[state]
+                    visits += node['n'][me][action]
+            if visits > 0:
+                V[action] = {'__EV__': total/weight,'__N__': visits}
+        return V
+
+    def simulate(self,vector,horizon,model,others=None,actions=None):
+        """
+        Runs a single simulation from the given state, adding at most one new state to the search tree
+        @param others: the actions already chosen by other agents in the given state (default is none)
+        @param actions: the possible actions of the deciding agent in the given state (default is all legal actions)
+        @return: the return of each agent
+        @rtype: strS{->}float
+        """
+        world = self.agent.world
+        R = self.rewards(vector,model)
+        if horizon <= 0 or world.terminated(vector):
+            return R
+        try:
+            index = self.index(vector,model,horizon,others)
+            node = self.nodes[index]
+            expanded = True
+        except KeyError:
+            node = {'n': {},'Q': {}}
+            self.nodes[index] = node
+            expanded = False
+        except TypeError:
+            # Unhashable state vector
+            node = {'n': {},'Q': {}}
+            expanded = False
+        exploration = self.agent.getAttribute('exploration',model)
+        if exploration is None:
+            exploration = self.exploration
+        # Choose the actions of whoever's turn it is
+        turn = {}
+        for name in world.next(vector):
+            if others and others.has_key(name):
+                continue
+            elif name == self.agent.name and not actions is None:
+                legal = actions
+            else:
+                legal = world.agents[name].getActions(vector)
+            turn[name] = self.select(node,name,legal,exploration)
+        if not actions is None and not turn.has_key(self.agent.name):
+            turn[self.agent.name] = self.select(node,self.agent.name,actions,exploration)
+        joint = dict(turn)
+        if others:
+            joint.update(others)
+        new = self.step(vector,joint)
+        if new is None:
+            # No consistent outcome
+            return R
+        elif expanded:
+            future = self.simulate(new,horizon-1,model)
+        else:
+            future = self.rollout(new,horizon-1,model)
+        result = self.accumulate(R,future,model)
+        # Update statistics of the actions chosen
+        for name,action in turn.items():
+            if not node['n'].has_key(name):
+                node['n'][name] = {}
+                node['Q'][name] = {}
+            count = node['n'][name].get(action,0)+1
+            node['n'][name][action] = count
+            mean = node['Q'][name].get(action,0.)
+            node['Q'][name][action] = mean+(result.get(name,0.)-mean)/float(count)
+        return result
+
+    def index(self,vector,model,horizon,others=None):
+        """
+        Models created by belief updates (see L{Agent.belief2model<psychsim.agent.Agent.belief2model>}) differ from their parents only in their beliefs, which the simulations ignore, so the search tree identifies each of them with its nearest non-transient ancestor, both as the deciding agent's model and within the state vector. Otherwise, every belief update would start the search over. Returns from different remaining horizons, or with different actions already fixed for other agents, are not comparable, so those stay apart.
+        @param others: the actions already chosen by other agents in the given state (default is none)
+        @type others: strS{->}L{ActionSet}
+        @return: the key of the given state in the search tree
+        @rtype: tuple
+        """
+        world = self.agent.world
+        mapping = {}
+        for name,label in world.vectorModels(vector):
+            agent = world.agents[name]
+            root = self.root(agent,label)
+            if root != label:
+                mapping[name] = {agent.model2index(label): agent.model2index(root)}
+        if mapping:
+            vector = world.translateModels(vector,mapping)
+        if others:
+            others = frozenset(others.items())
+        else:
+            others = None
+        return (self.root(self.agent,model),vector,horizon,others)
+
+    def root(self,agent,model):
+        """
+        @return: the nearest ancestor of the given model (possibly itself) that was not created by a belief update
+        @rtype: str
+        """
+        while agent.models.get(model,{}).get('transient',False):
+            model = agent.models[model]['parent']
+        return model
+
+    def rollout(self,vector,horizon,model):
+        """
+        Simulates the given state forward with randomly chosen actions
+        @return: the return of each agent
+        @rtype: strS{->}float
+        """
+        world = self.agent.world
+        R = self.rewards(vector,model)
+        if horizon <= 0 or world.terminated(vector):
+            return R
+        joint = {}
+        for name in world.next(vector):
+            joint[name] = random.choice(sorted(world.agents[name].getActions(vector)))
+        new = self.step(vector,joint)
+        if new is None:
+            return R
+        return self.accumulate(R,self.rollout(new,horizon-1,model),model)
+
+    def step(self,vector,actions):
+        """
+        @return: a sampled state resulting from the given actions, or C{None} if there is no consistent outcome
+        @rtype: L{KeyedVector}
+        """
+        outcome = self.agent.world.stepFromState(vector,actions,updateBeliefs=False)
+        new = outcome.get('new')
+        if isinstance(new,Distribution):
+            new = new.sample()
+        return new
+
+    def select(self,node,name,actions,exploration):
+        """
+        Applies UCT to choose the given agent's action in the given node of the search tree
+        @rtype: L{ActionSet}
+        """
+        actions = sorted(actions)
+        counts = node['n'].get(name,{})
+        untried = [action for action in actions if counts.get(action,0) == 0]
+        if untried:
+            return random.choice(untried)
+        values = node['Q'][name]
+        total = math.log(sum([counts[action] for action in actions]))
+        best = None
+        for action in actions:
+            score = values[action]+exploration*math.sqrt(total/float(counts[action]))
+            if best is None or score > best[0]:
+                best = (score,action)
+        return best[1]
+
+    def rewards(self,vector,model):
+        """
+        @return: the reward of each agent in the given state, using the given model for the deciding agent and the models in the state for everyone else
+        @rtype: strS{->}float
+        """
+        result = {}
+        for name,agent in self.agent.world.agents.items():
+            if name == self.agent.name:
+                result[name] = agent.reward(vector,model)
+            else:
+                result[name] = agent.reward(vector,self.agent.world.getModel(name,vector))
+        return result
+
+    def accumulate(self,R,future,model):
+        """
+        @return: the immediate rewards plus the discounted future returns (or just the latter, if only the final value matters), as in L{Agent.value<psychsim.agent.Agent.value>}
+        @rtype: strS{->}float
+        """
+        discount = self.agent.getAttribute('discount',model)
+        if discount < -1e-6:
+            # Only final value matters
+            return future
+        else:
+            return dict([(name,R[name]+discount*future.get(name,0.)) for name in R.keys()])
@@ -0,0 +1,418 @@
+"""
+Class definition for farming the possible worlds of a simulation step out to a pool of processes, and for running independent simulations in parallel
+"""
+import bz2
+import copy
+import multiprocessing
+import random
+import sys
+from xml.dom.minidom import parseString
+
+from pwl import CONSTANT,KeyedVector,KeyedMatrix,MatrixDistribution,VectorDistribution
+from agent import Agent
+from world import World,isModelKey,isTurnKey,modelKey
+
+# The copy of the world held by a worker process
+_world = None
+# The labels of the models in that copy that are also in the original world, by agent
+_models = {}
+# The number of entries of the pool's model log already added to that copy
+_synced = 0
+
+def _initialize(snapshot,agentClass):
+    """
+    Builds the worker's copy of the world from the compressed XML snapshot
+    """
+    global _world,_synced
+    _world = World()
+    _world.parse(parseString(bz2.decompress(snapshot)).documentElement,agentClass)
+    _models.clear()
+    for name,agent in _world.agents.items():
+        _models[name] = set(agent.models.keys())
+    _synced = 0
+
+def _sync(log):
+    """
+    Adds the models that the original world has gained since the snapshot, and that the worker's copy does not have yet
+    @param log: the models added since the snapshot (agent name, label, index, parent, and beliefs), in order
+    @type log: list
+    """
+    global _synced
+    for name,label,index,parent,beliefs in log[_synced:]:
+        model = _world.agents[name].addModel(label,index=index,parent=parent,beliefs=beliefs,transient=True)
+        assert model['index'] == index,'Model index %d of %s already in use by worker' % (index,name)
+        _models[name].add(label)
+    _synced = len(log)
+
+def _restore():
+    """
+    Deletes the models created by the last task, so that the worker's models match those of the original world again
+    @return: the deleted models (agent name, label, index, parent, and beliefs), in order of creation
+    @rtype: list
+    """
+    created = []
+    mapping = {}
+    for name,agent in _world.agents.items():
+        for label in agent.models.keys():
+            if not label in _models[name]:
+                model = agent.models[label]
+                created.append((model['index'],name,label,model['parent'],model.get('beliefs',True)))
+                if not mapping.has_key(name):
+                    mapping[name] = {}
+                mapping[name][model['index']] = None
+                agent.deleteModel(label)
+    if mapping:
+        # Cached values may refer to the deleted models, whose indices may be reused
+        _world.remapModels(mapping)
+    created.sort()
+    return [(name,label,index,parent,beliefs) for index,name,label,parent,beliefs in created]
+
+def _stepFromState(args):
+    """
+    Computes the outcome of a single possible world within a worker process
+    @return: the outcome, along with the models created along the way (agent name, label, index, parent, and beliefs), in order of creation
+    """
+    log,vector,actions,horizon,tiebreak,updateBeliefs,keys = args
+    _sync(log)
+    try:
+        outcome = _world.stepFromState(vector,actions,horizon,tiebreak,updateBeliefs,keys)
+    finally:
+        created = _restore()
+    return outcome,created
+
+def _value(args):
+    """
+    Computes the value of a single action in a single possible world within a worker process
+    """
+    log,name,vector,action,horizon,others,model,keys = args
+    _sync(log)
+    try:
+        return _world.agents[name].value(vector,action,horizon,others,model,keys)
+    finally:
+        _restore()
+
+class WorldPool:
+    """
+    Pool of processes, each holding its own copy of a world, that compute the outcomes of possible worlds in parallel for L{World.step}, or the values of alternative actions in parallel for L{Agent.decide}
+    @ivar world: the world being simulated
+    @type world: L{World}
+    @ivar processes: the number of worker processes (default is the number of CPUs)
+    @type processes: int
+    @ivar agentClass: the class used to instantiate agents within the workers (default is L{Agent})
+    @type agentClass: class
+    @ivar models: the index of each model in the workers' copies, by agent and label
+    @type models: strS{->}strS{->}int
+    @ivar log: the models added to the world since the workers' snapshot (agent name, label, index, parent, and beliefs), which are sent along with each task
+    @type log: list
+    @ivar logSize: the number of models in the L{log} beyond which the workers get a fresh snapshot instead (default is 256)
+    @type logSize: int
+    @ivar revision: the L{World.revision} of the workers' snapshot
+    @type revision: int
+    @warning: the workers copy the world when the pool starts. Afterward, they receive only the models created by belief updates, and they get a fresh copy only when models are deleted or renumbered (e.g., by L{World.modelGC}), when a model is added by other means, or when the L{World.revision} changes (e.g., new dynamics or reward functions). Call L{refresh} after any modification of the world that bypasses L{World.invalidate}.
+    """
+    logSize = 256
+
+    def __init__(self,world,processes=None,agentClass=Agent):
+        self.world = world
+        self.processes = processes
+        self.agentClass = agentClass
+        self.pool = None
+        self.models = {}
+        self.log = []
+        self.revision = None
+
+    def sync(self):
+        """
+        Brings the workers' copies of the world up to date, by adding any new models created by belief updates to the L{log}, or else by a L{refresh}
+        """
+        if self.pool is None or self.revision != self.world.revision:
+            self.refresh()
+            return
+        added = []
+        for name,agent in self.world.agents.items():
+            known = self.models[name]
+            for label,index in known.items():
+                if agent.models.get(label,{}).get('index') != index:
+                    # Deleted or renumbered model
+                    self.refresh()
+                    return
+            if len(agent.models) > len(known):
+                for label,model in agent.models.items():
+                    if not known.has_key(label):
+                        if not model.get('transient',False):
+                            # Models may have arbitrary attributes when not created by a belief update
+                            self.refresh()
+                            return
+                        added.append((model['index'],name,label,model['parent'],model.get('beliefs',True)))
+        if len(self.log)+len(added) > self.logSize:
+            self.refresh()
+        else:
+            added.sort()
+            for index,name,label,parent,beliefs in added:
+                self.log.append((name,label,index,parent,beliefs))
+                self.models[name][label] = index
+
+    def refresh(self):
+        """
+        Restarts the workers with a fresh snapshot of the world
+        """
+        self.close()
+        snapshot = bz2.compress(self.world.__xml__().toprettyxml())
+        self.models.clear()
+        for name,agent in self.world.agents.items():
+            self.models[name] = dict([(label,model['index']) for label,model in agent.models.items()])
+        del self.log[:]
+        self.revision = self.world.revision
+        self.pool = multiprocessing.Pool(self.processes,_initialize,(snapshot,self.agentClass))
+
+    def close(self):
+        """
+        Shuts down the worker processes
+        """
+        if not self.pool is None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def stepFromState(self,vectors,actions=None,horizon=None,tiebreak=None,updateBeliefs=True,keys=None):
+        """
+        Parallel version of L{World.stepFromState} over multiple possible worlds
+        @param vectors: the possible worlds
+        @type vectors: L{KeyedVector}[]
+        @return: the outcomes for each of the given worlds, in the same order
+        @rtype: dict[]
+        """
+        self.sync()
+        args = [(self.log,vector,actions,horizon,tiebreak,updateBeliefs,keys) for vector in vectors]
+        outcomes = []
+        for outcome,created in self.pool.map(_stepFromState,args):
+            if created:
+                self.merge(outcome,created)
+            outcomes.append(outcome)
+        return outcomes
+
+    def value(self,name,requests,horizon=None,others=None,model=None):
+        """
+        Parallel version of L{Agent.value} over multiple action choices and possible worlds
+        @param name: the agent whose value is being computed
+        @type name: str
+        @param requests: the possible worlds, actions, and subsets of state features to evaluate
+        @type requests: (L{KeyedVector},L{ActionSet},set)[]
+        @return: the results for each of the given requests, in the same order
+        @rtype: dict[]
+        @warning: the indices of any models created within the projections refer to models that the workers have since deleted
+        """
+        self.sync()
+        args = [(self.log,name,vector,action,horizon,others,model,keys) for vector,action,keys in requests]
+        return self.pool.map(_value,args)
+
+    def merge(self,outcome,created):
+        """
+        Adds the models created by a worker into the world, translating their indices and labels within the given outcome
+        @param created: the models created by the worker, as returned by L{_stepFromState}
+        @type created: list
+        """
+        mapping = {}
+        labels = {}
+        for name,label,index,parent,beliefs in created:
+            agent = self.world.agents[name]
+            if not mapping.has_key(name):
+                mapping[name] = {}
+                labels[name] = {}
+            if isinstance(beliefs,VectorDistribution):
+                beliefs = self.world.translateModels(beliefs,mapping)
+            if labels[name].has_key(parent):
+                # Parent was also created by the worker
+                parent = labels[name][parent]
+            model = agent.belief2model(parent,beliefs)
+            mapping[name][index] = model['index']
+            labels[name][label] = model['name']
+        self.translate(outcome,mapping,labels,set())
+
+    def translate(self,outcome,mapping,labels,done):
+        """
+        Translates the model indices and labels within the given outcome (as returned by L{World.stepFromState}, or as found in the projection of a value) in place, including any decisions made along the way
+        @param mapping: the new index of each model created by the worker, by agent
+        @type mapping: strS{->}intS{->}int
+        @param labels: the new label of each model created by the worker, by agent
+        @type labels: strS{->}strS{->}str
+        @param done: the identities of the outcomes already translated (as outcomes may be shared within a projection)
+        @type done: set
+        """
+        if id(outcome) in done:
+            return
+        done.add(id(outcome))
+        for key in ['new','state']:
+            if outcome.has_key(key):
+                outcome[key] = self.world.translateModels(outcome[key],mapping)
+        if outcome.has_key('effect'):
+            outcome['effect'] = [translateEffect(effect,mapping) for effect in outcome['effect']]
+        if outcome.has_key('delta'):
+            outcome['delta'] = outcome['new'] - outcome['old']
+        for name in mapping.keys():
+            if outcome.has_key('SE %s' % (name)):
+                table = {}
+                for oldModel,estimates in outcome['SE %s' % (name)].items():
+                    table[labels[name].get(oldModel,oldModel)] = \
+                        dict([(omega,mapping[name].get(index,index)) for omega,index in estimates.items()])
+                outcome['SE %s' % (name)] = table
+        for entry in outcome.get('projection',[]):
+            self.translate(entry,mapping,labels,done)
+        for decision in outcome.get('decisions',{}).values():
+            for action,table in decision.get('V',{}).items():
+                new = {}
+                for state,value in table.items():
+                    if isinstance(value,dict):
+                        self.translate(value,mapping,labels,done)
+                        state = self.world.translateModels(state,mapping)
+                    new[state] = value
+                decision['V'][action] = new
+
+def translateEffect(effect,mapping):
+    """
+    @param effect: an effect within an outcome (as returned by L{World.stepFromState})
+    @param mapping: the new model index for each old model index that has changed, by agent
+    @type mapping: strS{->}intS{->}int
+    @return: the same effect, but with any changes to the given agents' models using the new indices
+    """
+    if isinstance(effect,MatrixDistribution):
+        result = MatrixDistribution()
+        for matrix in effect.domain():
+            result.addProb(translateEffect(matrix,mapping),effect[matrix])
+        return result
+    elif isinstance(effect,KeyedMatrix):
+        result = None
+        for name,table in mapping.items():
+            key = modelKey(name)
+            if effect.has_key(key) and effect[key].keys() == [CONSTANT]:
+                index = int(effect[key][CONSTANT]+0.5)
+                if table.has_key(index):
+                    if result is None:
+                        result = KeyedMatrix(effect)
+                    result[key] = KeyedVector({CONSTANT: table[index]})
+        if result is None:
+            return effect
+        else:
+            return result
+    else:
+        return effect
+
+def _rollout(args):
+    """
+    Runs a single simulation within a worker process
+    """
+    seed,horizon,select,trajectory = args
+    return rollout(_world,seed,horizon,select,trajectory)
+
+def rollout(world,seed=None,horizon=None,select=True,trajectory=False):
+    """
+    Simulates the given world from its current state until termination, and then restores that state (removing any models created along the way)
+    @param seed: the seed for the random number generator used in this simulation
+    @type seed: int
+    @param horizon: the maximum number of steps (default is C{None}, i.e., run until termination)
+    @type horizon: int
+    @param select: if C{True}, then sample a single possible world after each step (default is C{True})
+    @type select: bool
+    @param trajectory: if C{True}, then include the state after every step in the result (default is C{False})
+    @type trajectory: bool
+    @return: the final state (under C{'state'}), the number of steps taken (under C{'steps'}), and the states along the way if requested (under C{'trajectory'})
+    @rtype: dict
+    """
+    # Draw from our own seed, leaving the caller's random number sequence where we found it
+    generator = random.getstate()
+    random.seed(seed)
+    original = {}
+    for label,state in world.state.items():
+        original[label] = copy.copy(state)
+    models = dict([(name,set(agent.models.keys())) for name,agent in world.agents.items()])
+    memory = world.__dict__.get('memory')
+    world.memory = False
+    # Garbage collection would delete and renumber the models in the state we restore afterward
+    gc = (world.gcInterval,world.gcModelLimit,world.gcSteps)
+    world.gcInterval = None
+    world.gcModelLimit = None
+    result = {'steps': 0}
+    if trajectory:
+        result['trajectory'] = [copy.copy(world.state[None])]
+    try:
+        while (horizon is None or result['steps'] < horizon) and not world.terminated():
+            world.step(select=select)
+            result['steps'] += 1
+            if trajectory:
+                result['trajectory'].append(copy.copy(world.state[None]))
+        result['state'] = copy.copy(world.state[None])
+    finally:
+        # Restore the initial state (in place, in case anyone else has a reference to it)
+        for label,state in original.items():
+            world.state[label].clear()
+            for vector in state.domain():
+                world.state[label][vector] = state[vector]
+        if memory is None:
+            del world.memory
+        else:
+            world.memory = memory
+        world.gcInterval,world.gcModelLimit,world.gcSteps = gc
+        # Discard any models created by belief updates during the simulation
+        mapping = {}
+        for name,agent in world.agents.items():
+            for label in agent.models.keys():
+                if not label in models[name]:
+                    mapping.setdefault(name,{})[agent.model2index(label)] = None
+                    agent.deleteModel(label)
+        if mapping:
+            world.remapModels(mapping)
+        random.setstate(generator)
+    return result
+
+def rollouts(world,n,horizon=None,workers=None,seed=None,trajectories=False,select=True,agentClass=Agent):
+    """
+    Runs independent simulations of the given world from its current state, each with its own random number seed
+    @param n: the number of simulations
+    @type n: int
+    @param workers: the number of worker processes (default is the number of CPUs); if 1, then the simulations run within this process
+    @type workers: int
+    @param seed: the seed from which the seed of each simulation is drawn (default is C{None}, i.e., a random seed)
+    @type seed: int
+    @param trajectories: if C{True}, then include the results of the individual simulations (default is C{False})
+    @type trajectories: bool
+    @return: the statistics of the numeric state features (excluding turns and models) in the final states: C{'mean'}, C{'variance'}, C{'min'}, and C{'max'}, each a table indexed by feature, plus the mean number of steps (C{'steps'}), and the results of each simulation as returned by L{rollout} (C{'trajectories'}) if requested
+    @rtype: dict
+    @warning: the model indices in the results of simulations run in worker processes refer to those processes' copies of the models
+    """
+    generator = random.Random(seed)
+    seeds = [generator.randint(0,sys.maxint) for index in range(n)]
+    if workers == 1:
+        results = [rollout(world,value,horizon,select,trajectories) for value in seeds]
+    else:
+        snapshot = bz2.compress(world.__xml__().toprettyxml())
+        pool = multiprocessing.Pool(workers,_initialize,(snapshot,agentClass))
+        try:
+            results = pool.map(_rollout,[(value,horizon,select,trajectories) for value in seeds])
+        finally:
+            pool.close()
+            pool.join()
+    # Accumulate the values of each feature, weighted by the probability of each final world
+    total = {}
+    squares = {}
+    weight = {}
+    summary = {'min': {},'max': {},'steps': float(sum([result['steps'] for result in results]))/float(n)}
+    for result in results:
+        for vector in result['state'].domain():
+            prob = result['state'][vector]
+            for key,value in vector.items():
+                if key == CONSTANT or isModelKey(key) or isTurnKey(key) or \
+                        not isinstance(value,(int,float)):
+                    continue
+                total[key] = total.get(key,0.)+prob*value
+                squares[key] = squares.get(key,0.)+prob*value*value
+                weight[key] = weight.get(key,0.)+prob
+                summary['min'][key] = min(summary['min'].get(key,value),value)
+                summary['max'][key] = max(summary['max'].get(key,value),value)
+    summary['mean'] = {}
+    summary['variance'] = {}
+    for key in total.keys():
+        summary['mean'][key] = total[key]/weight[key]
+        summary['variance'][key] = max(squares[key]/weight[key]-summary['mean'][key]*summary['mean'][key],0.)
+    if trajectories:
+        summary['trajectories'] = results
+    return summary
@@ -1,4 +1,7 @@
+import bisect
+import copy
 import math
+import random
 from xml.dom.minidom import Document,Node
 
 class Distribution(dict):
@@ -12,8 +15,11 @@ class Distribution(dict):
 
     The possible domain values are any objects
     @warning: If you make the domain values mutable types, try not to change the values while they are inside the distribution.  If you must change a domain value, it is better to first delete the old value, change it, and then re-insert it.
+    @cvar hashed: if C{True}, then domain values are keyed by their own hash and equality (so they must be hashable), rather than by their C{str} representation (default is C{False})
+    @type hashed: bool
     """
     epsilon = 1e-8
+    hashed = False
 
     def __init__(self,args=None,rationality=None):
         """
@@ -23,6 +29,7 @@ class Distribution(dict):
         @type rationality: float
         """
         self._domain = {}
+        self._cumulative = None
         dict.__init__(self)
         if not args is None:
             if isinstance(args,Node):
@@ -43,6 +50,8 @@ class Distribution(dict):
                 self.normalize()
 
     def __getitem__(self,element):
+        if self.hashed:
+            return dict.__getitem__(self,element)
         key = str(element)
         return dict.__getitem__(self,key)
         
@@ -52,8 +61,12 @@ class Distribution(dict):
         @param value: the probability to associate with the given key
         @type value: float
         """
-        key = str(element)
+        if self.hashed:
+            key = element
+        else:
+            key = str(element)
         self._domain[key] = element
+        self._cumulative = None
         dict.__setitem__(self,key,value)
 
     def addProb(self,element,value):
@@ -75,13 +88,18 @@ class Distribution(dict):
             return 0.
 
     def __delitem__(self,element):
-        key = str(element)
+        if self.hashed:
+            key = element
+        else:
+            key = str(element)
         dict.__delitem__(self,key)
         del self._domain[key]
+        self._cumulative = None
 
     def clear(self):
         dict.clear(self)
         self._domain.clear()
+        self._cumulative = None
 
     def replace(self,old,new):
         """Replaces on element in the sample space with another.  Raises an exception if the original element does not exist, and an exception if the new element already exists (i.e., does not do a merge)
@@ -129,23 +147,59 @@ class Distribution(dict):
                     total += element*self[element]
             return total
 
-    def sample(self,quantify=False):
+    def cumulative(self):
+        """
+        @return: the elements of the domain, and the cumulative probability up to and including each of them (cached until the distribution is next modified)
+        @rtype: (list,float[])
+        """
+        if self._cumulative is None:
+            elements = self.domain()
+            table = []
+            total = 0.
+            for element in elements:
+                total += self[element]
+                table.append(total)
+            self._cumulative = (elements,table)
+        return self._cumulative
+
+    def sample(self,quantify=False,generator=None):
         """
         @param quantify: if C{True}, also returns the amount of mass by which the sampling crosssed the threshold of the generated sample's range
+        @param generator: the random number generator to draw from, or a seed for a new one (default is the C{random} module)
+        @type generator: C{random.Random} or int
         @return: an element from this domain, with a sample probability given by this distribution
         """
-        import random
-        selection = random.random()
-        for element in self.domain():
-            if selection > self[element]:
-                selection -= self[element]
-            else:
-                if quantify:
-                    return element,selection
-                else:
-                    return element
-        else:
+        generator = makeGenerator(generator)
+        elements,table = self.cumulative()
+        selection = generator.random()
+        index = bisect.bisect_left(table,selection)
+        if index == len(table):
             raise ValueError,'Random number exceeded total probability in distribution.'
+        if quantify:
+            if index > 0:
+                selection -= table[index-1]
+            return elements[index],selection
+        else:
+            return elements[index]
+
+    def sampleN(self,count,generator=None):
+        """
+        @param count: the number of samples to draw
+        @type count: int
+        @param generator: the random number generator to draw from, or a seed for a new one (default is the C{random} module)
+        @type generator: C{random.Random} or int
+        @return: independently sampled elements from this domain
+        @rtype: list
+        """
+        generator = makeGenerator(generator)
+        elements,table = self.cumulative()
+        result = []
+        for sample in xrange(count):
+            index = bisect.bisect_left(table,generator.random())
+            if index == len(table):
+                raise ValueError,'Random number exceeded total probability in distribution.'
+            result.append(elements[index])
+        return result
 
     def set(self,element):
         """
@@ -155,12 +209,14 @@ class Distribution(dict):
         self.clear()
         self[element] = 1.
 
-    def select(self):
+    def select(self,generator=None):
         """
         Reduce distribution to a single element, sampled according to the given distribution
+        @param generator: the random number generator to draw from, or a seed for a new one (default is the C{random} module)
+        @type generator: C{random.Random} or int
         @return: the probability of the selection made
         """
-        element = self.sample()
+        element = self.sample(generator=generator)
         prob = self[element]
         self.set(element)
         return prob
@@ -212,6 +268,8 @@ class Distribution(dict):
         doc.appendChild(root)
         for key,value in self._domain.items():
             prob = dict.__getitem__(self,key)
+            if self.hashed:
+                key = str(value)
             node = doc.createElement('entry')
             root.appendChild(node)
             node.setAttribute('probability',str(prob))
@@ -242,7 +300,9 @@ class Distribution(dict):
                 while subNode and subNode.nodeType != subNode.ELEMENT_NODE:
                     subNode = subNode.nextSibling
                 value = self.xml2element(key,subNode)
-                if not key:
+                if self.hashed:
+                    key = value
+                elif not key:
                     key = str(value)
                 dict.__setitem__(self,key,prob)
                 self._domain[key] = value
@@ -263,4 +323,29 @@ class Distribution(dict):
         return hash(str(self))
 
     def __copy__(self):
-        return self.__class__(self.__xml__().documentElement)
+        result = self.__class__()
+        dict.update(result,self)
+        result._domain.update(self._domain)
+        return result
+
+    def __deepcopy__(self,memo):
+        result = self.__class__()
+        memo[id(self)] = result
+        for element in self.domain():
+            result[copy.deepcopy(element,memo)] = self[element]
+        return result
+
+    def __reduce__(self):
+        return (self.__class__,(),None,None,iter([(element,self[element]) for element in self.domain()]))
+
+def makeGenerator(generator=None):
+    """
+    @param generator: a random number generator, a seed for a new one, or C{None}
+    @return: the given generator, a new one seeded with the given seed, or the C{random} module if C{None}
+    """
+    if generator is None:
+        return random
+    elif isinstance(generator,int) or isinstance(generator,long):
+        return random.Random(generator)
+    else:
+        return generator
@@ -0,0 +1,102 @@
+"""
+Linear feasibility testing for the conditions along paths in PWL decision trees
+"""
+
+def feasible(constraints,bounds={},epsilon=1e-8):
+    """
+    Determines whether a set of linear constraints can be satisfied simultaneously, using the first phase of the simplex method (with Bland's rule to avoid cycling)
+    @param constraints: each constraint is a tuple (weights,lo,hi), requiring that lo <= weights*x <= hi, where either bound may be C{None}
+    @type constraints: (L{KeyedVector},float,float)[]
+    @param bounds: the lower and upper bounds on each variable (either may be C{None}); any variable not in this table is unbounded
+    @type bounds: strS{->}(float,float)
+    @param epsilon: the tolerance for treating values as zero (default is 1e-8)
+    @type epsilon: float
+    @rtype: bool
+    """
+    # Rewrite each variable in terms of nonnegative columns: key -> (offset,[(column,sign)])
+    substitution = {}
+    rows = []
+    count = 0
+    for weights,lo,hi in constraints:
+        for key in weights.keys():
+            if not substitution.has_key(key):
+                low,high = bounds.get(key,(None,None))
+                if low is not None and high is not None and abs(high-low) < epsilon:
+                    # Constant
+                    substitution[key] = (low,[])
+                elif low is not None:
+                    substitution[key] = (low,[(count,1.)])
+                    if high is not None:
+                        rows.append(({count: 1.},1,high-low))
+                    count += 1
+                elif high is not None:
+                    substitution[key] = (high,[(count,-1.)])
+                    count += 1
+                else:
+                    # Free variable is difference of two nonnegative ones
+                    substitution[key] = (0.,[(count,1.),(count+1,-1.)])
+                    count += 2
+        coefficients = {}
+        offset = 0.
+        for key,weight in weights.items():
+            shift,columns = substitution[key]
+            offset += weight*shift
+            for column,sign in columns:
+                coefficients[column] = coefficients.get(column,0.)+weight*sign
+        if lo is not None:
+            rows.append((coefficients,-1,lo-offset))
+        if hi is not None:
+            rows.append((coefficients,1,hi-offset))
+    if len(rows) == 0:
+        return True
+    # Build tableau: original columns, then one slack and one artificial column per row
+    height = len(rows)
+    width = count+2*height
+    table = []
+    for index,(coefficients,sense,rhs) in enumerate(rows):
+        row = [0.]*(width+1)
+        for column,value in coefficients.items():
+            row[column] = value
+        row[count+index] = float(sense)
+        row[-1] = rhs
+        if rhs < 0.:
+            row = [-value for value in row]
+        row[count+height+index] = 1.
+        table.append(row)
+    basis = range(count+height,width)
+    # Minimize the sum of artificial variables
+    objective = [0.]*(width+1)
+    for row in table:
+        for column in range(count+height):
+            objective[column] -= row[column]
+        objective[-1] -= row[-1]
+    while True:
+        for enter in range(width):
+            if objective[enter] < -epsilon:
+                break
+        else:
+            # Optimal
+            break
+        leave = None
+        for index in range(height):
+            if table[index][enter] > epsilon:
+                ratio = table[index][-1]/table[index][enter]
+                if leave is None or ratio < best-epsilon or \
+                        (abs(ratio-best) <= epsilon and basis[index] < basis[leave]):
+                    leave = index
+                    best = ratio
+        if leave is None:
+            # Unbounded direction (cannot happen when minimizing a nonnegative sum)
+            break
+        pivot = table[leave]
+        scale = pivot[enter]
+        for column in range(width+1):
+            pivot[column] /= scale
+        for row in table+[objective]:
+            if not row is pivot:
+                factor = row[enter]
+                if abs(factor) > 0.:
+                    for column in range(width+1):
+                        row[column] -= factor*pivot[column]
+        basis[leave] = enter
+    return -objective[-1] < epsilon*max(1.,height)
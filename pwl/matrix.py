@@ -16,18 +16,19 @@ class KeyedMatrix(dict):
         else:
             dict.__init__(self,arg)
             self._string = None
+            self._hash = None
         
     def __eq__(self,other):
-        return str(self) == str(other)
-         # for key,vector in self.items():
-         #     try:
-         #         if vector != other[key]:
-         #             return False
-         #     except KeyError:
-         #         if vector != {}:
-         #             return False
-         # else:
-         #     return True
+        # Row by row, so that equality agrees with the structural hash
+        if not isinstance(other,KeyedMatrix) or len(self) != len(other):
+            return False
+        for key,vector in self.items():
+            try:
+                if vector != other[key]:
+                    return False
+            except KeyError:
+                return False
+        return True
 
     def __ne__(self,other):
         return not self == other
@@ -65,6 +66,12 @@ class KeyedMatrix(dict):
                                 result[r1][c2] += value1*value2
                             except KeyError:
                                 result[r1][c2] = value1*value2
+        elif isinstance(other,DenseVector):
+            result = KeyedVector()
+            for r1,v1 in self.items():
+                value = other.dot(v1)
+                if not value is None:
+                    result[r1] = value
         elif isinstance(other,KeyedVector):
             result = KeyedVector()
             for r1,v1 in self.items():
@@ -164,12 +171,24 @@ class KeyedMatrix(dict):
         assert isinstance(value,KeyedVector),'Illegal row type: %s' % \
             (value.__class__.__name__)
         self._string = None
+        self._hash = None
         dict.__setitem__(self,key,value)
 
     def update(self,other):
         self._string = None
+        self._hash = None
         dict.update(self,other)
     
+    def __copy__(self):
+        return self.__class__(self)
+
+    def __deepcopy__(self,memo):
+        result = self.__class__()
+        memo[id(self)] = result
+        for key,row in self.items():
+            result[key] = copy.deepcopy(row,memo)
+        return result
+
     def __str__(self):
         if self._string is None:
             joiner = lambda item: '%s*%s' % (item[1],item[0])
@@ -180,7 +199,9 @@ class KeyedMatrix(dict):
         return self._string
 
     def __hash__(self):
-        return hash(str(self))
+        if self._hash is None:
+            self._hash = hash(frozenset([(key,hash(row)) for key,row in self.items()]))
+        return self._hash
 
     def __xml__(self):
         doc = Document()
@@ -194,6 +215,7 @@ class KeyedMatrix(dict):
 
     def parse(self,element):
         self._string = None
+        self._hash = None
         assert element.tagName == 'matrix'
         node = element.firstChild
         while node:
@@ -260,12 +282,12 @@ def setFalseMatrix(key):
     return setToConstantMatrix(key,0.)
 
 class MatrixDistribution(Distribution):
+    hashed = True
+
     def update(self,matrix):
-        original = dict(self)
-        domain = self.domain()
+        worlds = [(old,self[old]) for old in self.domain()]
         self.clear()
-        for old in domain:
-            prob = original[old]
+        for old,prob in worlds:
             if isinstance(matrix,Distribution):
                 # Merge distributions
                 for submatrix in matrix.domain():
@@ -273,8 +295,9 @@ class MatrixDistribution(Distribution):
                     new.update(submatrix)
                     self.addProb(new,prob*matrix[submatrix])
             else:
-                old.update(matrix)
-                self[old] = prob
+                new = copy.copy(old)
+                new.update(matrix)
+                self.addProb(new,prob)
 
     def __mul__(self,other):
         if isinstance(other,Distribution):
@@ -1,7 +1,8 @@
 import operator
 from xml.dom.minidom import Node
 
-from vector import KeyedVector
+from vector import KeyedVector,evaluateExpression
+from . import CONSTANT
 
 class KeyedPlane:
     """
@@ -16,6 +17,7 @@ class KeyedPlane:
 
     def __init__(self,vector,threshold=None,comparison=1):
         self._string = None
+        self._hash = None
         if isinstance(vector,Node):
             self.parse(vector)
         else:
@@ -44,7 +46,7 @@ class KeyedPlane:
     def desymbolizeThreshold(self,threshold,table):
         if isinstance(threshold,str):
             try:
-                return eval(threshold,globals(),table)
+                return evaluateExpression(threshold,table)
             except NameError:
                 # Undefined reference: assume it'll get sorted out later
                 return threshold
@@ -77,12 +79,74 @@ class KeyedPlane:
         if not isinstance(other,KeyedPlane):
             return False
         elif self.vector == other.vector and \
-                self.threshold == other.threshold and \
+                self.sameThreshold(self.threshold,other.threshold) and \
                 self.comparison == other.comparison:
             return True
         else:
             return False
 
+    def sameThreshold(self,mine,yours):
+        """
+        @return: C{True} iff the two thresholds are equal (after the rounding used by L{__hash__}, if numeric)
+        @rtype: bool
+        """
+        if isinstance(mine,list):
+            return isinstance(yours,list) and len(mine) == len(yours) and \
+                all(map(self.sameThreshold,mine,yours))
+        elif isinstance(mine,float) and isinstance(yours,float):
+            return self.roundThreshold(mine) == self.roundThreshold(yours)
+        else:
+            return mine == yours
+
+    def __hash__(self):
+        if self._hash is None:
+            if isinstance(self.threshold,list):
+                threshold = tuple([self.roundThreshold(t) for t in self.threshold])
+            else:
+                threshold = self.roundThreshold(self.threshold)
+            self._hash = hash((self.vector,threshold,self.comparison))
+        return self._hash
+
+    def roundThreshold(self,threshold):
+        if isinstance(threshold,float):
+            return round(threshold,self.vector.digits)
+        else:
+            return threshold
+
+    def region(self,value):
+        """
+        @param value: the result of testing this hyperplane
+        @type value: bool
+        @return: a linear constraint (weights,lo,hi), requiring lo <= weights*x <= hi, that holds for any vector on which this hyperplane has the given result, or C{None} if there is no single such constraint
+        @rtype: (L{KeyedVector},float,float)
+        """
+        if isinstance(self.threshold,list):
+            if len(self.threshold) != 1:
+                return None
+            threshold = self.threshold[0]
+        else:
+            threshold = self.threshold
+        if isinstance(threshold,str):
+            return None
+        for weight in self.vector.values():
+            if isinstance(weight,str):
+                return None
+        epsilon = self.vector.epsilon
+        if self.comparison > 0:
+            if value:
+                return (self.vector,threshold-epsilon,None)
+            else:
+                return (self.vector,None,threshold-epsilon)
+        elif self.comparison < 0:
+            if value:
+                return (self.vector,None,threshold+epsilon)
+            else:
+                return (self.vector,threshold+epsilon,None)
+        elif value:
+            return (self.vector,threshold-epsilon,threshold+epsilon)
+        else:
+            return None
+
     def compare(self,other,value):
         """
         Identifies any potential conflicts between two hyperplanes
@@ -152,7 +216,10 @@ class KeyedPlane:
 
     def __xml__(self):
         doc = self.vector.__xml__()
-        doc.documentElement.setAttribute('threshold',str(self.threshold))
+        if isinstance(self.threshold,float):
+            doc.documentElement.setAttribute('threshold',repr(self.threshold))
+        else:
+            doc.documentElement.setAttribute('threshold',str(self.threshold))
         doc.documentElement.setAttribute('comparison',str(self.comparison))
         return doc
 
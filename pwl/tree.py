@@ -1,11 +1,19 @@
+import copy
+import weakref
 from xml.dom.minidom import Document,Node
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 from psychsim.probability import Distribution
 from psychsim.action import Action
+from psychsim.cache import LRUCache
 
-from vector import KeyedVector
+from vector import KeyedVector,DenseVector
 from matrix import *
 from plane import KeyedPlane
+from lp import feasible
 
 class KeyedTree:
     """
@@ -16,9 +24,17 @@ class KeyedTree:
     @type children: dict
     @ivar branch: the hyperplane branch at this node (if applicable)
     @type branch: L{KeyedPlane}
+    @ivar _factory: the factory that interned this node (C{None} if not interned)
+    @type _factory: L{TreeFactory}
+    @cvar cache: memoized results of L{compose} and L{expectation} on interned trees, keyed by the identities of the operands and the operation
+    @type cache: L{LRUCache}
     """
+    cache = LRUCache(4096)
+
     def __init__(self,leaf=None):
         self._string = None
+        self._hash = None
+        self._factory = None
         self._keysIn = None
         self._keysOut = None
         if isinstance(leaf,Node):
@@ -30,17 +46,23 @@ class KeyedTree:
         return self.leaf
 
     def makeLeaf(self,leaf):
+        assert self._factory is None,'Interned trees cannot be modified'
+        self._hash = None
         self.children = {None: leaf}
         self.leaf = True
         self.branch = None
 
     def makeBranch(self,plane,trueTree,falseTree):
+        assert self._factory is None,'Interned trees cannot be modified'
+        self._hash = None
         self.children = {True: trueTree,False: falseTree}
         self.branch = plane
         self.leaf = False
 
     def makeProbabilistic(self,distribution):
         assert isinstance(distribution,Distribution)
+        assert self._factory is None,'Interned trees cannot be modified'
+        self._hash = None
         self.children = distribution
         self.branch = None
         self.leaf = False
@@ -174,52 +196,64 @@ class KeyedTree:
             for child in self.children.domain():
                 new.addProb(child.desymbolize(table),self.children[child])
             tree.makeProbabilistic(new)
+        if not self._factory is None:
+            tree = self._factory.intern(tree)
         return tree
 
     def floor(self,key,lo):
         """
         Modify this tree to make sure the new computed value never goes lower than the given floor
+        @return: the modified tree, which is a new tree if this one is interned (and thus cannot be modified in place)
+        @rtype: L{KeyedTree}
         @warning: may introduce redundant checks
         """
+        if not self._factory is None:
+            tree = self.__class__()
+            tree.graft(self)
+            return self._factory.intern(tree.floor(key,lo))
         if self.isLeaf():
             tMatrix = self.children[None]
             assert len(tMatrix) == 1,'Unable to handle dynamics of more than one feature'
             assert tMatrix.has_key(key),'Are you sure you should be flooring me on a key I don\'t have?'
-            del self.children[None]
             fMatrix = setToConstantMatrix(key,lo)
             branch = KeyedPlane(KeyedVector(tMatrix[key]),lo)
             self.makeBranch(branch,KeyedTree(tMatrix),KeyedTree(fMatrix))
         elif self.branch:
-            self.children[True].floor(key,lo)
-            self.children[False].floor(key,lo)
+            self.makeBranch(self.branch,self.children[True].floor(key,lo),self.children[False].floor(key,lo))
         else:
-            for child in self.children.domain():
-                prob = self.children[child]
-                del self.children[child]
-                self[child.floor(key,lo)] = prob
+            new = TreeDistribution()
+            # Look up each probability before recursing, which modifies the child (and thus its hash)
+            for child,prob in [(child,self.children[child]) for child in self.children.domain()]:
+                new.addProb(child.floor(key,lo),prob)
+            self.makeProbabilistic(new)
         return self
 
     def ceil(self,key,hi):
         """
         Modify this tree to make sure the new computed value never goes higher than the given ceiling
+        @return: the modified tree, which is a new tree if this one is interned (and thus cannot be modified in place)
+        @rtype: L{KeyedTree}
         @warning: may introduce redundant checks
         """
+        if not self._factory is None:
+            tree = self.__class__()
+            tree.graft(self)
+            return self._factory.intern(tree.ceil(key,hi))
         if self.isLeaf():
             fMatrix = self.children[None]
             assert len(fMatrix) == 1,'Unable to handle dynamics of more than one feature'
             assert fMatrix.has_key(key),'Are you sure you should be ceiling me on a key I don\'t have?'
-            del self.children[None]
             tMatrix = setToConstantMatrix(key,hi)
             branch = KeyedPlane(KeyedVector(fMatrix[key]),hi)
             self.makeBranch(branch,KeyedTree(tMatrix),KeyedTree(fMatrix))
         elif self.branch:
-            self.children[True].ceil(key,hi)
-            self.children[False].ceil(key,hi)
+            self.makeBranch(self.branch,self.children[True].ceil(key,hi),self.children[False].ceil(key,hi))
         else:
-            for child in self.children.domain():
-                prob = self.children[child]
-                del self.children[child]
-                self[child.ceil(key,hi)] = prob
+            new = TreeDistribution()
+            # Look up each probability before recursing, which modifies the child (and thus its hash)
+            for child,prob in [(child,self.children[child]) for child in self.children.domain()]:
+                new.addProb(child.ceil(key,hi),prob)
+            self.makeProbabilistic(new)
         return self
 
     def scale(self,table):
@@ -237,7 +271,12 @@ class KeyedTree:
         return tree
 
     def __eq__(self,other):
-        if self.isLeaf():
+        if self is other:
+            return True
+        elif not self._factory is None and self._factory is getattr(other,'_factory',None):
+            # Distinct nodes from the same factory are structurally different
+            return False
+        elif self.isLeaf():
             if other.isLeaf():
                 return self.children[None] == other.children[None]
             else:
@@ -246,7 +285,7 @@ class KeyedTree:
             if isinstance(other.children,Distribution):
                 return self.children == other.children
             else:
-                return false
+                return False
         else:
             if self.branch == other.branch:
                 return self.children == other.children
@@ -255,38 +294,18 @@ class KeyedTree:
             
     def __add__(self,other):
         if isinstance(other,KeyedTree):
-            return self.compose(other,lambda x,y: x+y)
+            return self.compose(other,addLeaves)
         else:
             return self+KeyedTree(other)
             
     def __mul__(self,other):
         if isinstance(other,KeyedTree):
-            return self.compose(other,lambda x,y: x*y,lambda x,y: x*y)
+            return self.compose(other,multiplyLeaves,multiplyLeaves)
         else:
             return self*KeyedTree(other)
 
     def max(self,other):
-        return self.compose(other,self.__max)
-
-    def __max(self,leaf1,leaf2):
-        """
-        Helper method for computing max
-        @return: a tree returing the maximum of the two vectors
-        @rtype: L{KeyedTree}
-        """
-        result = self.__class__()
-        if leaf1 is False:
-            result.graft(leaf2)
-        elif leaf2 is False:
-            result.graft(leaf1)
-        else:
-            if isinstance(leaf1,dict):
-                weights = leaf1['vector'] - leaf2['vector']
-            else:
-                # Assume vectors
-                weights = leaf1 - leaf2
-            result.makeBranch(KeyedPlane(weights,0.),KeyedTree(leaf1),KeyedTree(leaf2))
-        return result
+        return self.compose(other,maxLeaves)
 
     def compose(self,other,leafOp=None,planeOp=None):
         """
@@ -296,7 +315,20 @@ class KeyedTree:
         @param leafOp: the binary operator to apply to leaves of each tree to generate a new leaf
         @param planeOp: the binary operator to apply to the plane
         @rtype: L{KeyedTree}
+        @note: if both trees are interned, the result is memoized in L{cache}
         """
+        if self._factory is None or other._factory is None:
+            return self._compose(other,leafOp,planeOp)
+        key = (id(self),id(other),leafOp,planeOp)
+        try:
+            return self.cache[key][-1]
+        except KeyError:
+            result = self._compose(other,leafOp,planeOp)
+            # Keep the operands alive so that their ids are not reused
+            self.cache[key] = (self,other,result)
+            return result
+
+    def _compose(self,other,leafOp,planeOp):
         result = KeyedTree()
         if other.isLeaf():
             if self.isLeaf():
@@ -352,6 +384,10 @@ class KeyedTree:
                 result.graft(trueTree)
             else:
                 result.makeBranch(other.branch,trueTree,falseTree)
+        if not self._factory is None:
+            result = self._factory.intern(result)
+        elif not other._factory is None:
+            result = other._factory.intern(result)
         return result
             
     def replace(self,old,new):
@@ -363,8 +399,17 @@ class KeyedTree:
     def expectation(self):
         """
         @return: a new tree representing an expectation over any probabilistic branches
+        @note: if this tree is interned, the result is memoized in L{cache}
         """
-        return self.map(distOp=lambda branch: branch.expectation())
+        if self._factory is None:
+            return self.map(distOp=lambda branch: branch.expectation())
+        key = (id(self),'expectation')
+        try:
+            return self.cache[key][-1]
+        except KeyError:
+            result = self.map(distOp=lambda branch: branch.expectation())
+            self.cache[key] = (self,result)
+            return result
 
     def map(self,leafOp=None,planeOp=None,distOp= None):
         """
@@ -404,6 +449,8 @@ class KeyedTree:
                 branch = self.branch
             result.makeBranch(branch,self.children[True].map(leafOp,planeOp,distOp),
                               self.children[False].map(leafOp,planeOp,distOp))
+        if not self._factory is None:
+            result = self._factory.intern(result)
         return result
 
     def graft(self,root):
@@ -424,10 +471,14 @@ class KeyedTree:
             # Leaf node (not a very smart use of graft, but who are we to judge)
             self.makeLeaf(root)
 
-    def prune(self,path=[]):
+    def prune(self,path=[],bounds=None):
         """
-        Removes redundant branches
-        @warning: correct, but not necessarily complete
+        Removes redundant branches, and merges branches whose subtrees are equal
+        @param path: the hyperplanes (and their values) tested on the way to this node
+        @type path: (L{KeyedPlane},bool)[]
+        @param bounds: if provided, the lower and upper bounds on each variable, so that any branch whose linear conditions no state within these bounds can satisfy is also removed (default is C{None})
+        @type bounds: strS{->}(float,float)
+        @warning: correct, but not necessarily complete (equality conditions on lists of values and the C{False} side of equality conditions are not checked for feasibility)
         """
         result = self.__class__()
         if self.isLeaf():
@@ -438,7 +489,7 @@ class KeyedTree:
             distribution = self.children.__class__() 
             for tree in self.children.domain():
                 prob = self.children[tree]
-                tree.prune(path)
+                tree = tree.prune(path,bounds)
                 try:
                     distribution[tree] += prob
                 except KeyError:
@@ -452,28 +503,106 @@ class KeyedTree:
             for branch,value in path:
                 conflict = self.branch.compare(branch,value)
                 if not conflict is None:
-                    result.graft(self.children[conflict].prune(path))
+                    result.graft(self.children[conflict].prune(path,bounds))
                     break
             else:
                 # No matches
-                result.makeBranch(self.branch,self.children[True].prune(path+[(self.branch,True)]),
-                                  self.children[False].prune(path+[(self.branch,False)]))
+                if bounds is None:
+                    reachable = [True,False]
+                else:
+                    reachable = [value for value in [True,False]
+                                 if self.isFeasible(path+[(self.branch,value)],bounds)]
+                if len(reachable) == 1:
+                    value = reachable[0]
+                    result.graft(self.children[value].prune(path+[(self.branch,value)],bounds))
+                else:
+                    trueTree = self.children[True].prune(path+[(self.branch,True)],bounds)
+                    falseTree = self.children[False].prune(path+[(self.branch,False)],bounds)
+                    if trueTree == falseTree:
+                        result.graft(trueTree)
+                    else:
+                        result.makeBranch(self.branch,trueTree,falseTree)
+        if not self._factory is None:
+            result = self._factory.intern(result)
         return result
 
+    def isFeasible(self,path,bounds):
+        """
+        @param path: the hyperplanes (and their values) along a path through a tree
+        @type path: (L{KeyedPlane},bool)[]
+        @param bounds: the lower and upper bounds on each variable
+        @type bounds: strS{->}(float,float)
+        @return: C{False} only if no state within the bounds can follow the given path
+        @rtype: bool
+        """
+        constraints = []
+        for plane,value in path:
+            constraint = plane.region(value)
+            if not constraint is None:
+                constraints.append(constraint)
+        return feasible(constraints,bounds)
+
     def minimizePlanes(self):
         """
         Modifies tree in place so that there are no constant factors in branch weights
+        @return: the modified tree, which is a new tree if this one is interned (and thus cannot be modified in place)
+        @rtype: L{KeyedTree}
         """
+        if not self._factory is None:
+            tree = self.__class__()
+            tree.graft(self)
+            return self._factory.intern(tree.minimizePlanes())
         if self.isProbabilistic():
-            for child in self.children.domain():
-                child.minimizePlanes()
+            new = TreeDistribution()
+            # Look up each probability before recursing, which modifies the child (and thus its hash)
+            for child,prob in [(child,self.children[child]) for child in self.children.domain()]:
+                new.addProb(child.minimizePlanes(),prob)
+            self.makeProbabilistic(new)
         elif not self.isLeaf():
-            self.branch = self.branch.minimize()
-            self.children[True].minimizePlanes()
-            self.children[False].minimizePlanes()
-            
+            self.makeBranch(self.branch.minimize(),self.children[True].minimizePlanes(),
+                            self.children[False].minimizePlanes())
+        return self
+
+    def __copy__(self):
+        if not self._factory is None:
+            # Interned trees are immutable, so they can be shared
+            return self
+        result = self.__class__()
+        result.graft(self)
+        return result
+
+    def __deepcopy__(self,memo):
+        if not self._factory is None:
+            return self
+        result = self.__class__()
+        if self.isLeaf():
+            result.makeLeaf(copy.deepcopy(self.children[None],memo))
+        elif self.isProbabilistic():
+            result.makeProbabilistic(copy.deepcopy(self.children,memo))
+        else:
+            result.makeBranch(self.branch,copy.deepcopy(self.children[True],memo),
+                              copy.deepcopy(self.children[False],memo))
+        return result
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['_factory'] = None
+        return state
+
     def __hash__(self):
-        return hash(str(self))
+        if self._hash is None:
+            if self.isLeaf():
+                leaf = self.children[None]
+                try:
+                    self._hash = hash(leaf)
+                except TypeError:
+                    # Unhashable leaf
+                    self._hash = hash(str(leaf))
+            elif self.isProbabilistic():
+                self._hash = hash(frozenset([(child,self.children[child]) for child in self.children.domain()]))
+            else:
+                self._hash = hash((self.branch,self.children[True],self.children[False]))
+        return self._hash
 
     def __str__(self):
         if self._string is None:
@@ -556,10 +685,363 @@ class KeyedTree:
         else:
             self.makeLeaf(children[None])
 
+    def compile(self,index=None):
+        """
+        @param index: the assignment of keys to slots (default is the index shared by all L{DenseVector} instances)
+        @type index: L{VectorIndex}
+        @return: an array-based version of this tree that can evaluate many vectors at once
+        @rtype: L{CompiledTree}
+        @warning: the compiled tree does not reflect any subsequent changes to this one
+        """
+        return CompiledTree(self,index)
+
+def addLeaves(leaf1,leaf2):
+    return leaf1+leaf2
+
+def multiplyLeaves(leaf1,leaf2):
+    return leaf1*leaf2
+
+def orLeaves(leaf1,leaf2):
+    return leaf1 or leaf2
+
+def maxLeaves(leaf1,leaf2):
+    """
+    Helper function for computing max
+    @return: a tree returing the maximum of the two vectors
+    @rtype: L{KeyedTree}
+    """
+    result = KeyedTree()
+    if leaf1 is False:
+        result.graft(leaf2)
+    elif leaf2 is False:
+        result.graft(leaf1)
+    else:
+        if isinstance(leaf1,dict):
+            weights = leaf1['vector'] - leaf2['vector']
+        else:
+            # Assume vectors
+            weights = leaf1 - leaf2
+        result.makeBranch(KeyedPlane(weights,0.),KeyedTree(leaf1),KeyedTree(leaf2))
+    return result
+
+class TreeFactory:
+    """
+    Hash-consing constructor of L{KeyedTree} nodes, so that structurally identical leaves, hyperplanes, and subtrees are only ever stored once. Two trees interned by the same factory are equal if and only if they are the same object.
+    @ivar nodes: the interned subtrees
+    @type nodes: weakref.WeakValueDictionary
+    @ivar planes: the interned hyperplanes
+    @type planes: weakref.WeakValueDictionary
+    @warning: interned trees are shared, so they cannot be modified in place
+    """
+    def __init__(self):
+        self.nodes = weakref.WeakValueDictionary()
+        self.planes = weakref.WeakValueDictionary()
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def intern(self,tree):
+        """
+        @return: the interned version of the given tree, which may be the given tree itself
+        @rtype: L{KeyedTree}
+        """
+        if tree._factory is self:
+            return tree
+        elif tree.isLeaf():
+            return self.leaf(tree.children[None])
+        elif tree.isProbabilistic():
+            return self.distribution(tree.children)
+        else:
+            return self.branch(tree.branch,tree.children[True],tree.children[False])
+
+    def leaf(self,value):
+        """
+        @return: the interned leaf node for the given value
+        @rtype: L{KeyedTree}
+        """
+        key = ('leaf',value.__class__,value)
+        try:
+            return self.nodes[key]
+        except TypeError:
+            # Unhashable leaf
+            key = ('leaf',value.__class__,str(value))
+        except KeyError:
+            pass
+        try:
+            return self.nodes[key]
+        except KeyError:
+            return self._add(key,KeyedTree(value))
+
+    def plane(self,plane):
+        """
+        @return: the interned copy of the given hyperplane
+        @rtype: L{KeyedPlane}
+        """
+        vector = plane.vector
+        weights = frozenset([(key,vector.roundValue(value)) for key,value in vector.items()])
+        if isinstance(plane.threshold,list):
+            threshold = tuple([plane.roundThreshold(t) for t in plane.threshold])
+        else:
+            threshold = plane.roundThreshold(plane.threshold)
+        key = (weights,threshold,plane.comparison)
+        try:
+            return self.planes[key]
+        except KeyError:
+            self.planes[key] = plane
+            return plane
+
+    def branch(self,plane,trueTree,falseTree):
+        """
+        @return: the interned node branching on the given hyperplane (or just the interned child, if both children are the same)
+        @rtype: L{KeyedTree}
+        """
+        trueTree = self.intern(trueTree)
+        falseTree = self.intern(falseTree)
+        if trueTree is falseTree:
+            return trueTree
+        plane = self.plane(plane)
+        key = ('branch',id(plane),id(trueTree),id(falseTree))
+        try:
+            return self.nodes[key]
+        except KeyError:
+            tree = KeyedTree()
+            tree.makeBranch(plane,trueTree,falseTree)
+            return self._add(key,tree)
+
+    def distribution(self,distribution):
+        """
+        @return: the interned node with a probabilistic branch over the given distribution of trees (or just the interned child, if there is only one)
+        @rtype: L{KeyedTree}
+        """
+        children = TreeDistribution()
+        for child in distribution.domain():
+            children.addProb(self.intern(child),distribution[child])
+        if len(children) == 1:
+            return children.domain()[0]
+        key = ('distribution',frozenset([(id(child),children[child]) for child in children.domain()]))
+        try:
+            return self.nodes[key]
+        except KeyError:
+            tree = KeyedTree()
+            tree.makeProbabilistic(children)
+            return self._add(key,tree)
+
+    def _add(self,key,tree):
+        # Children are already interned, so this hash is computed from their cached ones
+        hash(tree)
+        tree._factory = self
+        self.nodes[key] = tree
+        return tree
+
+treeFactory = TreeFactory()
+
+class CompiledTree:
+    """
+    A L{KeyedTree} flattened into arrays, so that a whole batch of possible worlds can be routed to their leaves in one pass
+    @ivar index: the assignment of keys to the columns of the plane weights
+    @type index: L{VectorIndex}
+    @ivar kind: the type of each node (L{LEAF}, L{BRANCH}, or L{PROBABILISTIC})
+    @type kind: numpy.ndarray
+    @ivar target: for each node, its position in the leaf table, plane arrays, or distribution arrays, according to its kind
+    @type target: numpy.ndarray
+    @ivar weights: the weights of each hyperplane, one row per plane and one column per slot
+    @type weights: numpy.ndarray
+    @ivar thresholds: the threshold(s) of each hyperplane, padded with NaN when a list of thresholds is being tested
+    @type thresholds: numpy.ndarray
+    @ivar comparison: the comparison code of each hyperplane
+    @type comparison: numpy.ndarray
+    @ivar branches: the node reached when each hyperplane is false (column 0) or true (column 1)
+    @type branches: numpy.ndarray
+    @ivar outcomes: the nodes reachable from each probabilistic branch (padded with 0)
+    @type outcomes: numpy.ndarray
+    @ivar probabilities: the probability of each outcome of each probabilistic branch (padded with 0)
+    @type probabilities: numpy.ndarray
+    @ivar fanout: the number of outcomes of each probabilistic branch
+    @type fanout: numpy.ndarray
+    @ivar leaves: the leaf table
+    @type leaves: list
+    """
+    LEAF = 0
+    BRANCH = 1
+    PROBABILISTIC = 2
+
+    def __init__(self,tree,index=None):
+        if numpy is None:
+            raise ImportError,'NumPy is required for %s' % (self.__class__.__name__)
+        if index is None:
+            index = DenseVector.index
+        self.index = index
+        self.leaves = []
+        self._nodes = []
+        self._planes = []
+        self._distributions = []
+        self._add(tree)
+        self.kind = numpy.array([node[0] for node in self._nodes],numpy.int8)
+        self.target = numpy.array([node[1] for node in self._nodes],numpy.intp)
+        width = len(index)
+        count = len(self._planes)
+        self.weights = numpy.zeros((count,width))
+        size = max([len(plane[1]) for plane in self._planes]+[1])
+        self.thresholds = numpy.empty((count,size))
+        self.thresholds.fill(numpy.nan)
+        self.comparison = numpy.zeros(count,numpy.int8)
+        self.branches = numpy.zeros((count,2),numpy.intp)
+        for position,(vector,thresholds,comparison,falseNode,trueNode) in enumerate(self._planes):
+            for key,value in vector.items():
+                self.weights[position,index.slots[key]] = value
+            self.thresholds[position,:len(thresholds)] = thresholds
+            self.comparison[position] = comparison
+            self.branches[position] = (falseNode,trueNode)
+        count = len(self._distributions)
+        size = max([len(dist) for dist in self._distributions]+[1])
+        self.outcomes = numpy.zeros((count,size),numpy.intp)
+        self.probabilities = numpy.zeros((count,size))
+        self.fanout = numpy.zeros(count,numpy.intp)
+        for position,dist in enumerate(self._distributions):
+            self.fanout[position] = len(dist)
+            for outcome,(node,prob) in enumerate(dist):
+                self.outcomes[position,outcome] = node
+                self.probabilities[position,outcome] = prob
+        del self._nodes
+        del self._planes
+        del self._distributions
+
+    def _add(self,tree):
+        """
+        Flattens the given subtree into my node lists
+        @return: the node assigned to the root of the subtree
+        @rtype: int
+        """
+        node = len(self._nodes)
+        if tree.isLeaf():
+            self._nodes.append((self.LEAF,len(self.leaves)))
+            self.leaves.append(tree.children[None])
+        elif tree.isProbabilistic():
+            self._nodes.append((self.PROBABILISTIC,len(self._distributions)))
+            dist = []
+            self._distributions.append(dist)
+            for child in tree.children.domain():
+                dist.append((self._add(child),tree.children[child]))
+        else:
+            plane = tree.branch
+            if isinstance(plane.threshold,list):
+                thresholds = plane.threshold
+                assert plane.comparison == 0,'List thresholds only supported for equality tests'
+            else:
+                thresholds = [plane.threshold]
+            for threshold in thresholds:
+                if isinstance(threshold,str):
+                    raise ValueError,'Unable to compile symbolic threshold %s. Desymbolize the tree first.' % (threshold)
+            if not plane.comparison in [-1,0,1]:
+                raise ValueError,'Unknown comparison for %s: %s' % (plane.__class__.__name__,plane.comparison)
+            for key in plane.vector.keys():
+                self.index.add(key)
+            entry = [plane.vector,thresholds,plane.comparison,None,None]
+            self._nodes.append((self.BRANCH,len(self._planes)))
+            self._planes.append(entry)
+            entry[4] = self._add(tree.children[True])
+            entry[3] = self._add(tree.children[False])
+        return node
+
+    def align(self,states):
+        """
+        @param states: the possible worlds, either as a matrix with one row per world and one column per slot in my index, or as a list of vectors
+        @return: a matrix with one row per possible world and one column per hyperplane weight
+        @rtype: numpy.ndarray
+        """
+        if not isinstance(states,numpy.ndarray):
+            vectors = []
+            for vector in states:
+                if not isinstance(vector,DenseVector) or not vector.index is self.index:
+                    vector = DenseVector(vector,self.index)
+                vector.fit()
+                vectors.append(vector.array)
+            states = numpy.array(vectors,ndmin=2)
+        width = self.weights.shape[1]
+        if states.shape[1] < width:
+            states = numpy.hstack((states,numpy.zeros((len(states),width-states.shape[1]))))
+        return states[:,:width]
+
+    def route(self,states):
+        """
+        Sends each possible world down the tree, splitting it at any probabilistic branches
+        @param states: the possible worlds (see L{align})
+        @return: arrays of the same length, indicating the row of the possible world, the position in the leaf table that it reached, the probability of reaching it, and whether a probabilistic branch was taken along the way
+        @rtype: (numpy.ndarray,numpy.ndarray,numpy.ndarray,numpy.ndarray)
+        """
+        states = self.align(states)
+        rows = numpy.arange(len(states))
+        nodes = numpy.zeros(len(states),numpy.intp)
+        prob = numpy.ones(len(states))
+        stochastic = numpy.zeros(len(states),bool)
+        epsilon = KeyedVector.epsilon
+        while True:
+            kind = self.kind[nodes]
+            branch = kind == self.BRANCH
+            dist = kind == self.PROBABILISTIC
+            if not branch.any() and not dist.any():
+                break
+            if branch.any():
+                planes = self.target[nodes[branch]]
+                total = numpy.einsum('ij,ij->i',self.weights[planes],states[rows[branch]])
+                thresholds = self.thresholds[planes]
+                comparison = self.comparison[planes]
+                test = numpy.where(comparison > 0,total+epsilon > thresholds[:,0],
+                                   total-epsilon < thresholds[:,0])
+                equal = comparison == 0
+                if equal.any():
+                    # Equality test against any of the thresholds (NaN padding never matches)
+                    difference = numpy.abs(total[equal,None]-thresholds[equal])
+                    test[equal] = (difference < epsilon).any(axis=1)
+                nodes[branch] = self.branches[planes,test.astype(numpy.intp)]
+            if dist.any():
+                # Replicate each world once for each outcome of its probabilistic branch
+                counts = numpy.ones(len(nodes),numpy.intp)
+                counts[dist] = self.fanout[self.target[nodes[dist]]]
+                source = numpy.repeat(numpy.arange(len(nodes)),counts)
+                offset = numpy.arange(len(source))-numpy.repeat(numpy.cumsum(counts)-counts,counts)
+                expanded = dist[source]
+                rows = rows[source]
+                nodes = nodes[source]
+                prob = prob[source]
+                stochastic = stochastic[source]
+                outcomes = self.target[nodes[expanded]]
+                prob[expanded] *= self.probabilities[outcomes,offset[expanded]]
+                nodes[expanded] = self.outcomes[outcomes,offset[expanded]]
+                stochastic[expanded] = True
+        return rows,self.target[nodes],prob,stochastic
+
+    def evaluate(self,states):
+        """
+        @param states: the possible worlds (see L{align})
+        @return: for each possible world, the leaf it reaches, or a L{Distribution} over leaves if there is a probabilistic branch along the way (i.e., the same result as indexing the original tree with each world)
+        @rtype: list
+        """
+        states = self.align(states)
+        rows,leaves,prob,stochastic = self.route(states)
+        if not stochastic.any():
+            return [self.leaves[leaf] for leaf in leaves]
+        result = [None for row in xrange(len(states))]
+        for particle in xrange(len(rows)):
+            row = rows[particle]
+            leaf = self.leaves[leaves[particle]]
+            if stochastic[particle]:
+                if result[row] is None:
+                    result[row] = Distribution()
+                result[row].addProb(leaf,prob.item(particle))
+            else:
+                result[row] = leaf
+        return result
+
+    def __getitem__(self,vector):
+        return self.evaluate([vector])[0]
+
 class TreeDistribution(Distribution):
     """
     A class representing a L{Distribution} over L{KeyedTree} instances
     """
+    hashed = True
+
     def element2xml(self,value):
         return value.__xml__().documentElement
 
@@ -1,38 +1,52 @@
 from xml.dom.minidom import Document,Node
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
-from psychsim.probability import Distribution
+from psychsim.probability import Distribution,makeGenerator
 
 class KeyedVector(dict):
     """
     Class for a compact, string-indexable vector
-    @cvar epsilon: the margin used for equality of vectors (as well as for testing hyperplanes in L{KeyedPlane})
+    @cvar epsilon: the margin used for testing hyperplanes in L{KeyedPlane}
     @type epsilon: float
+    @cvar digits: the number of decimal places that values are rounded to when hashing and testing equality
+    @type digits: int
     @ivar _string: the C{str} representation of this vector
     @type _string: bool
     """
     epsilon = 1e-8
+    digits = 8
 
     def __init__(self,arg={}):
         if isinstance(arg,Node):
             dict.__init__(self)
             self.parse(arg)
+        elif isinstance(arg,DenseVector):
+            # Dense values do not live in the underlying dict
+            dict.__init__(self,arg.items())
         else:
             dict.__init__(self,arg)
         self._string = None
+        self._hash = None
+        self._gather = None
 
     def __eq__(self,other):
-        delta = 0.
+        # Same quantization as __hash__, so that equal vectors always hash alike
         tested = {}
         for key,value in self.items():
             try:
-                delta += abs(value-other[key])
+                if self.roundValue(value) != self.roundValue(other[key]):
+                    return False
             except KeyError:
-                delta += abs(value)
+                if self.roundValue(value) != 0:
+                    return False
             tested[key] = True
         for key,value in other.items():
-            if not tested.has_key(key):
-                delta += abs(value)
-        return delta < self.epsilon
+            if not tested.has_key(key) and self.roundValue(value) != 0:
+                return False
+        return True
 
     def __ne__(self,other):
         return not self == other
@@ -74,18 +88,30 @@ class KeyedVector(dict):
 
     def __setitem__(self,key,value):
         self._string = None
+        self._hash = None
+        self._gather = None
         dict.__setitem__(self,key,value)
 
     def __delitem__(self,key):
         self._string = None
+        self._hash = None
+        self._gather = None
         dict.__delitem__(self,key)
 
+    def update(self,other):
+        self._string = None
+        self._hash = None
+        self._gather = None
+        if isinstance(other,DenseVector):
+            other = other.items()
+        dict.update(self,other)
+
     def desymbolize(self,table,debug=False):
         result = self.__class__()
         for key,value in self.items():
             if isinstance(value,str):
                 try:
-                    result[key] = eval(value,globals(),table)
+                    result[key] = evaluateExpression(value,table)
                 except NameError:
                     # Undefined reference: assume it'll get sorted out later
                     result[key] = value
@@ -141,8 +167,30 @@ class KeyedVector(dict):
     def __repr__(self):
         return '%s(%r)' % (self.__class__.__name__,dict(self))
 
+    def roundValue(self,value):
+        """
+        @return: the given value rounded to the precision used for hashing
+        """
+        if isinstance(value,float):
+            return round(value,self.digits)
+        else:
+            return value
+
     def __hash__(self):
-        return hash(str(self))
+        if self._hash is None:
+            # Missing entries are equal to 0, so leave out any entries that round to 0
+            items = [(key,self.roundValue(value)) for key,value in self.items()]
+            self._hash = hash(frozenset([item for item in items if item[1] != 0]))
+        return self._hash
+
+    def __copy__(self):
+        return self.__class__(self)
+
+    def __deepcopy__(self,memo):
+        return self.__class__(self)
+
+    def __reduce__(self):
+        return (self.__class__,(dict(self),))
 
     def __xml__(self):
         doc = Document()
@@ -150,13 +198,19 @@ class KeyedVector(dict):
         for key,value in self.items():
             node = doc.createElement('entry')
             node.setAttribute('key',key)
-            node.setAttribute('value',str(value))
+            if isinstance(value,float):
+                # repr recovers the exact value on parsing
+                node.setAttribute('value',repr(value))
+            else:
+                node.setAttribute('value',str(value))
             root.appendChild(node)
         doc.appendChild(root)
         return doc
 
     def parse(self,element):
         self._string = None
+        self._hash = None
+        self._gather = None
         node = element.firstChild
         while node:
             if node.nodeType == node.ELEMENT_NODE:
@@ -169,10 +223,357 @@ class KeyedVector(dict):
                 dict.__setitem__(self,key,value)
             node = node.nextSibling
 
+expressions = {}
+
+def evaluateExpression(expression,table):
+    """
+    Evaluates a symbolic expression, compiling it only the first time it is seen
+    @param expression: the Python expression
+    @type expression: str
+    @param table: the values of any names used in the expression
+    @type table: dict
+    @return: the value of the expression
+    @raise NameError: if the expression uses a name not in the given table
+    """
+    try:
+        # Shortcut for an expression that is just a name
+        return table[expression]
+    except KeyError:
+        pass
+    except TypeError:
+        # Unhashable table keys are no concern of ours
+        pass
+    try:
+        code = expressions[expression]
+    except KeyError:
+        code = compile(expression,'<expression>','eval')
+        expressions[expression] = code
+    return eval(code,globals(),table)
+
+class VectorIndex:
+    """
+    Assignment of keys to fixed integer slots, shared by all of the L{DenseVector} instances built on top of it. Slots are only ever appended, so a slot never changes once assigned.
+    @ivar keys: the key assigned to each slot
+    @type keys: str[]
+    @ivar slots: the slot assigned to each key
+    @type slots: strS{->}int
+    """
+    def __init__(self,keys=[]):
+        self.keys = []
+        self.slots = {}
+        for key in keys:
+            self.add(key)
+
+    def add(self,key):
+        """
+        @return: the slot for the given key, assigning a new one if necessary
+        @rtype: int
+        """
+        try:
+            return self.slots[key]
+        except KeyError:
+            slot = len(self.keys)
+            self.slots[key] = slot
+            self.keys.append(key)
+            return slot
+
+    def has_key(self,key):
+        return self.slots.has_key(key)
+
+    def __contains__(self,key):
+        return key in self.slots
+
+    def __len__(self):
+        return len(self.keys)
+
+    def gather(self,vector):
+        """
+        @param vector: a (typically sparse) vector of weights
+        @type vector: L{KeyedVector}
+        @return: the slots of the keys in the given vector, and the corresponding weights
+        @rtype: (int[],float[])
+        """
+        cache = vector._gather
+        if cache is None or not cache[0] is self:
+            slots = numpy.fromiter([self.add(key) for key in vector.keys()],numpy.intp)
+            weights = numpy.fromiter(vector.values(),numpy.float64)
+            cache = (self,slots,weights)
+            vector._gather = cache
+        return cache[1],cache[2]
+
+class DenseVector(KeyedVector):
+    """
+    A L{KeyedVector} that stores its values in a contiguous float64 array, with one slot per key in a L{VectorIndex}
+    @cvar index: the default index shared by all dense vectors, unless otherwise specified
+    @type index: L{VectorIndex}
+    @ivar index: the index assigning keys to slots in this vector
+    @ivar array: the values of this vector (0 in any slots without a value)
+    @type array: numpy.ndarray
+    @ivar mask: flags indicating which slots have a value
+    @type mask: numpy.ndarray
+    @warning: values must be numeric, so symbolic values must be desymbolized before being stored
+    """
+    index = VectorIndex()
+
+    def __init__(self,arg={},index=None):
+        if numpy is None:
+            raise ImportError,'NumPy is required for %s' % (self.__class__.__name__)
+        dict.__init__(self)
+        self._string = None
+        self._hash = None
+        self._gather = None
+        if index is None:
+            if isinstance(arg,DenseVector):
+                index = arg.index
+            else:
+                index = self.__class__.index
+        self.index = index
+        if isinstance(arg,DenseVector) and arg.index is index:
+            self.array = arg.array.copy()
+            self.mask = arg.mask.copy()
+        else:
+            self.array = numpy.zeros(len(index))
+            self.mask = numpy.zeros(len(index),bool)
+            if isinstance(arg,Node):
+                self.parse(arg)
+            else:
+                self.update(arg)
+
+    def fit(self):
+        """
+        Extends my storage to cover any slots added to my index since I was created
+        """
+        size = len(self.index)
+        if len(self.array) < size:
+            self.array = numpy.concatenate((self.array,numpy.zeros(size-len(self.array))))
+            self.mask = numpy.concatenate((self.mask,numpy.zeros(size-len(self.mask),bool)))
+
+    def slot(self,key):
+        """
+        @return: the slot holding the given key's value, or C{None} if I have no value for it
+        @rtype: int
+        """
+        slot = self.index.slots.get(key)
+        if slot is None or slot >= len(self.mask) or not self.mask[slot]:
+            return None
+        else:
+            return slot
+
+    def __getitem__(self,key):
+        slot = self.slot(key)
+        if slot is None:
+            raise KeyError,key
+        return self.array.item(slot)
+
+    def __setitem__(self,key,value):
+        if isinstance(value,str):
+            raise TypeError,'%s is unable to store symbolic value %s for %s' % \
+                (self.__class__.__name__,value,key)
+        slot = self.index.add(key)
+        if slot >= len(self.array):
+            self.fit()
+        self.array[slot] = value
+        self.mask[slot] = True
+        self._string = None
+        self._hash = None
+
+    def __delitem__(self,key):
+        slot = self.slot(key)
+        if slot is None:
+            raise KeyError,key
+        self.array[slot] = 0.
+        self.mask[slot] = False
+        self._string = None
+        self._hash = None
+
+    def has_key(self,key):
+        return not self.slot(key) is None
+
+    def __contains__(self,key):
+        return not self.slot(key) is None
+
+    def get(self,key,default=None):
+        slot = self.slot(key)
+        if slot is None:
+            return default
+        else:
+            return self.array.item(slot)
+
+    def __len__(self):
+        return int(self.mask.sum())
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        return [self.index.keys[slot] for slot in numpy.flatnonzero(self.mask)]
+
+    def values(self):
+        return self.array[self.mask].tolist()
+
+    def items(self):
+        keys = self.index.keys
+        return [(keys[slot],self.array.item(slot)) for slot in numpy.flatnonzero(self.mask)]
+
+    def iterkeys(self):
+        return iter(self.keys())
+
+    def itervalues(self):
+        return iter(self.values())
+
+    def iteritems(self):
+        return iter(self.items())
+
+    def update(self,other):
+        if isinstance(other,DenseVector) and other.index is self.index:
+            other.fit()
+            self.fit()
+            self.array[other.mask] = other.array[other.mask]
+            self.mask |= other.mask
+            self._string = None
+            self._hash = None
+        else:
+            if isinstance(other,dict):
+                other = other.items()
+            for key,value in other:
+                self[key] = value
+
+    def clear(self):
+        self.array[:] = 0.
+        self.mask[:] = False
+        self._string = None
+        self._hash = None
+
+    def copy(self):
+        return self.__class__(self)
+
+    def __copy__(self):
+        return self.__class__(self)
+
+    def __deepcopy__(self,memo):
+        return self.__class__(self)
+
+    def align(self,other):
+        """
+        @return: my values and the values of the given vector (sharing my index) as arrays of the same length
+        """
+        self.fit()
+        other.fit()
+        return self.array,other.array
+
+    def dot(self,vector):
+        """
+        @param vector: a sparse vector of weights
+        @type vector: L{KeyedVector}
+        @return: the dot product of the given vector with me, or C{None} if I have no value for any of its keys
+        @rtype: float
+        """
+        slots,weights = self.index.gather(vector)
+        if len(slots) and slots.max() >= len(self.array):
+            self.fit()
+        if self.mask[slots].any():
+            return float(numpy.dot(weights,self.array[slots]))
+        else:
+            return None
+
+    def __eq__(self,other):
+        if isinstance(other,DenseVector) and other.index is self.index:
+            mine,yours = self.align(other)
+            delta = numpy.abs(mine-yours)
+            if not delta.any():
+                return True
+            elif delta.max() > 10.**(-self.digits):
+                # Too far apart to round to the same value
+                return False
+        return KeyedVector.__eq__(self,other)
+
+    def __ne__(self,other):
+        return not self == other
+
+    def __add__(self,other):
+        if isinstance(other,DenseVector) and other.index is self.index:
+            mine,yours = self.align(other)
+            result = self.__class__(index=self.index)
+            result.array = mine+yours
+            result.mask = self.mask | other.mask
+            return result
+        else:
+            result = self.__class__(self)
+            for key,value in other.items():
+                result[key] = result.get(key,0.) + value
+            return result
+
+    def __neg__(self):
+        result = self.__class__(self)
+        result.array = -self.array
+        return result
+
+    def __mul__(self,other):
+        if isinstance(other,DenseVector) and other.index is self.index:
+            # Dot product
+            mine,yours = self.align(other)
+            return float(numpy.dot(mine,yours))
+        elif isinstance(other,KeyedVector):
+            # Dot product
+            total = self.dot(other)
+            if total is None:
+                return 0.
+            else:
+                return total
+        elif isinstance(other,float):
+            # Scaling
+            result = self.__class__(self)
+            result.array = self.array*other
+            return result
+        else:
+            return NotImplemented
+
+    __rmul__ = __mul__
+
+    def desymbolize(self,table,debug=False):
+        # Values are always numeric
+        return self.__class__(self)
+
+    def filter(self,ignore):
+        if isinstance(ignore,list):
+            test = lambda k: not k in ignore
+        else:
+            test = ignore
+        result = self.__class__(self)
+        for key in self.keys():
+            if not test(key):
+                del result[key]
+        return result
+
+    def distance(self,vector):
+        if isinstance(vector,DenseVector) and vector.index is self.index:
+            mine,yours = self.align(vector)
+            return float(numpy.square(mine-yours)[self.mask].sum())
+        else:
+            return KeyedVector.distance(self,vector)
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__,dict(self.items()))
+
+    def __reduce__(self):
+        return (self.__class__,(dict(self.items()),self.index))
+
+    def parse(self,element):
+        self._string = None
+        self._hash = None
+        node = element.firstChild
+        while node:
+            if node.nodeType == node.ELEMENT_NODE:
+                assert node.tagName == 'entry'
+                key = str(node.getAttribute('key'))
+                self[key] = float(node.getAttribute('value'))
+            node = node.nextSibling
+
 class VectorDistribution(Distribution):
     """
     A class representing a L{Distribution} over L{KeyedVector} instances
     """
+    hashed = True
 
     def join(self,key,value):
         """
@@ -181,19 +582,19 @@ class VectorDistribution(Distribution):
         @type key: str
         @param value: either a single value to apply to all vectors, or else a L{Distribution} over possible values
         """
-        original = dict(self)
-        domain = self.domain()
+        worlds = [(row,self[row]) for row in self.domain()]
         self.clear()
-        for row in domain:
-            prob = original[str(row)]
+        for row,prob in worlds:
             if isinstance(value,Distribution):
                 for element in value.domain():
                     new = row.__class__(row)
                     new[key] = element
                     self.addProb(new,prob*value[element])
             else:
-                row[key] = value
-                self[row] = prob
+                # Leave the original vector untouched, as copies may share it
+                new = row.__class__(row)
+                new[key] = value
+                self.addProb(new,prob)
 
     def merge(self,other):
         """
@@ -225,10 +626,13 @@ class VectorDistribution(Distribution):
                 result[row[key]] = self[row]
         return Distribution(result)
 
-    def select(self,incremental=False):
+    def select(self,incremental=False,generator=None):
         """
         @param incremental: if C{True}, then select each key value in series (rather than picking out a joint vector all at once, default is C{False})
+        @param generator: the random number generator to draw from, or a seed for a new one (default is the C{random} module)
+        @type generator: C{random.Random} or int
         """
+        generator = makeGenerator(generator)
         if incremental:
             # Sample each key and keep track how likely each individual choice was
             sample = KeyedVector()
@@ -239,7 +643,7 @@ class VectorDistribution(Distribution):
                 dist = self.marginal(key)
                 if len(dist) > 1:
                     # Have to make a choice here
-                    element,sample[key] = dist.sample(True)
+                    element,sample[key] = dist.sample(True,generator)
                     # Figure out where the "spinner" ended up across entire pie chart
                     for other in dist.domain():
                         if other == element:
@@ -253,7 +657,7 @@ class VectorDistribution(Distribution):
                 index += 1
             return sample
         else:
-            Distribution.select(self)
+            Distribution.select(self,generator)
             
     def hasColumn(self,key):
         """
@@ -265,13 +669,342 @@ class VectorDistribution(Distribution):
                 return False
         return True
 
-    def __deepcopy__(self,memo):
-        result = self.__class__()
-        for vector in self.domain():
+class DenseDistribution(VectorDistribution):
+    """
+    A L{VectorDistribution} stored column-wise: an NxK matrix of values (one row per possible world, one column per slot in a L{VectorIndex}) plus an N-length array of probabilities. Possible worlds are handed out as L{DenseVector} copies of the rows, so modifying an element of the domain does not modify the distribution.
+    @ivar index: the assignment of keys to columns
+    @type index: L{VectorIndex}
+    @warning: values must be numeric, so symbolic values must be desymbolized before being stored
+    """
+    def __init__(self,args=None,rationality=None,index=None):
+        if numpy is None:
+            raise ImportError,'NumPy is required for %s' % (self.__class__.__name__)
+        if index is None:
+            if isinstance(args,DenseDistribution):
+                index = args.index
+            else:
+                index = DenseVector.index
+        self.index = index
+        self._store(numpy.zeros((0,len(index))),numpy.zeros((0,len(index)),bool),
+                    numpy.zeros(0))
+        Distribution.__init__(self,args,rationality)
+
+    def _store(self,values,mask,prob):
+        """
+        Replaces my contents with the given arrays, merging any duplicate rows
+        """
+        self._values = values
+        self._mask = mask
+        self._prob = prob
+        self._size = len(prob)
+        self._elements = None
+        self._cumulative = None
+        self._rows = {}
+        for row in xrange(self._size):
+            key = self._key(values[row],mask[row])
             try:
-                new = memo[id(vector)]
+                duplicate = self._rows[key]
             except KeyError:
-                new = KeyedVector(vector)
-                memo[id(vector)] = new
-            result[new] = self[vector]
+                self._rows[key] = row
+                continue
+            # Collapse duplicate worlds, summing their probability
+            unique = numpy.unique(numpy.hstack((values,mask)),axis=0,return_inverse=True)[1]
+            total = numpy.bincount(unique,weights=prob)
+            first = numpy.zeros(len(total),numpy.intp)
+            first[unique[::-1]] = numpy.arange(len(unique))[::-1]
+            self._store(values[first],mask[first],total)
+            break
+
+    def _key(self,values,mask):
+        return values.tostring()+mask.tostring()
+
+    def fit(self):
+        """
+        Extends my columns to cover any slots added to my index since I was created
+        """
+        width = len(self.index)
+        if self._values.shape[1] < width:
+            extra = width-self._values.shape[1]
+            capacity = len(self._prob)
+            self._values = numpy.hstack((self._values,numpy.zeros((capacity,extra))))
+            self._mask = numpy.hstack((self._mask,numpy.zeros((capacity,extra),bool)))
+            self._rows = {}
+            for row in xrange(self._size):
+                self._rows[self._key(self._values[row],self._mask[row])] = row
+
+    def columns(self):
+        """
+        @return: the value matrix, the presence mask, and the probability array, one row per possible world
+        @rtype: (numpy.ndarray,numpy.ndarray,numpy.ndarray)
+        @warning: the arrays are views onto my storage, so do not modify them
+        """
+        self.fit()
+        return self._values[:self._size],self._mask[:self._size],self._prob[:self._size]
+
+    def _find(self,element):
+        """
+        @return: the row holding the given vector, or C{None} if there is none
+        @rtype: int
+        """
+        if not isinstance(element,DenseVector) or not element.index is self.index:
+            element = DenseVector(element,self.index)
+        self.fit()
+        element.fit()
+        width = self._values.shape[1]
+        return self._rows.get(self._key(element.array[:width],element.mask[:width]))
+
+    def __getitem__(self,element):
+        row = self._find(element)
+        if row is None:
+            raise KeyError,str(element)
+        return self._prob.item(row)
+
+    def __setitem__(self,element,value):
+        row = self._find(element)
+        if row is None:
+            if not isinstance(element,DenseVector) or not element.index is self.index:
+                element = DenseVector(element,self.index)
+            element.fit()
+            row = self._size
+            if row == len(self._prob):
+                # Grow storage geometrically
+                capacity = max(4,2*row)
+                width = self._values.shape[1]
+                values = numpy.zeros((capacity,width))
+                mask = numpy.zeros((capacity,width),bool)
+                prob = numpy.zeros(capacity)
+                values[:row] = self._values[:row]
+                mask[:row] = self._mask[:row]
+                prob[:row] = self._prob[:row]
+                self._values,self._mask,self._prob = values,mask,prob
+            width = self._values.shape[1]
+            self._values[row] = element.array[:width]
+            self._mask[row] = element.mask[:width]
+            self._rows[self._key(self._values[row],self._mask[row])] = row
+            self._size += 1
+            self._elements = None
+        self._prob[row] = value
+        self._cumulative = None
+
+    def __delitem__(self,element):
+        row = self._find(element)
+        if row is None:
+            raise KeyError,str(element)
+        del self._rows[self._key(self._values[row],self._mask[row])]
+        last = self._size-1
+        if row < last:
+            # Move last row into the vacated one
+            self._values[row] = self._values[last]
+            self._mask[row] = self._mask[last]
+            self._prob[row] = self._prob[last]
+            self._rows[self._key(self._values[row],self._mask[row])] = row
+        self._values[last] = 0.
+        self._mask[last] = False
+        self._size = last
+        self._elements = None
+        self._cumulative = None
+
+    def has_key(self,element):
+        return not self._find(element) is None
+
+    def __contains__(self,element):
+        return not self._find(element) is None
+
+    def __len__(self):
+        return self._size
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        return map(str,self.domain())
+
+    def values(self):
+        return self._prob[:self._size].tolist()
+
+    def items(self):
+        return zip(self.keys(),self.values())
+
+    def clear(self):
+        self.fit()
+        self._store(numpy.zeros((0,self._values.shape[1])),
+                    numpy.zeros((0,self._values.shape[1]),bool),numpy.zeros(0))
+
+    def domain(self):
+        if self._elements is None:
+            self.fit()
+            self._elements = []
+            for row in xrange(self._size):
+                vector = DenseVector(index=self.index)
+                vector.array = self._values[row].copy()
+                vector.mask = self._mask[row].copy()
+                self._elements.append(vector)
+        return list(self._elements)
+
+    def normalize(self):
+        prob = self._prob[:self._size]
+        total = prob.sum()
+        if abs(total-1.) > self.epsilon:
+            if total == 0.:
+                prob[:] = 1./float(self._size)
+            else:
+                prob /= total
+            self._cumulative = None
+
+    def cumulative(self):
+        if self._cumulative is None:
+            self._cumulative = (self.domain(),numpy.cumsum(self._prob[:self._size]))
+        return self._cumulative
+
+    def sample(self,quantify=False,generator=None):
+        generator = makeGenerator(generator)
+        elements,table = self.cumulative()
+        selection = generator.random()
+        index = int(numpy.searchsorted(table,selection))
+        if index == len(table):
+            raise ValueError,'Random number exceeded total probability in distribution.'
+        if quantify:
+            if index > 0:
+                selection -= table.item(index-1)
+            return elements[index],selection
+        else:
+            return elements[index]
+
+    def sampleN(self,count,generator=None):
+        generator = makeGenerator(generator)
+        elements,table = self.cumulative()
+        selections = numpy.fromiter([generator.random() for sample in xrange(count)],numpy.float64,count)
+        indices = numpy.searchsorted(table,selections)
+        if count and indices.max() == len(table):
+            raise ValueError,'Random number exceeded total probability in distribution.'
+        return [elements[index] for index in indices]
+
+    def join(self,key,value):
+        values,mask,prob = self.columns()
+        slot = self.index.add(key)
+        if slot >= values.shape[1]:
+            values,mask,prob = self.columns()
+        if isinstance(value,Distribution):
+            # Cartesian product of my worlds with the possible values
+            elements = value.domain()
+            count = len(elements)
+            values = numpy.repeat(values,count,axis=0)
+            mask = numpy.repeat(mask,count,axis=0)
+            values[:,slot] = numpy.tile(elements,len(prob))
+            prob = numpy.outer(prob,[value[element] for element in elements]).ravel()
+        else:
+            values = values.copy()
+            mask = mask.copy()
+            values[:,slot] = value
+            prob = prob.copy()
+        mask[:,slot] = True
+        self._store(values,mask,prob)
+
+    def merge(self,other):
+        if not isinstance(other,DenseDistribution) or not other.index is self.index:
+            other = self.__class__(other,index=self.index)
+        diffValues,diffMask,diffProb = other.columns()
+        values,mask,prob = self.columns()
+        count = len(diffProb)
+        # Overwrite my columns with each row of the other distribution in turn
+        diffMask = numpy.repeat(diffMask,len(prob),axis=0)
+        values = numpy.where(diffMask,numpy.repeat(diffValues,len(prob),axis=0),
+                             numpy.tile(values,(count,1)))
+        mask = numpy.tile(mask,(count,1)) | diffMask
+        prob = numpy.outer(diffProb,prob).ravel()
+        result = self.__class__(index=self.index)
+        result._store(values,mask,prob)
         return result
+
+    def marginal(self,key):
+        values,mask,prob = self.columns()
+        slot = self.index.slots.get(key)
+        if slot is None or not mask[:,slot].all():
+            raise KeyError,key
+        elements,inverse = numpy.unique(values[:,slot],return_inverse=True)
+        total = numpy.bincount(inverse,weights=prob)
+        return Distribution(dict(zip(elements.tolist(),total.tolist())))
+
+    def select(self,incremental=False,generator=None):
+        generator = makeGenerator(generator)
+        if incremental:
+            sample = KeyedVector()
+            keys = self.domain()[0].keys()
+            index = 0
+            while len(self) > 1:
+                key = keys[index]
+                dist = self.marginal(key)
+                if len(dist) > 1:
+                    element,sample[key] = dist.sample(True,generator)
+                    for other in dist.domain():
+                        if other == element:
+                            break
+                        else:
+                            sample[key] += dist[other]
+                    values,mask,prob = self.columns()
+                    keep = values[:,self.index.slots[key]] == element
+                    self._store(values[keep],mask[keep],prob[keep])
+                    self.normalize()
+                index += 1
+            return sample
+        else:
+            Distribution.select(self,generator)
+
+    def hasColumn(self,key):
+        values,mask,prob = self.columns()
+        slot = self.index.slots.get(key)
+        return not slot is None and bool(mask[:,slot].all())
+
+    def __eq__(self,other):
+        if not isinstance(other,Distribution) or len(self) != len(other):
+            return False
+        for element in self.domain():
+            if abs(self[element]-other.getProb(element)) > self.epsilon:
+                return False
+        else:
+            return True
+
+    def __ne__(self,other):
+        return not self == other
+
+    def __copy__(self):
+        values,mask,prob = self.columns()
+        result = self.__class__(index=self.index)
+        result._store(values.copy(),mask.copy(),prob.copy())
+        return result
+
+    def __deepcopy__(self,memo):
+        result = self.__copy__()
+        memo[id(self)] = result
+        return result
+
+    def __reduce__(self):
+        return (self.__class__,(None,None,self.index),None,None,
+                iter([(element,self[element]) for element in self.domain()]))
+
+    def __xml__(self):
+        doc = Document()
+        root = doc.createElement('distribution')
+        doc.appendChild(root)
+        for element in self.domain():
+            node = doc.createElement('entry')
+            root.appendChild(node)
+            node.setAttribute('probability',str(self[element]))
+            node.appendChild(self.element2xml(element))
+        return doc
+
+    def parse(self,element):
+        assert element.tagName == 'distribution'
+        self.clear()
+        node = element.firstChild
+        while node:
+            if node.nodeType == node.ELEMENT_NODE:
+                prob = float(node.getAttribute('probability'))
+                subNode = node.firstChild
+                while subNode and subNode.nodeType != subNode.ELEMENT_NODE:
+                    subNode = subNode.nextSibling
+                self[self.xml2element(None,subNode)] = prob
+            node = node.nextSibling
+
+    def xml2element(self,key,node):
+        return DenseVector(node,self.index)
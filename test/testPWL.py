@@ -1,3 +1,5 @@
+import copy
+import pickle
 import unittest
 import random
 
@@ -104,6 +106,249 @@ class TestPWL(unittest.TestCase):
                 for key in product.keys():
                     self.assertAlmostEqual(product[key],v2[key],8)
 
+    def testDenseVector(self):
+        for iteration in range(100):
+            v1 = self.makeVector(gap=0.1)
+            v2 = self.makeVector(gap=0.2)
+            d1 = DenseVector(v1)
+            d2 = DenseVector(v2)
+            self.assertEqual(d1,v1)
+            self.assertEqual(set(d1.keys()),set(v1.keys()))
+            self.assertEqual(str(KeyedVector(d1)),str(v1))
+            self.assertAlmostEqual(d1*d2,v1*v2,8)
+            self.assertAlmostEqual(v1*d2,v1*v2,8)
+            total = d1+d2
+            self.assertTrue(isinstance(total,DenseVector))
+            self.assertEqual(total,v1+v2)
+            self.assertEqual(d1-d2,v1-v2)
+            matrix = self.makeMatrix(colgap=0.5)
+            product = matrix*d1
+            self.assertEqual(set(product.keys()),set((matrix*v1).keys()))
+            self.assertEqual(product,matrix*v1)
+            plane = self.makePlane(gap=0.5)
+            self.assertEqual(plane.evaluate(d1),plane.evaluate(v1))
+            d1['Z'] = 1.
+            self.assertTrue(d1.has_key('Z'))
+            del d1['Z']
+            self.assertFalse(d1.has_key('Z'))
+            self.assertEqual(d1,v1)
+
+    def testDenseDistribution(self):
+        for iteration in range(20):
+            sparse = VectorDistribution()
+            for element in range(4):
+                sparse.addProb(self.makeVector(gap=0.),random.random())
+            sparse.normalize()
+            dense = DenseDistribution(sparse)
+            self.assertEqual(len(dense),len(sparse))
+            self.assertEqual(dense,sparse)
+            value = Distribution({1.: 0.25,2.: 0.75})
+            sparse.join('Z',value)
+            dense.join('Z',value)
+            self.assertEqual(len(dense),len(sparse))
+            for vector in sparse.domain():
+                self.assertAlmostEqual(dense[vector],sparse[vector],8)
+            marginal = dense.marginal('Z')
+            self.assertAlmostEqual(marginal[2.],0.75,8)
+            self.assertTrue(dense.hasColumn('Z'))
+            diff = VectorDistribution({KeyedVector({'Z': 3.}): 1.})
+            merged = dense.merge(diff)
+            self.assertEqual(len(merged),len(sparse)/2)
+            self.assertAlmostEqual(merged.marginal('Z')[3.],1.,8)
+            element = dense.domain()[0]
+            del dense[element]
+            self.assertFalse(dense.has_key(element))
+            dense.normalize()
+            self.assertAlmostEqual(sum(dense.values()),1.,8)
+
+    def testHashedDistribution(self):
+        for iteration in range(20):
+            dist = VectorDistribution()
+            for element in range(4):
+                dist.addProb(self.makeVector(gap=0.5),random.random())
+            for vector in dist.domain():
+                copy = KeyedVector(vector)
+                self.assertEqual(hash(copy),hash(vector))
+                self.assertAlmostEqual(dist[copy],dist[vector],8)
+            new = VectorDistribution(dist.__xml__().documentElement)
+            self.assertEqual(len(new),len(dist))
+            for vector in dist.domain():
+                self.assertAlmostEqual(new[vector],dist[vector],8)
+            trees = TreeDistribution()
+            for element in range(4):
+                trees.addProb(self.makeTree(depth=2),random.random())
+            new = TreeDistribution(trees.__xml__().documentElement)
+            for tree in trees.domain():
+                self.assertAlmostEqual(new[tree],trees[tree],8)
+
+    def testHashEquality(self):
+        # Values that differ by less than epsilon but straddle a rounding boundary
+        vector = KeyedVector({'x': 0.123456785+1e-12,'y': 1.})
+        other = KeyedVector({'x': 0.123456785-1e-12,'y': 1.,'z': 0.})
+        self.assertEqual(vector == other,hash(vector) == hash(other))
+        self.assertEqual(KeyedVector({'x': 1.,'z': 1e-12}),KeyedVector({'x': 1.}))
+        self.assertEqual(hash(KeyedVector({'x': 1.,'z': 1e-12})),hash(KeyedVector({'x': 1.})))
+        dist = VectorDistribution()
+        dist.addProb(vector,0.5)
+        dist.addProb(other,0.5)
+        self.assertEqual(len(dist),2-int(vector == other))
+        matrix = KeyedMatrix({'x': KeyedVector({'x': 1.,'z': 0.})})
+        same = KeyedMatrix({'x': KeyedVector({'x': 1.})})
+        self.assertEqual(matrix,same)
+        self.assertEqual(hash(matrix),hash(same))
+        self.assertNotEqual(matrix,KeyedMatrix({'x': KeyedVector({'x': 1.}),'y': KeyedVector()}))
+
+    def testSampling(self):
+        dist = VectorDistribution()
+        for element in range(4):
+            dist[self.makeVector()] = float(element+1)/10.
+        for distribution in [dist,DenseDistribution(dist)]:
+            samples = distribution.sampleN(4000,random.Random(0))
+            self.assertEqual(samples,distribution.sampleN(4000,0))
+            for vector in distribution.domain():
+                frequency = float(len([sample for sample in samples if sample == vector]))/4000.
+                self.assertAlmostEqual(frequency,distribution[vector],1)
+            vector = distribution.domain()[0]
+            distribution[vector] += 1.
+            distribution.normalize()
+            samples = distribution.sampleN(1000,1)
+            self.assertGreater(len([sample for sample in samples if sample == vector]),500)
+
+    def testDistributionCopy(self):
+        dist = VectorDistribution()
+        for element in range(4):
+            dist.addProb(self.makeVector(gap=0.5),random.random())
+        for original in [dist,DenseDistribution(dist)]:
+            shallow = copy.copy(original)
+            deep = copy.deepcopy(original)
+            pickled = pickle.loads(pickle.dumps(original,pickle.HIGHEST_PROTOCOL))
+            for new in [shallow,deep,pickled]:
+                self.assertEqual(new.__class__,original.__class__)
+                self.assertEqual(len(new),len(original))
+                for vector in original.domain():
+                    self.assertAlmostEqual(new[vector],original[vector],8)
+            vector = original.domain()[0]
+            deep.join('Z',1.)
+            self.assertFalse(original.domain()[0].has_key('Z'))
+            shallow[vector] = 2.
+            self.assertNotEqual(original[vector],2.)
+        trees = TreeDistribution({self.makeTree(depth=1): 0.5,self.makeTree(depth=1): 0.5})
+        for tree in copy.deepcopy(trees).domain():
+            self.assertAlmostEqual(trees[tree],0.5,8)
+
+    def testTreeFactory(self):
+        factory = TreeFactory()
+        for iteration in range(20):
+            t1 = self.makeTree(rows=2,cols=2,planecols=2,depth=2)
+            t2 = self.makeTree(rows=2,cols=2,planecols=2,depth=1)
+            i1 = factory.intern(t1)
+            self.assertTrue(factory.intern(copy.deepcopy(t1)) is i1)
+            self.assertTrue(KeyedTree(t1.__xml__().documentElement) == t1)
+            self.assertTrue(factory.intern(KeyedTree(t1.__xml__().documentElement)) is i1)
+            self.assertTrue(copy.deepcopy(i1) is i1)
+            i2 = factory.intern(t2)
+            product = i1*i2
+            self.assertTrue(factory.intern(product) is product)
+            for testIteration in range(20):
+                v = self.makeVector()
+                self.assertEqual(product[v]*v,(t1*t2)[v]*v)
+        del t1,t2,i1,i2,product
+        KeyedTree.cache.clear()
+        self.assertEqual(len(factory),0)
+
+    def testInternedFloor(self):
+        leaf = treeFactory.intern(makeTree(incrementMatrix('x',-10.)))
+        tree = treeFactory.intern(makeTree({'if': thresholdRow('y',0.5),
+                                            True: incrementMatrix('x',-10.),
+                                            False: incrementMatrix('x',5.)}))
+        for original in [leaf,tree]:
+            text = str(original)
+            floored = original.floor('x',0.)
+            self.assertEqual(str(original),text)
+            self.assertFalse(floored is original)
+            self.assertTrue(treeFactory.intern(floored) is floored)
+            self.assertEqual(floored[KeyedVector({'x': 5.,'y': 1.,CONSTANT: 1.})]['x'],
+                             setToConstantMatrix('x',0.)['x'])
+            ceiled = original.ceil('x',1.)
+            self.assertEqual(str(original),text)
+            self.assertFalse(ceiled is original)
+        plane = KeyedPlane(KeyedVector({'y': 2.,CONSTANT: -1.}),0.)
+        tree = treeFactory.intern(makeTree({'if': plane,True: incrementMatrix('x',1.),
+                                            False: incrementMatrix('x',2.)}))
+        minimized = tree.minimizePlanes()
+        self.assertTrue(tree.branch.vector.has_key(CONSTANT))
+        self.assertFalse(minimized.branch.vector.has_key(CONSTANT))
+        self.assertTrue(treeFactory.intern(minimized) is minimized)
+        for value in [0.,1.]:
+            vector = KeyedVector({'x': 0.,'y': value,CONSTANT: 1.})
+            self.assertEqual(minimized[vector],tree[vector])
+
+    def testProbabilisticFloor(self):
+        for method,bound,value,outside in [('floor',0.,-10.,-20.),('ceil',1.,5.,20.)]:
+            tree = makeTree({'distribution': [(incrementMatrix('x',value),0.7),(noChangeMatrix('x'),0.3)]})
+            bounded = getattr(tree,method)('x',bound)
+            self.assertTrue(bounded.isProbabilistic())
+            self.assertEqual(len(bounded.children),2)
+            self.assertAlmostEqual(sum([bounded.children[child] for child in bounded.children.domain()]),1.,8)
+            for child in bounded.children.domain():
+                self.assertFalse(child.isLeaf())
+                # Outside the bound, either outcome sets it to the bound
+                self.assertEqual(child[KeyedVector({'x': outside,CONSTANT: 1.})]['x'],
+                                 setToConstantMatrix('x',bound)['x'])
+        plane = KeyedPlane(KeyedVector({'y': 2.,CONSTANT: -1.}),0.)
+        tree = makeTree({'distribution': [({'if': plane,True: incrementMatrix('x',1.),
+                                            False: incrementMatrix('x',2.)},0.5),
+                                           (noChangeMatrix('x'),0.5)]})
+        minimized = tree.minimizePlanes()
+        self.assertEqual(len(minimized.children),2)
+        for child in minimized.children.domain():
+            self.assertAlmostEqual(minimized.children[child],0.5,8)
+            if not child.isLeaf():
+                self.assertFalse(child.branch.vector.has_key(CONSTANT))
+
+    def testTreeCache(self):
+        KeyedTree.cache.clear()
+        t1 = treeFactory.intern(self.makeTree(rows=2,cols=2,planecols=2,depth=2))
+        t2 = treeFactory.intern(self.makeTree(rows=2,cols=2,planecols=2,depth=1))
+        product = t1*t2
+        misses = KeyedTree.cache.misses
+        self.assertTrue(misses > 0)
+        self.assertTrue(t1*t2 is product)
+        self.assertEqual(KeyedTree.cache.misses,misses)
+        self.assertTrue(KeyedTree.cache.hits > 0)
+        expectation = t1.expectation()
+        self.assertTrue(t1.expectation() is expectation)
+        KeyedTree.cache.resize(1)
+        self.assertEqual(len(KeyedTree.cache),1)
+        t1+t2
+        self.assertEqual(len(KeyedTree.cache),1)
+        KeyedTree.cache.resize(4096)
+        KeyedTree.cache.clear()
+
+    def testPruneBounds(self):
+        bounds = {}
+        for index in range(8):
+            bounds[chr(65+index)] = (0.,1.)
+        # Second test can never succeed after first one does
+        tree = KeyedTree()
+        inner = KeyedTree()
+        inner.makeBranch(KeyedPlane(KeyedVector({'A': 1.}),0.2,-1),KeyedTree(KeyedMatrix()),
+                         self.makeTree(depth=1))
+        tree.makeBranch(KeyedPlane(KeyedVector({'A': 1.}),0.5),inner,self.makeTree(depth=1))
+        pruned = tree.prune(bounds=bounds)
+        self.assertTrue(pruned.children[True].isLeaf() or pruned.children[True].branch != inner.branch)
+        # Nothing within bounds exceeds the sum of the weights
+        tree = KeyedTree()
+        tree.makeBranch(KeyedPlane(KeyedVector({'A': 1.,'B': 1.}),2.5),self.makeTree(depth=1),
+                        self.makeTree(depth=1))
+        self.assertTrue(tree.prune(bounds=bounds) == tree.children[False])
+        for iteration in range(20):
+            tree = self.makeTree(rows=2,cols=2,planecols=2,depth=4)
+            pruned = tree.prune(bounds=bounds)
+            for testIteration in range(50):
+                vector = self.makeVector()
+                self.assertEqual(pruned[vector],tree[vector])
+
     def DONTtestTreeAddition(self):
         for iteration in range(100):
             t1 = self.makeTree(colgap=0.75,planegap=0.75)
@@ -114,6 +359,18 @@ class TestPWL(unittest.TestCase):
                 total = t1[v]*v + t2[v]*v
                 self.assertAlmostEqual(tTotal[v]*v,total,8)
 
+    def testDesymbolize(self):
+        vector = KeyedVector({'A': 'x','B': '2*x+y','C': 'z',CONSTANT: 1.})
+        for x in range(5):
+            table = {'x': x,'y': 0.5}
+            result = vector.desymbolize(table)
+            self.assertEqual(result['A'],x)
+            self.assertAlmostEqual(result['B'],2*x+0.5,8)
+            self.assertEqual(result['C'],'z')
+            self.assertAlmostEqual(result[CONSTANT],1.,8)
+        plane = KeyedPlane(KeyedVector({'A': 1.}),'x+1')
+        self.assertAlmostEqual(plane.desymbolize({'x': 2}).threshold,3.,8)
+
     def testTreeMultiplication(self):
         for iteration in range(100):
             t1 = self.makeTree(rows=2,cols=2,planecols=2,depth=1)
@@ -128,5 +385,27 @@ class TestPWL(unittest.TestCase):
                 for key in v3.keys():
                     self.assertAlmostEqual(product1[key],v3[key],8)
 
+    def testCompiledTree(self):
+        for iteration in range(20):
+            vectors = [self.makeVector(gap=0.25) for index in range(50)]
+            target = vectors[0].get('A',0.)
+            tree = KeyedTree()
+            tree.makeBranch(KeyedPlane(KeyedVector({'A': 1.}),[0.5,target],0),
+                            self.makeTree(planegap=0.5),KeyedTree())
+            branch = self.makeTree(planegap=0.5)
+            tree.children[False].makeProbabilistic(TreeDistribution({branch: 0.4,
+                                                                     self.makeTree(depth=1): 0.6}))
+            compiled = tree.compile()
+            results = compiled.evaluate(vectors)
+            for vector,result in zip(vectors,results):
+                expected = tree[vector]
+                if isinstance(expected,Distribution):
+                    self.assertTrue(isinstance(result,Distribution))
+                    for matrix in expected.domain():
+                        self.assertAlmostEqual(result[matrix],expected[matrix],8)
+                else:
+                    self.assertEqual(result,expected)
+            self.assertEqual(compiled[vectors[0]],tree[vectors[0]])
+
 if __name__ == '__main__':
     unittest.main()
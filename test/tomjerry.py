@@ -1,10 +1,16 @@
+import copy
+import random
+import time
 import unittest
 
 from psychsim.action import *
 from psychsim.world import *
-from psychsim.agent import Agent
+from psychsim.agent import Agent,ValueFunction,DeadlineExceeded
 from psychsim.pwl import *
 from psychsim.reward import *
+from psychsim.parallel import WorldPool
+from psychsim.history import History
+from psychsim.batch import Batch
 
 class TestAgents(unittest.TestCase):
 
@@ -131,6 +137,22 @@ class TestAgents(unittest.TestCase):
                         self.assertAlmostEqual(belief[key],40,8)
                     else:
                         self.assertAlmostEqual(belief[key],10,8)
+            # Repeating the same update uses the memoized result
+            hits = self.jerry.estimates.hits
+            self.assertEqual(self.jerry.index2model(self.jerry.stateEstimator(vector,new,omega)),model)
+            self.assertEqual(self.jerry.estimates.hits,hits+1)
+        self.assertEqual(len(self.jerry.estimates),len(omegaDist))
+        # Changes to the dynamics (or other definitions) invalidate them
+        self.world.setDynamics(key,self.hit,makeTree(incrementMatrix(key,-20)))
+        self.assertEqual(len(self.jerry.estimates),0)
+        model = self.jerry.index2model(self.jerry.stateEstimator(vector,new,omega))
+        for belief in self.jerry.models[model]['beliefs'].domain():
+            self.assertTrue(belief[key] in [0,30])
+        # Garbage collected models are not resurrected
+        self.jerry.deleteModel(model)
+        self.assertNotEqual(self.jerry.index2model(self.jerry.stateEstimator(vector,new,omega)),None)
+        self.jerry.estimates.resize(0)
+        self.assertEqual(self.jerry.estimates.weight,0)
 
     def testUnobservedAction(self):
         self.addStates()
@@ -204,6 +226,14 @@ class TestAgents(unittest.TestCase):
         self.addActions()
         self.addDynamics()
         key = stateKey(self.jerry.name,'health')
+        # Reuse an (interned) tree for another action
+        hit = self.world.dynamics[key][self.hit]
+        text = str(hit)
+        self.world.setDynamics(key,self.trick,hit,enforceMin=True)
+        self.assertEqual(str(hit),text)
+        for value in [0,5,50]:
+            vector = KeyedVector({key: value,CONSTANT: 1.})
+            self.assertEqual(self.world.dynamics[key][self.trick][vector]*vector,hit[vector]*vector)
         self.assertEqual(len(self.world.state[None]),1)
         vector = self.world.state[None].domain()[0]
         self.assertTrue(vector.has_key(stateKey(self.tom.name,'health')))
@@ -227,6 +257,492 @@ class TestAgents(unittest.TestCase):
             outcome = self.world.step({self.tom.name: self.hit})
             self.saveload()
 
+    def testDenseState(self):
+        self.world.setOrder([self.tom.name])
+        self.addStates()
+        self.addActions()
+        self.addDynamics()
+        self.addModels()
+        self.world.setModel(self.jerry.name,True)
+        self.world.setMentalModel(self.jerry.name,self.tom.name,{'friend': 0.5,'foe': 0.5})
+        index = self.world.densify()
+        key = stateKey(self.jerry.name,'health')
+        self.assertTrue(index.has_key(key))
+        for i in range(3):
+            self.assertEqual(len(self.world.state[None]),1)
+            vector = self.world.state[None].domain()[0]
+            self.assertTrue(isinstance(vector,DenseVector))
+            self.assertAlmostEqual(vector[key],50-10*i,8)
+            self.world.step({self.tom.name: self.hit})
+        model = self.world.getModel(self.jerry.name,self.world.state[None].domain()[0])
+        beliefs = self.jerry.getAttribute('beliefs',model)
+        for belief in beliefs.domain():
+            if self.tom.index2model(belief[modelKey(self.tom.name)]) == 'foe':
+                self.assertGreater(beliefs[belief],0.5)
+
+    def testCopy(self):
+        class Mouse(Agent):
+            def __init__(self,name,hole):
+                Agent.__init__(self,name)
+                self.hole = hole
+        mouse = Mouse('Nibbles','kitchen')
+        self.world.addAgent(mouse)
+        self.world.setOrder([self.tom.name])
+        self.addStates()
+        self.addActions()
+        self.addDynamics()
+        self.addModels()
+        self.world.setModel(self.jerry.name,True)
+        self.world.setMentalModel(self.jerry.name,self.tom.name,{'friend': 0.5,'foe': 0.5})
+        key = stateKey(self.jerry.name,'health')
+        for world in [copy.copy(self.world),copy.deepcopy(self.world)]:
+            self.assertEqual(world.agents['Nibbles'].__class__,Mouse)
+            self.assertEqual(world.agents['Nibbles'].hole,'kitchen')
+            for agent in world.agents.values():
+                self.assertTrue(agent.world is world)
+            world.step({self.tom.name: self.hit})
+            self.assertAlmostEqual(world.getValue(key),40,8)
+            self.assertAlmostEqual(self.world.getValue(key),50,8)
+            self.assertEqual(len(self.world.history),0)
+            self.assertEqual(self.jerry.models.keys(),[True])
+            # Changing the copy's reward leaves mine alone
+            vector = self.world.state[None].domain()[0]
+            reward = self.tom.reward(vector,'foe')
+            goals = len(self.tom.models['foe']['R'])
+            world.agents[self.tom.name].setReward(maximizeFeature(stateKey(self.tom.name,'health')),1.,'foe')
+            self.assertEqual(len(world.agents[self.tom.name].models['foe']['R']),goals+1)
+            self.assertEqual(len(self.tom.models['foe']['R']),goals)
+            self.assertAlmostEqual(self.tom.reward(vector,'foe'),reward,8)
+            self.assertFalse(world.agents[self.tom.name].models['foe']['V'] is self.tom.models['foe']['V'])
+        self.world.step({self.tom.name: self.hit})
+        self.assertAlmostEqual(self.world.getValue(key),40,8)
+
+    def testParallelStep(self):
+        self.world.setOrder([self.tom.name])
+        self.addStates()
+        self.addActions()
+        self.addDynamics()
+        self.addModels()
+        self.world.setModel(self.jerry.name,True)
+        self.world.setMentalModel(self.jerry.name,self.tom.name,{'friend': 0.5,'foe': 0.5})
+        self.world.setState(self.jerry.name,'health',Distribution({50: 0.5,30: 0.5}))
+        serial = self.world.step(real=False)
+        pool = WorldPool(self.world,2)
+        try:
+            parallel = self.world.step(real=False,executor=pool)
+            self.assertEqual(len(serial),len(parallel))
+            for old,new in zip(serial,parallel):
+                self.assertEqual(old['old'],new['old'])
+                self.assertEqual(old['actions'],new['actions'])
+                self.assertEqual(old['new'],new['new'])
+                self.assertAlmostEqual(old['probability'],new['probability'],8)
+            self.world.step(executor=pool)
+            self.assertEqual(len(self.world.state[None]),2)
+            # Later steps only send the new models to the same workers
+            workers = pool.pool
+            for i in range(3):
+                outcomes = self.world.step(executor=pool)
+                self.assertTrue(pool.pool is workers)
+                for outcome in outcomes:
+                    for vector in outcome['new'].domain():
+                        label = self.jerry.index2model(vector[modelKey(self.jerry.name)])
+                        self.assertTrue(self.jerry.models.has_key(label))
+                    matrix = outcome['effect'][-1].domain()[0]
+                    self.assertEqual(matrix[modelKey(self.jerry.name)][CONSTANT],
+                                     outcome['new'].domain()[0][modelKey(self.jerry.name)])
+            self.assertGreater(len(pool.log),0)
+            self.assertEqual(len(self.world.state[None]),2)
+        finally:
+            pool.close()
+
+    def testParallelDecide(self):
+        self.world.setOrder([self.tom.name])
+        self.addStates()
+        self.addActions()
+        self.addDynamics()
+        key = stateKey(self.jerry.name,'health')
+        self.tom.setReward(minimizeFeature(key),1.)
+        self.tom.setHorizon(2)
+        self.tom.setBelief(key,Distribution({50: 0.5,30: 0.5}))
+        vector = self.world.state[None].domain()[0]
+        pool = WorldPool(self.world,2)
+        try:
+            for selection in ['consistent','distribution']:
+                self.tom.setAttribute('V',ValueFunction())
+                serial = self.tom.decide(vector,selection=selection)
+                self.tom.setAttribute('V',ValueFunction())
+                parallel = self.tom.decide(vector,selection=selection,executor=pool)
+                self.assertEqual(serial['action'],parallel['action'])
+                self.assertAlmostEqual(serial['V*'],parallel['V*'],8)
+                for action in self.tom.actions:
+                    self.assertEqual(sorted(serial['V'][action].keys()),sorted(parallel['V'][action].keys()))
+                    self.assertAlmostEqual(serial['V'][action]['__EV__'],parallel['V'][action]['__EV__'],8)
+            self.assertAlmostEqual(parallel['action'][self.hit]+parallel['action'][self.chase],1.,8)
+            # Ties are broken the same way (and the workers pick up the new reward on their own)
+            workers = pool.pool
+            self.tom.setReward(minimizeFeature(key),0.)
+            self.tom.setAttribute('V',ValueFunction())
+            serial = self.tom.decide(vector,selection='uniform')
+            self.tom.setAttribute('V',ValueFunction())
+            parallel = self.tom.decide(vector,selection='uniform',executor=pool)
+            self.assertFalse(pool.pool is workers)
+            self.assertEqual(pool.revision,self.world.revision)
+            self.assertEqual(serial['action'],parallel['action'])
+            self.assertEqual(len(parallel['action']),2)
+        finally:
+            pool.close()
+
+    def testTransitionCache(self):
+        self.world.setOrder([self.tom.name])
+        self.addStates()
+        self.addActions()
+        self.addDynamics()
+        vector = self.world.state[None].domain()[0]
+        actions = {self.tom.name: self.hit}
+        first = self.world.effect(actions,vector,0.5)
+        hits = self.world.transitions.hits
+        second = self.world.effect(actions,vector,0.5)
+        self.assertEqual(self.world.transitions.hits,hits+1)
+        self.assertEqual(first['new'],second['new'])
+        self.assertAlmostEqual(sum([second['new'][v] for v in second['new'].domain()]),0.5,8)
+        # Changing the dynamics must flush the cache
+        key = stateKey(self.jerry.name,'health')
+        self.world.setDynamics(key,self.hit,makeTree(incrementMatrix(key,-20)))
+        self.assertEqual(len(self.world.transitions),0)
+        new = self.world.effect(actions,vector)['new'].domain()[0]
+        self.assertEqual(new[key],30)
+
+    def testAffected(self):
+        self.world.setOrder([self.tom.name])
+        self.addStates()
+        self.addActions()
+        self.addDynamics()
+        key = stateKey(self.jerry.name,'health')
+        self.assertEqual(self.world.getAffected({self.tom.name: self.hit}),set([key]))
+        self.assertEqual(self.world.getAffected({self.tom.name: self.chase}),set())
+        tree = makeTree(incrementMatrix(stateKey(self.tom.name,'health'),1))
+        self.world.setDynamics(stateKey(self.tom.name,'health'),True,tree)
+        self.assertEqual(self.world.getAffected({self.tom.name: self.chase}),
+                         set([stateKey(self.tom.name,'health')]))
+        self.world.step({self.tom.name: self.hit})
+        vector = self.world.state[None].domain()[0]
+        self.assertEqual(vector[key],40)
+        # Default dynamics still apply
+        self.assertEqual(vector[stateKey(self.tom.name,'health')],51)
+
+    def testModelGC(self):
+        self.addStates()
+        self.addActions()
+        self.addDynamics()
+        self.addModels()
+        self.world.setOrder([self.tom.name])
+        self.world.setModel(self.jerry.name,True)
+        self.world.setMentalModel(self.jerry.name,self.tom.name,{'friend': 0.5,'foe': 0.5})
+        actions = {self.tom.name: self.hit}
+        for t in range(3):
+            self.world.step(actions)
+        vector = self.world.state[None].domain()[0]
+        beliefs = self.jerry.getAttribute('beliefs',self.world.getModel(self.jerry.name,vector))
+        # Simulations leave the models in the current state intact, even when collecting along the way
+        model = self.world.getModel(self.jerry.name,vector)
+        labels = sorted(self.jerry.models.keys())
+        self.world.gcInterval = 1
+        self.world.rollouts(1,horizon=2,workers=1,seed=1)
+        self.assertEqual(self.world.gcInterval,1)
+        self.world.gcInterval = None
+        self.assertEqual(self.world.getModel(self.jerry.name,self.world.state[None].domain()[0]),model)
+        self.assertEqual(sorted(self.jerry.models.keys()),labels)
+        count = len(self.jerry.models)
+        deleted = self.world.modelGC(True)
+        self.assertGreater(deleted,0)
+        self.assertEqual(len(self.jerry.models),count-deleted)
+        self.assertEqual(sorted(self.jerry.modelList.keys()),range(len(self.jerry.models)))
+        # Authored models survive, and the current model keeps its beliefs
+        self.assertTrue(self.tom.models.has_key('friend'))
+        self.assertTrue(self.tom.models.has_key('foe'))
+        vector = self.world.state[None].domain()[0]
+        self.assertEqual(self.jerry.getAttribute('beliefs',self.world.getModel(self.jerry.name,vector)),
+                         beliefs)
+        self.assertEqual(self.world.modelGC(True),0)
+        # Periodic collection
+        self.world.gcInterval = 2
+        for t in range(4):
+            self.world.step(actions)
+            self.assertEqual(self.world.gcSteps,(t+1) % 2)
+        # Collection once there are too many models
+        self.world.gcInterval = None
+        self.world.gcModelLimit = len(self.jerry.models)+len(self.tom.models)
+        for t in range(3):
+            self.world.step(actions)
+            self.assertLessEqual(len(self.jerry.models)+len(self.tom.models),self.world.gcModelLimit+1)
+
+    def testHistory(self):
+        self.addStates()
+        self.addActions()
+        self.addDynamics()
+        self.world.setOrder([self.tom.name])
+        self.world.history = History(2)
+        key = stateKey(self.jerry.name,'health')
+        for t in range(5):
+            self.world.step({self.tom.name: self.hit})
+        self.assertEqual(len(self.world.history),5)
+        self.assertEqual(len(self.world.history.recent),2)
+        self.assertEqual(len(self.world.history.offsets),3)
+        for t,outcomes in enumerate(self.world.history):
+            self.assertEqual(outcomes[0]['old'][key],50-10*t)
+        self.assertEqual(self.world.history[1][0]['old'][key],40)
+        self.assertEqual(self.world.history[-1][0]['old'][key],10)
+        del self.world.history[:]
+        self.assertEqual(len(self.world.history),0)
+
+    def testRollouts(self):
+        self.addStates()
+        self.addActions()
+        self.addDynamics()
+        self.world.setOrder([self.tom.name])
+        key = stateKey(self.jerry.name,'health')
+        self.tom.setReward(minimizeFeature(key),1.)
+        self.world.setState(self.jerry.name,'health',Distribution({50: 0.5,30: 0.5}))
+        self.world.addTermination(makeTree({'if': thresholdRow(key,15),
+                                            True: False,False: True}))
+        serial = self.world.rollouts(4,horizon=5,workers=1,seed=1,trajectories=True)
+        # The initial state is restored after each simulation
+        self.assertEqual(len(self.world.state[None]),2)
+        # Both possible worlds end once they reach 10 (the one starting at 30 waits there)
+        self.assertAlmostEqual(serial['mean'][key],10.,8)
+        self.assertAlmostEqual(serial['variance'][key],0.,8)
+        self.assertEqual(serial['min'][key],10)
+        self.assertEqual(serial['max'][key],10)
+        self.assertAlmostEqual(serial['steps'],4.,8)
+        self.assertEqual(len(serial['trajectories'][0]['trajectory']),5)
+        self.assertEqual(len(serial['trajectories']),4)
+        parallel = self.world.rollouts(4,horizon=5,workers=2,seed=1)
+        self.assertAlmostEqual(parallel['mean'][key],serial['mean'][key],8)
+        self.assertAlmostEqual(parallel['steps'],serial['steps'],8)
+        # Simulations leave neither the caller's random numbers nor belief models behind
+        self.tom.setBelief(key,Distribution({50: 0.5,30: 0.5}))
+        labels = sorted(self.tom.models.keys())
+        random.seed(2)
+        expected = random.random()
+        random.seed(2)
+        self.world.rollouts(2,horizon=2,workers=1,seed=1)
+        self.assertEqual(random.random(),expected)
+        self.assertEqual(sorted(self.tom.models.keys()),labels)
+
+    def testBatch(self):
+        self.addStates()
+        self.addActions()
+        key = stateKey(self.jerry.name,'health')
+        tree = makeTree({'distribution': [(incrementMatrix(key,-10),0.5),(noChangeMatrix(key),0.5)]})
+        self.world.setDynamics(key,self.hit,tree)
+        self.world.setOrder([self.tom.name])
+        self.world.setState(self.jerry.name,'health',Distribution({50: 0.5,30: 0.5}))
+        self.world.addTermination(makeTree({'if': thresholdRow(key,25),
+                                            True: False,False: True}))
+        self.tom.setPolicy(makeTree(self.hit))
+        batch = Batch(self.world,200,seed=1)
+        self.assertEqual(len(batch),200)
+        self.assertEqual(batch.done.sum(),0)
+        batch.run(horizon=30)
+        summary = batch.summary()
+        # Every sampled world stops as soon as it reaches 20, within the horizon
+        self.assertTrue(batch.done.all())
+        self.assertEqual(summary['min'][key],20)
+        self.assertEqual(summary['max'][key],20)
+        self.assertTrue(2 < summary['steps'] < 8)
+        self.assertEqual(sorted(summary['mean'].keys()),[key,stateKey(self.tom.name,'health')])
+        # Batch leaves the world itself untouched
+        self.assertEqual(len(self.world.state[None]),2)
+
+    def testTermination(self):
+        self.addStates()
+        tom = stateKey(self.tom.name,'health')
+        jerry = stateKey(self.jerry.name,'health')
+        self.assertFalse(self.world.terminated())
+        self.world.addTermination(makeTree({'if': thresholdRow(jerry,15),
+                                            True: False,False: True}))
+        self.world.addTermination(makeTree({'if': thresholdRow(tom,15),
+                                            True: False,False: True}))
+        vector = self.world.state[None].domain()[0]
+        self.assertFalse(self.world.terminated(vector))
+        self.assertFalse(self.world.terminated(vector))
+        self.assertEqual(self.world.terminals.hits,1)
+        for key in [tom,jerry]:
+            other = KeyedVector(vector)
+            other[key] = 10
+            self.assertTrue(self.world.terminated(other))
+        # Conditions added directly to the list are also checked
+        self.world.termination.append(makeTree({'if': thresholdRow(tom,45),
+                                                True: True,False: False}))
+        self.assertTrue(self.world.terminated(vector))
+
+    def testTranspositions(self):
+        self.addStates()
+        self.addActions()
+        self.addDynamics()
+        self.world.setOrder([self.tom.name])
+        key = stateKey(self.jerry.name,'health')
+        self.tom.setReward(minimizeFeature(key),1.)
+        self.tom.setHorizon(3)
+        vector = self.world.state[None].domain()[0]
+        decision = self.tom.decide(vector)
+        self.assertEqual(decision['action'],self.hit)
+        # Sub-projections reached by different action sequences are shared
+        self.assertTrue(self.world.transpositions.hits > 0)
+        # Same decision without the table
+        self.world.transpositions.resize(0)
+        self.tom.setAttribute('V',ValueFunction())
+        expected = self.tom.decide(vector)
+        self.assertEqual(len(self.world.transpositions),0)
+        self.assertEqual(decision['action'],expected['action'])
+        for action in self.tom.actions:
+            self.assertAlmostEqual(decision['V'][action]['__EV__'],expected['V'][action]['__EV__'],8)
+        self.world.transpositions.resize(None)
+        # Changing the reward invalidates the table
+        self.tom.setReward(maximizeFeature(key),1.)
+        self.assertEqual(len(self.world.transpositions),0)
+        # Each step starts afresh, unless told otherwise
+        self.world.step()
+        size = len(self.world.transpositions)
+        self.world.reuseTranspositions = True
+        self.world.step()
+        self.assertTrue(len(self.world.transpositions) > size)
+
+    def testDeadline(self):
+        self.addStates()
+        self.addActions()
+        self.addDynamics()
+        self.world.setOrder([self.tom.name])
+        key = stateKey(self.jerry.name,'health')
+        self.tom.setReward(minimizeFeature(key),1.)
+        self.tom.setHorizon(3)
+        vector = self.world.state[None].domain()[0]
+        # Plenty of time to reach the full horizon
+        decision = self.tom.decide(vector,deadline=time.time()+600.)
+        self.assertEqual(decision['horizon'],3)
+        self.assertEqual(decision['action'],self.hit)
+        self.assertTrue(self.world.deadline is None)
+        # No time, but still a decision
+        self.tom.setAttribute('V',ValueFunction())
+        decision = self.tom.decide(vector,deadline=time.time()-1.)
+        self.assertEqual(decision['horizon'],1)
+        self.assertEqual(decision['action'],self.hit)
+        self.assertTrue(self.world.deadline is None)
+        # Decisions without any deepening still report their horizon
+        decision = self.tom.decide(vector,horizon=1,deadline=time.time()+600.)
+        self.assertEqual(decision['horizon'],1)
+        decision = self.tom.decide(vector,actions=set([self.hit]),deadline=time.time()+600.)
+        self.assertEqual(decision['horizon'],3)
+        self.assertEqual(decision['action'],self.hit)
+        self.assertFalse(self.tom.decide(vector,actions=set([self.hit])).has_key('horizon'))
+        # An expired deadline interrupts any projection
+        self.tom.setAttribute('V',ValueFunction())
+        self.world.deadline = time.time()-1.
+        self.assertRaises(DeadlineExceeded,self.tom.value,vector,self.hit)
+        self.world.deadline = None
+
+    def testMCTS(self):
+        self.addStates()
+        self.addActions()
+        self.addDynamics()
+        self.world.setOrder([self.tom.name])
+        key = stateKey(self.jerry.name,'health')
+        self.tom.setReward(minimizeFeature(key),1.)
+        self.tom.setHorizon(6)
+        self.tom.setAttribute('planner','mcts')
+        self.tom.setAttribute('iterations',200)
+        self.saveload()
+        self.assertEqual(self.tom.getAttribute('planner'),'mcts')
+        random.seed(0)
+        vector = self.world.state[None].domain()[0]
+        decision = self.tom.decide(vector)
+        self.assertEqual(decision['action'],self.hit)
+        # Chasing returns to the same state, which then counts as a visit to that state too
+        self.assertTrue(sum([entry['__N__'] for entry in decision['V'].values()]) >= 200)
+        self.assertTrue(decision['V'][self.hit]['__EV__'] > decision['V'][self.chase]['__EV__'])
+        # The search tree carries over to the next step
+        self.world.step()
+        size = len(self.tom.search.nodes)
+        self.assertTrue(size > 1)
+        self.assertEqual(self.world.step()[0]['actions'][self.tom.name],self.hit)
+        self.assertTrue(len(self.tom.search.nodes) >= size)
+        # Time budget instead of fixed iterations
+        decision = self.tom.decide(self.world.state[None].domain()[0],deadline=time.time()+0.1)
+        self.assertEqual(decision['action'],self.hit)
+        self.assertEqual(decision['horizon'],6)
+        # Nothing to simulate without a horizon, so fall back on the immediate reward
+        decision = self.tom.decide(self.world.state[None].domain()[0],horizon=0)
+        self.assertTrue(decision['action'] in self.tom.actions)
+        # The search tree survives belief updates
+        self.world.setModel(self.tom.name,True)
+        self.tom.setBelief(key,Distribution({50: 0.5,30: 0.5}))
+        self.assertEqual(len(self.tom.search.nodes),0)
+        for t in range(2):
+            # (The first observation of Tom's actions defines a new variable, which discards the tree)
+            self.world.step()
+        vector = self.world.state[None].domain()[0]
+        model = self.world.getModel(self.tom.name,vector)
+        self.assertTrue(self.tom.models[model].get('transient',False))
+        # (The previous search reached this state with one step fewer remaining)
+        self.assertTrue(self.tom.search.index(vector,model,5) in self.tom.search.nodes)
+        self.assertFalse(self.tom.search.index(vector,model,6) in self.tom.search.nodes)
+        self.assertFalse(self.tom.search.index(vector,model,5,{self.jerry.name: self.run}) in self.tom.search.nodes)
+        self.assertEqual(self.world.step()[0]['actions'][self.tom.name],self.hit)
+        # New dynamics discard the search tree
+        self.world.setDynamics(key,self.chase,makeTree(noChangeMatrix(key)))
+        self.assertEqual(len(self.tom.search.nodes),0)
+
+    def testSparseSampling(self):
+        self.addStates()
+        self.addActions()
+        key = stateKey(self.jerry.name,'health')
+        tree = makeTree({'distribution': [(incrementMatrix(key,-delta),0.2) for delta in range(5)]})
+        self.world.setDynamics(key,self.hit,tree)
+        self.world.setOrder([self.tom.name])
+        self.tom.setReward(minimizeFeature(key),1.)
+        self.tom.setHorizon(1)
+        vector = self.world.state[None].domain()[0]
+        exact = self.tom.value(vector,self.hit)
+        self.assertEqual(len(exact['projection']),5)
+        self.assertAlmostEqual(exact['variance'],0.,8)
+        estimates = []
+        for trial in range(2):
+            self.tom.setAttribute('V',ValueFunction())
+            self.tom.setAttribute('samples',3)
+            self.tom.setAttribute('seed',1)
+            estimate = self.tom.value(vector,self.hit)
+            self.assertTrue(len(estimate['projection']) <= 3)
+            self.assertAlmostEqual(sum([entry['probability'] for entry in estimate['projection']]),1.,8)
+            estimates.append(estimate)
+        # Same seed, same sample
+        self.assertAlmostEqual(estimates[0]['V'],estimates[1]['V'],8)
+        self.assertAlmostEqual(estimates[0]['variance'],estimates[1]['variance'],8)
+        self.assertTrue(estimates[0]['variance'] >= 0.)
+        # Cached values keep their variance
+        self.world.transpositions.clear()
+        self.assertAlmostEqual(self.tom.value(vector,self.hit)['variance'],estimates[1]['variance'],8)
+        # ...as do saved ones, and the sampling settings come back as integers
+        self.saveload()
+        self.assertEqual(self.tom.getAttribute('samples'),3)
+        self.assertTrue(isinstance(self.tom.getAttribute('samples'),int))
+        self.assertTrue(isinstance(self.tom.getAttribute('seed'),int))
+        self.assertAlmostEqual(self.tom.value(vector,self.hit)['variance'],estimates[1]['variance'],8)
+        self.tom.setAttribute('V',ValueFunction())
+        estimate = self.tom.value(vector,self.hit)
+        self.assertAlmostEqual(estimate['V'],estimates[0]['V'],8)
+        # Deeper estimates include the variance of the sampled outcomes' own estimates
+        self.tom.setAttribute('V',ValueFunction())
+        estimate = self.tom.value(vector,self.hit,2)
+        discount = self.tom.getAttribute('discount')
+        propagated = sum([entry['probability']*entry['probability']*entry['variance']
+                          for entry in estimate['projection']])
+        self.assertTrue(propagated > 0.)
+        self.assertTrue(estimate['variance'] >= discount*discount*propagated-1e-8)
+        # Too few outcomes to bother sampling
+        self.tom.setAttribute('V',ValueFunction())
+        self.tom.setAttribute('samples',5)
+        self.assertAlmostEqual(self.tom.value(vector,self.hit)['V'],exact['V'],8)
+
     def testRewardOnOthers(self):
         self.addStates()
         self.addActions()
@@ -310,6 +826,33 @@ class TestAgents(unittest.TestCase):
         self.assertEqual(vector[tTurn],1)
         self.assertEqual(vector[jTurn],0)
 
+    def testDefaultTurns(self):
+        self.addStates()
+        self.addActions()
+        self.world.setOrder([self.tom.name,self.jerry.name])
+        # Default turn dynamics need no variable definitions
+        self.assertFalse(self.world.variables.has_key(turnKey(self.jerry.name)))
+        self.assertFalse(self.world.getBounds().has_key(turnKey(self.jerry.name)))
+        vector = self.world.state[None].domain()[0]
+        self.assertEqual(self.world.next(vector),[self.tom.name])
+        actions = {self.tom.name: self.chase}
+        delta = self.world.deltaOrder(actions,vector)
+        self.assertTrue(self.world.deltaOrder(actions,vector) is delta)
+        new = delta*vector
+        self.assertEqual(new[turnKey(self.tom.name)],1)
+        self.assertEqual(new[turnKey(self.jerry.name)],0)
+        self.world.step(actions)
+        self.assertEqual(self.world.next(),[self.jerry.name])
+        # Default dynamics are not stored with the custom ones
+        self.assertFalse(self.world.dynamics.has_key(turnKey(self.tom.name)))
+        # Custom turn dynamics follow changes to the turn order
+        self.world.setTurnDynamics(self.tom.name,self.hit,makeTree(noChangeMatrix(turnKey(self.tom.name))))
+        self.assertEqual(self.world.variables[turnKey(self.tom.name)]['hi'],1)
+        self.world.addAgent(Agent('Spike'))
+        self.world.setOrder([self.tom.name,self.jerry.name,'Spike'])
+        self.assertEqual(self.world.variables[turnKey(self.tom.name)]['hi'],2)
+        self.assertFalse(self.world.variables.has_key(turnKey('Spike')))
+
     def testStatic(self):
         self.addStates()
         self.addActions()
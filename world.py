@@ -1,5 +1,6 @@
 import bz2
 import copy
+import types
 
 import StringIO
 from xml.dom.minidom import Document,Node,parseString
@@ -7,6 +8,8 @@ from xml.dom.minidom import Document,Node,parseString
 from action import ActionSet,Action
 from pwl import *
 from probability import Distribution
+from cache import LRUCache
+from history import History
 from agent import Agent
 
 class World:
@@ -23,10 +26,36 @@ class World:
     @type dynamics: dict
     @ivar dependency: table of dependencies among state features that impose temporal constraints
     @type dependency: dict
-    @ivar history: accumulated list of outcomes from simulation steps
-    @type history: list
+    @ivar history: accumulated list of outcomes from simulation steps (replace with a bounded L{History} to spill older steps to disk)
+    @type history: L{History}
     @ivar termination: list of conditions under which the simulation terminates (default is none)
     @type termination: L{KeyedTree}[]
+    @ivar terminals: results already computed by L{terminated}, indexed by state vector (resize to 0 to disable)
+    @type terminals: L{LRUCache}
+    @ivar instantiated: dynamics trees already instantiated for actions with extra parameters, indexed by state feature and action
+    @type instantiated: L{LRUCache}
+    @ivar triggers: the state features with dynamics, indexed by the action (or C{True} for default dynamics) that triggers them, built on demand by L{indexDynamics}
+    @type triggers: dict
+    @ivar turnKeys: the turn state feature of each agent
+    @type turnKeys: strS{->}str
+    @ivar turnDefaults: the default turn dynamics of each agent, when it has acted (C{True}) or not (C{False}), built by L{compileOrder}
+    @type turnDefaults: strS{->}boolS{->}L{KeyedTree}
+    @ivar turnDeltas: turn order changes already computed from default turn dynamics, indexed by the turns of the agents and by who has acted
+    @type turnDeltas: dict
+    @ivar gcInterval: the number of steps between model garbage collections (default is C{None}, i.e., never)
+    @type gcInterval: int
+    @ivar gcModelLimit: the total number of models across agents beyond which models are garbage collected after a step (default is C{None}, i.e., never)
+    @type gcModelLimit: int
+    @ivar transitions: possible worlds already computed by L{transition}, indexed by state vector, actions, and subset of keys (resize to 0 to disable)
+    @type transitions: L{LRUCache}
+    @ivar transpositions: projections already computed by L{Agent.value}, indexed by agent, model, state vector, horizon, action, other agents' actions, and subset of keys, and shared by all of the agents (resize to 0 to disable)
+    @type transpositions: L{LRUCache}
+    @ivar deadline: the time (as returned by C{time.time()}) by which the decision currently being made must finish (see L{Agent.decide}), or C{None} if there is no limit
+    @type deadline: float
+    @ivar reuseTranspositions: if C{True}, then keep the L{transpositions} from one L{step} to the next, rather than starting each step with an empty table (default is C{False})
+    @type reuseTranspositions: bool
+    @ivar revision: the number of times the definition of this world has changed (see L{invalidate}), so that copies elsewhere (e.g., in a L{WorldPool<psychsim.parallel.WorldPool>}) can tell when they are out of date
+    @type revision: int
     """
     memory = True
 
@@ -44,17 +73,32 @@ class World:
         self.symbols = {}
         self.symbolList = []
         self.termination = []
+        self.terminationTree = None
+        self.terminals = LRUCache(8192)
         self.relations = {}
 
         self.maxTurn = None
+        self.turnKeys = {}
+        self.turnDefaults = None
+        self.turnDeltas = {}
 
         # Action effect information
         self.dynamics = {}
+        self.triggers = None
+        self.instantiated = LRUCache(4096)
+        self.transitions = LRUCache(8192)
+        self.transpositions = LRUCache(65536)
+        self.reuseTranspositions = False
+        self.revision = 0
+        self.deadline = None
         self.dependency = {}
         self.graph = {}
         self.evaluationOrder = [set()]
 
-        self.history = []
+        self.history = History()
+        self.gcInterval = None
+        self.gcModelLimit = None
+        self.gcSteps = 0
 
         self.diagram = None
 
@@ -76,24 +120,34 @@ class World:
 
     def initialize(self):
         self.agents.clear()
+        self.turnKeys.clear()
+        self.turnDefaults = None
+        self.turnDeltas.clear()
         self.variables.clear()
         self.locals.clear()
         self.relations.clear()
         self.symbols.clear()
         del self.symbolList[:]
         self.dynamics.clear()
+        self.triggers = None
+        self.instantiated.clear()
+        self.transitions.clear()
+        self.transpositions.clear()
+        self.revision += 1
         self.dependency.clear()
         del self.evaluationOrder[:]
         self.evaluationOrder.append(set())
         del self.history[:]
         del self.termination[:]
+        self.terminationTree = None
+        self.terminals.clear()
         self.state.clear()
 
     """------------------"""
     """Simulation methods"""
     """------------------"""
     
-    def step(self,actions=None,state=None,real=True,select=True,keys=None):
+    def step(self,actions=None,state=None,real=True,select=True,keys=None,executor=None):
         """
         The simulation method
         @param actions: optional argument setting a subset of actions to be performed in this turn
@@ -102,17 +156,21 @@ class World:
         @type state: L{VectorDistribution}
         @param real: if C{True}, then modify the given state; otherwise, this is only hypothetical (default is C{True})
         @type real: bool
+        @param executor: optional pool of processes that computes the possible worlds in parallel (default is to compute them serially in this process)
+        @type executor: L{WorldPool<psychsim.parallel.WorldPool>}
         """
         if state is None:
             state = self.state[None]
-        outcomes = []
-        # Iterate through each possible world
+        if not self.reuseTranspositions:
+            self.transpositions.clear(False)
         oldStates = state.domain()
-        for stateVector in oldStates:
-            prob = state[stateVector]
-            outcome = self.stepFromState(stateVector,actions,keys=keys)
-            outcome['probability'] = prob
-            outcomes.append(outcome)
+        if executor is None or len(oldStates) < 2:
+            # Iterate through each possible world
+            outcomes = [self.stepFromState(stateVector,actions,keys=keys) for stateVector in oldStates]
+        else:
+            outcomes = executor.stepFromState(oldStates,actions,keys=keys)
+        for index in range(len(oldStates)):
+            outcomes[index]['probability'] = state[oldStates[index]]
         if real:
             # Apply effects
             assert keys is None,'Cannot perform real step over a subset of keys'
@@ -147,9 +205,30 @@ class World:
                 raise RuntimeError,msg
             if self.memory:
                 self.history.append(outcomes)
-            self.modelGC(False)
+            self.gcSteps += 1
+            if (not self.gcInterval is None and self.gcSteps >= self.gcInterval) or \
+                    (not self.gcModelLimit is None and \
+                         sum([len(agent.models) for agent in self.agents.values()]) > self.gcModelLimit):
+                self.modelGC()
         return outcomes
 
+    def rollouts(self,n,horizon=None,workers=None,seed=None,trajectories=False,select=True,agentClass=Agent):
+        """
+        Runs independent simulations from the current state until termination, in a pool of worker processes
+        @param n: the number of simulations
+        @type n: int
+        @param horizon: the maximum number of steps in each simulation (default is C{None}, i.e., run until termination)
+        @type horizon: int
+        @param workers: the number of worker processes (default is the number of CPUs); if 1, then the simulations run within this process
+        @type workers: int
+        @param seed: the seed from which the seed of each simulation is drawn (default is C{None}, i.e., a random seed)
+        @type seed: int
+        @return: statistics of the final states, as computed by L{rollouts<psychsim.parallel.rollouts>}
+        @rtype: dict
+        """
+        from parallel import rollouts
+        return rollouts(self,n,horizon,workers,seed,trajectories,select,agentClass)
+
     def stepFromState(self,vector,actions=None,horizon=None,tiebreak=None,updateBeliefs=True,keys=None):
         """
         Compute the resulting states when starting in a given possible world (as opposed to a distribution over possible worlds)
@@ -227,22 +306,13 @@ class World:
         """
         @param probability: the likelihood of this particular action set (default is 100%)
         @type probability: float
+        @param updateBeliefs: if C{False}, then leave the agents' models unchanged (default is C{True})
+        @type updateBeliefs: bool
         """
-        result = {'effect': [],
-                  'new': VectorDistribution({vector: probability})}
-        result['new'] = self.deltaState(actions,result['new'],result['effect'],keys)
-        # Update turn order
-        delta = self.deltaOrder(actions,vector)
-        if delta:
-            result['effect'].append(delta)
-            new = VectorDistribution()
-            for old in result['new'].domain():
-                newVector = KeyedVector(old)
-                newVector.update(delta*old)
-                new.addProb(newVector,result['new'][old])
-            result['new'] = new
+        result = {'effect': []}
+        result['new'] = self.transition(actions,vector,probability,result['effect'],keys)
         # Update agent models included in the original world (after finding out possible new worlds)
-        agentsModeled = [name for name in self.agents.keys() if vector.has_key(modelKey(name)) and \
+        agentsModeled = [name for name in self.agents.keys() if updateBeliefs and vector.has_key(modelKey(name)) and \
                              (keys is None or modelKey(name) in keys)]
         for name in agentsModeled:
             result['SE %s' % (name)] = {}
@@ -287,7 +357,7 @@ class World:
                 result['effect'].append(delta)
                 new = VectorDistribution()
                 for old in result['new'].domain():
-                    newVector = KeyedVector(old)
+                    newVector = old.__class__(old)
                     for matrix in delta.domain():
                         newVector.update(matrix*old)
                         new.addProb(newVector,result['new'][old]*delta[matrix])
@@ -297,6 +367,55 @@ class World:
                 result.clear()
         return result
 
+    def transition(self,actions,vector,probability=1.,effects=None,keys=None):
+        """
+        Computes the possible worlds resulting from the given actions, before any agent models are updated. Results are memoized in L{transitions}.
+        @param probability: the likelihood of this particular action set (default is 100%)
+        @type probability: float
+        @param effects: if provided, the list to which the effects are appended
+        @type effects: list
+        @rtype: L{VectorDistribution}
+        """
+        if isinstance(actions,ActionSet):
+            index = actions
+        elif isinstance(actions,dict):
+            index = frozenset(actions.items())
+        else:
+            index = None
+        if not index is None:
+            if not keys is None:
+                keys = frozenset(keys)
+            index = (vector,index,keys)
+            try:
+                new,delta = self.transitions[index]
+            except KeyError:
+                new,delta = None,None
+            except TypeError:
+                # Unhashable action specification
+                index = None
+        if index is None or new is None:
+            delta = []
+            new = self.deltaState(actions,VectorDistribution({vector: 1.}),delta,keys)
+            # Update turn order
+            order = self.deltaOrder(actions,vector)
+            if order:
+                delta.append(order)
+                outcome = VectorDistribution()
+                for old in new.domain():
+                    newVector = old.__class__(old)
+                    newVector.update(order*old)
+                    outcome.addProb(newVector,new[old])
+                new = outcome
+            if not index is None:
+                self.transitions[index] = (new,delta)
+        if not effects is None:
+            effects.extend(delta)
+        # Never hand out the memoized distribution itself
+        result = VectorDistribution()
+        for newVector in new.domain():
+            result.addProb(newVector,new[newVector]*probability)
+        return result
+
     def multiDeltaVector(self,actions,old,keys):
         new = VectorDistribution({old: 1.})
         for key in keys:
@@ -326,7 +445,7 @@ class World:
                     newValue = matrix*old
                 if isinstance(newValue,KeyedVector):
                     # Deterministic effect
-                    new = KeyedVector(old)
+                    new = old.__class__(old)
                     new.update(newValue)
                 else:
                     # Stochastic effect
@@ -367,9 +486,17 @@ class World:
         """
         Computes the change across a subset of state features
         """
+        affected = self.getAffected(actions)
         for keySet in self.evaluationOrder:
             if not keys is None:
                 keySet = {k for k in keySet if k in keys}
+            if not affected is None:
+                # No need to look at features that these actions leave untouched
+                keySet = keySet & affected
+                if len(keySet) == 0:
+                    new = old
+                    effects.append(MatrixDistribution({KeyedMatrix(): 1.}))
+                    continue
             new = VectorDistribution()
             for oldVector in old.domain():
                 partial = self.multiDeltaVector(actions,oldVector,keySet)
@@ -384,6 +511,37 @@ class World:
         Adds a possible termination condition to the list
         """
         self.termination.append(tree.desymbolize(self.symbols))
+        self.terminationTree = None
+        self.terminals.clear(False)
+        self.transitions.clear(False)
+        self.invalidate()
+
+    def invalidate(self):
+        """
+        Discards the memoized results that depend on how the world is defined, rather than just on its state: the L{transpositions}, and the belief updates and search trees kept by each agent (see L{Agent.estimates<psychsim.agent.Agent.estimates>} and L{Agent.search<psychsim.agent.Agent.search>}), and marks the change by incrementing the L{revision}
+        """
+        self.revision += 1
+        self.transpositions.clear(False)
+        for agent in self.agents.values():
+            agent.estimates.clear(False)
+            agent.search.clear()
+
+    def getTermination(self):
+        """
+        @return: a single tree combining all of the termination conditions, which returns C{True} iff at least one of them does (C{None} if there are no conditions)
+        @rtype: L{KeyedTree}
+        """
+        if self.terminationTree is None or self.terminationTree[0] != len(self.termination):
+            # Conditions may also have been appended to the list directly
+            tree = None
+            for condition in self.termination:
+                if tree is None:
+                    tree = condition
+                else:
+                    tree = tree.compose(condition,orLeaves)
+            self.terminationTree = (len(self.termination),tree)
+            self.terminals.clear(False)
+        return self.terminationTree[1]
 
     def terminated(self,state=None):
         """
@@ -410,11 +568,19 @@ class World:
                 return True
         else:
             assert isinstance(state,KeyedVector)
-            for condition in self.termination:
-                if condition[state]:
-                    return True
-            else:
+            tree = self.getTermination()
+            if tree is None:
                 return False
+            try:
+                return self.terminals[state]
+            except KeyError:
+                pass
+            except TypeError:
+                # Unhashable state vector
+                return bool(tree[state])
+            result = bool(tree[state])
+            self.terminals[state] = result
+            return result
 
     """-----------------"""
     """Authoring methods"""
@@ -426,6 +592,7 @@ class World:
         if isinstance(agent,str):
             agent = Agent(agent)
         self.agents[agent.name] = agent
+        self.turnKeys[agent.name] = turnKey(agent.name)
         agent.world = self
         return agent
 
@@ -487,11 +654,16 @@ class World:
         tree = tree.desymbolize(self.symbols)
         if enforceMin and self.variables[key]['domain'] in [int,float]:
             # Modify tree to enforce floor
-            tree.floor(key,self.variables[key]['lo'])
+            tree = tree.floor(key,self.variables[key]['lo'])
         if enforceMax and self.variables[key]['domain'] in [int,float]:
             # Modify tree to enforce ceiling
-            tree.ceil(key,self.variables[key]['hi'])
-        self.dynamics[key][action] = tree
+            tree = tree.ceil(key,self.variables[key]['hi'])
+        # Share any structure in common with previously defined trees
+        self.dynamics[key][action] = treeFactory.intern(tree)
+        self.triggers = None
+        self.instantiated.clear(False)
+        self.transitions.clear(False)
+        self.invalidate()
 
     def getDynamics(self,key,action,state=None):
         if not self.dynamics.has_key(key):
@@ -521,16 +693,88 @@ class World:
                         except KeyError:
                             tree = None
                         if tree:
-                            table = {}
-                            for field in atom.getParameters():
-                                table[actionKey(field)] = atom[field]
-                            dynamics.append(tree.desymbolize(table))
+                            index = (key,str(atom))
+                            try:
+                                dynamics.append(self.instantiated[index])
+                            except KeyError:
+                                table = {}
+                                for field in atom.getParameters():
+                                    table[actionKey(field)] = atom[field]
+                                tree = tree.desymbolize(table)
+                                self.instantiated[index] = tree
+                                dynamics.append(tree)
             if len(dynamics) == 0:
                 # No action-specific dynamics, fall back to default dynamics
                 if self.dynamics[key].has_key(True):
                     dynamics.append(self.dynamics[key][True])
             return dynamics
 
+    def indexDynamics(self):
+        """
+        @return: the state features with dynamics, indexed by the action (or C{True} for default dynamics) that triggers them
+        @rtype: dict
+        """
+        if self.triggers is None:
+            self.triggers = {}
+            for key,table in self.dynamics.items():
+                if isinstance(table,dict):
+                    actions = table.keys()
+                else:
+                    actions = [True]
+                for action in actions:
+                    try:
+                        self.triggers[action].add(key)
+                    except KeyError:
+                        self.triggers[action] = set([key])
+        return self.triggers
+
+    def getAffected(self,actions):
+        """
+        @return: the state features whose dynamics L{getDynamics} may find for the given actions (including those with default dynamics), or C{None} if unknown (i.e., L{getDynamics} has been overridden)
+        @rtype: set
+        """
+        if not self.__class__.getDynamics.im_func is World.getDynamics.im_func:
+            return None
+        triggers = self.indexDynamics()
+        if isinstance(actions,Action):
+            actions = ActionSet([actions])
+        elif not isinstance(actions,ActionSet) and not isinstance(actions,list):
+            # Table of actions by multiple agents
+            actions = ActionSet(actions)
+        affected = set(triggers.get(True,[]))
+        candidates = [actions]
+        for atom in actions:
+            candidates.append(ActionSet([atom]))
+            candidates.append(ActionSet([atom.root()]))
+        for action in candidates:
+            try:
+                affected |= triggers[action]
+            except KeyError:
+                pass
+            except TypeError:
+                # List of actions
+                pass
+        return affected
+
+    def pruneTrees(self):
+        """
+        Removes any branches of the dynamics and reward trees that cannot be reached by any state within the bounds of the state features (see L{getBounds}), and merges any branches with equal subtrees
+        """
+        bounds = self.getBounds()
+        for table in self.dynamics.values():
+            if isinstance(table,dict):
+                for action,tree in table.items():
+                    table[action] = tree.prune(bounds=bounds)
+        for agent in self.agents.values():
+            for model in agent.models.values():
+                if isinstance(model.get('R'),dict):
+                    R = {}
+                    for tree,weight in model['R'].items():
+                        if isinstance(tree,KeyedTree):
+                            tree = tree.prune(bounds=bounds)
+                        R[tree] = R.get(tree,0.)+weight
+                    model['R'] = R
+
     def addDependency(self,dependent,independent):
         """
         Adds a dependency between the dependent key and the independent key, indicating that the new value for the independent key should be determined first
@@ -567,6 +811,8 @@ class World:
         else:
             # Need to add another entry
             self.evaluationOrder.append(set([dependent]))
+        self.transitions.clear(False)
+        self.invalidate()
 
     """------------------"""
     """Turn order methods"""
@@ -586,6 +832,26 @@ class World:
             for name in names:
                 self.state[None].join(turnKey(name),index)
         self.maxTurn = len(order) - 1
+        for key in self.turnKeys.values():
+            if self.variables.has_key(key):
+                # Defined by setTurnDynamics under the previous turn order
+                self.variables[key]['hi'] = self.maxTurn
+        self.compileOrder()
+        self.transitions.clear(False)
+        self.invalidate()
+
+    def compileOrder(self):
+        """
+        Builds the default turn dynamics of each agent: if it has acted, it goes to the end of the turn order, otherwise it moves one turn closer
+        """
+        self.turnDefaults = {}
+        self.turnDeltas.clear()
+        for name,key in self.turnKeys.items():
+            acted = makeTree({'if': thresholdRow(key,0.5),
+                              True: incrementMatrix(key,-1),
+                              False: setToConstantMatrix(key,self.maxTurn)})
+            self.turnDefaults[name] = {True: treeFactory.intern(acted),
+                                       False: treeFactory.intern(makeTree(incrementMatrix(key,-1)))}
 
     def next(self,vector=None):
         """
@@ -595,21 +861,26 @@ class World:
         if vector is None:
             assert len(self.state[None]) == 1,'Ambiguous state vector'
             vector = self.state[None].domain()[0]
-        items = filter(lambda i: isTurnKey(i[0]),vector.items())
-        if len(items) == 0:
+        turns = {}
+        for name,key in self.turnKeys.items():
+            if vector.has_key(key):
+                turns[name] = int(vector[key])
+        if len(turns) == 0:
             # No turn information in vector
             return []
-        value = min(map(lambda i: int(i[1]),items))
-        return map(lambda i: turn2name(i[0]),filter(lambda i: int(i[1]) == value,items))
+        value = min(turns.values())
+        return [name for name,turn in turns.items() if turn == value]
 
     def deltaOrder(self,actions,vector):
         """
         @warning: assumes that no one is acting out of turn
         @return: the new turn sequence resulting from the performance of the given actions
         """
-        potentials = [name for name in self.agents.keys() if vector.has_key(turnKey(name))]
+        potentials = [name for name,key in self.turnKeys.items() if vector.has_key(key)]
         if self.maxTurn is None:
-            self.maxTurn = max([vector[turnKey(name)] for name in potentials])
+            self.maxTurn = max([vector[self.turnKeys[name]] for name in potentials])
+        if self.turnDefaults is None:
+            self.compileOrder()
         # Figure out who has acted
         if isinstance(actions,ActionSet):
             table = {}
@@ -632,25 +903,30 @@ class World:
                 table[atom['subject']] = True
                 actions.add(atom)
             actions = ActionSet(actions)
+        if len([name for name in potentials if self.dynamics.has_key(self.turnKeys[name])]) == 0:
+            # Only default dynamics, which depend on only whether each agent has acted and is up next
+            index = frozenset([(name,table.has_key(name),vector[self.turnKeys[name]] > 0.5)
+                               for name in potentials])
+            try:
+                return self.turnDeltas[index]
+            except KeyError:
+                pass
+        else:
+            index = None
         # Find dynamics for each turn
         delta = KeyedMatrix()
         for name in potentials:
-            key = turnKey(name)
+            key = self.turnKeys[name]
             dynamics = self.getDynamics(key,actions,vector)
             if len(dynamics) == 0:
-                # Create default dynamics
-                if table.has_key(name):
-                    tree = makeTree({'if': thresholdRow(key,0.5),
-                                     True: incrementMatrix(key,-1),
-                                     False: setToConstantMatrix(key,self.maxTurn)})
-                else:
-                    tree = makeTree(incrementMatrix(key,-1))
-                self.setTurnDynamics(name,actions,tree)
-                dynamics = [tree]
+                # Default dynamics
+                dynamics = [self.turnDefaults[name][table.has_key(name)]]
             # Combine any turn dynamics into single matrix
             matrix = dynamics[0][vector]
             assert isinstance(matrix,KeyedMatrix),'Dynamics must be deterministic'
             delta.update(matrix)
+        if not index is None:
+            self.turnDeltas[index] = delta
         return delta
 
     def getActions(self,vector,agents=None,actions=None):
@@ -676,6 +952,24 @@ class World:
     """State methods"""
     """-------------"""
 
+    def getBounds(self):
+        """
+        @return: the lowest and highest numeric values that each state feature may take (with symbolic features bounded by the positions of their elements in the symbol table)
+        @rtype: strS{->}(float,float)
+        """
+        bounds = {CONSTANT: (1.,1.)}
+        for key,variable in self.variables.items():
+            if variable['domain'] is bool:
+                bounds[key] = (0.,1.)
+            elif variable.has_key('elements'):
+                indices = [self.symbols[element] for element in variable['elements']
+                           if self.symbols.has_key(element)]
+                if indices:
+                    bounds[key] = (float(min(indices)),float(max(indices)))
+            elif not variable['lo'] is None and not variable['hi'] is None:
+                bounds[key] = (float(variable['lo']),float(variable['hi']))
+        return bounds
+
     def defineVariable(self,key,domain=float,lo=-1.,hi=1.,description=None,combinator=None,evaluate=True):
         """
         Define the type and domain of a given element of the state vector
@@ -732,6 +1026,8 @@ class World:
         self.variables[key]['key'] = key
         if evaluate:
             self.evaluationOrder[0].add(key)
+            self.transitions.clear(False)
+            self.invalidate()
 
     def setFeature(self,key,value,state=None):
         """
@@ -814,6 +1110,26 @@ class World:
         assert self.variables.has_key(key),'Unknown element "%s"' % (key)
         return self.float2value(key,state.marginal(key))
 
+    def densify(self,index=None):
+        """
+        Converts my state into L{DenseDistribution} instances over L{DenseVector} possible worlds, so that subsequent simulation operates over arrays rather than dictionaries
+        @param index: the assignment of keys to slots (default is the index shared by all L{DenseVector} instances)
+        @type index: L{VectorIndex}
+        @return: the index used, with slots for the constant, all variables, and all turn and model keys
+        @rtype: L{VectorIndex}
+        """
+        if index is None:
+            index = DenseVector.index
+        index.add(CONSTANT)
+        for key in sorted(self.variables.keys()):
+            index.add(key)
+        for name in sorted(self.agents.keys()):
+            index.add(turnKey(name))
+            index.add(modelKey(name))
+        for label,distribution in self.state.items():
+            self.state[label] = DenseDistribution(distribution,index=index)
+        return index
+
     def getValue(self,key,state=None):
         """
         Helper method that returns a single value from a vector or a singleton distribution
@@ -943,76 +1259,164 @@ class World:
         Do you want a version of a possible world *without* all the fuss of agent models?
         Then *this* is the method for you!
         """
-        return KeyedVector({key: vector[key] for key in vector.keys() if not isModelKey(key)})
-
-    def modelGC(self,check=False):
-        """
-        Garbage collect orphaned models.
-        """
-        if check:
-            # Record initial indices for verification purposes
-            indices = {}
-            for name,agent in self.agents.items():
-                indices[name] = {}
-                for label,model in agent.models.items():
-                    indices[name][label] = agent.model2index(label)
-                    assert agent.index2model(indices[name][label]) == label
-        # Keep track of which models are active for each agent and who their parent models are
-        parents = {}
-        children = {}
-        for name in self.agents.keys():
-            parents[name] = {}
-            children[name] = set()
-        # Start with the worlds in the current state
-        remaining = self.state[None].domain()
-        realWorld = True
-        while len(remaining) > 0:
-            newRemaining = []
-            for vector in remaining:
-                # Look for models of each agent
-                for name,agent in self.agents.items():
-                    key = modelKey(name)
-                    if vector.has_key(key):
-                        # This world specifies an active model
-                        model = agent.index2model(vector[key])
-                    elif realWorld:
-                        # No explicit specification, so assume True
-                        model = True
-                    else:
-                        model = None
-                    if model:
-                        children[name].add(model)
-                        try:
-                            parents[name][agent.models[model]['parent']].append(model)
-                        except KeyError:
-                            parents[name][agent.models[model]['parent']] = [model]
-                        if agent.models[model].has_key('beliefs'):
-                            while not isinstance(agent.models[model]['beliefs'],VectorDistribution):
-                                # Beliefs are symbolic link to another model
-                                model = agent.models[model]['beliefs']
-                                if model in children[name]:
-                                    # Already processed this model
-                                    break
-                                else:
-                                    children[name].add(model)
-                            else:
-                                # Recurse into the worlds within this agent's subjective view
-                                newRemaining += agent.models[model]['beliefs'].domain()
-            realWorld = False
-            remaining = newRemaining
-        # Remove inactive models
-#        for name,active in children.items():
-#            agent = self.agents[name]
-#            for model in agent.models.keys():
-#                if not model in active and not parents[name].has_key(model):
-#                    # Inactive model with no dependencies
-#                    agent.deleteModel(model)
+        return vector.filter(lambda key: not isModelKey(key))
+
+    def modelGC(self,check=False,compact=True):
+        """
+        Garbage collect orphaned models: any model created by a belief update (i.e., flagged as transient by L{Agent.belief2model}) that can no longer be reached from the current state, either directly or through the beliefs of some other reachable (or non-transient) model.
+        @param check: if C{True}, then verify that the surviving models and their indices are consistent afterward (default is C{False})
+        @type check: bool
+        @param compact: if C{True}, then renumber the surviving models so that each agent's indices are contiguous, translating the state, beliefs, and value functions accordingly (default is C{True})
+        @type compact: bool
+        @return: the number of models deleted
+        @rtype: int
+        @warning: the state vectors already in L{history} are not translated
+        """
+        self.gcSteps = 0
+        # Mark: start with the non-transient models and the worlds in the current state
+        marked = {}
+        stack = []
+        for name,agent in self.agents.items():
+            marked[name] = set()
+            for label,model in agent.models.items():
+                if not model.get('transient',False):
+                    stack.append((name,label))
+        for state in self.state.values():
+            for vector in state.domain():
+                stack += self.vectorModels(vector,True)
+        while stack:
+            name,label = stack.pop()
+            agent = self.agents[name]
+            if label in marked[name] or not agent.models.has_key(label):
+                continue
+            marked[name].add(label)
+            model = agent.models[label]
+            # Models inherit from their parents
+            stack.append((name,model['parent']))
+            beliefs = model.get('beliefs',True)
+            if isinstance(beliefs,VectorDistribution):
+                # Recurse into the worlds within this agent's subjective view
+                for vector in beliefs.domain():
+                    stack += self.vectorModels(vector,False)
+            elif not beliefs is True:
+                # Beliefs are symbolic link to another model
+                stack.append((name,beliefs))
+        # Sweep: remove unmarked models, noting which indices no longer mean anything
+        mapping = {}
+        count = 0
+        for name,agent in self.agents.items():
+            table = {}
+            for label in agent.models.keys():
+                if not label in marked[name]:
+                    table[agent.model2index(label)] = None
+                    agent.deleteModel(label)
+            if compact:
+                labels = sorted(agent.models.keys(),key=agent.model2index)
+                if [agent.model2index(label) for label in labels] != range(len(labels)):
+                    agent.modelList.clear()
+                    for index in range(len(labels)):
+                        model = agent.models[labels[index]]
+                        if model['index'] != index:
+                            table[model['index']] = index
+                            model['index'] = index
+                        agent.modelList[index] = labels[index]
+            if table:
+                mapping[name] = table
+            count += len([index for index in table.values() if index is None])
+        if mapping:
+            self.remapModels(mapping)
         if check:
             # Verify final indices
             for name,agent in self.agents.items():
                 for label,model in agent.models.items():
-                    assert indices[name][label] == agent.model2index(label)
-                    assert agent.index2model(indices[name][label]) == label
+                    assert agent.index2model(agent.model2index(label)) == label
+                assert len(agent.modelList) == len(agent.models)
+                for state in self.state.values():
+                    for vector in state.domain():
+                        if vector.has_key(modelKey(name)):
+                            assert not agent.index2model(vector[modelKey(name)]) is None
+        return count
+
+    def remapModels(self,mapping):
+        """
+        Translates the model indices in the current state and in the agents' beliefs and value functions (dropping any values of worlds that contain deleted models), and discards any memoized results that may refer to the old indices
+        @param mapping: the new model index for each old model index that has changed (C{None} if the model no longer exists), by agent
+        @type mapping: strS{->}intS{->}int
+        """
+        for state in self.state.values():
+            new = self.translateModels(state,mapping)
+            state.clear()
+            for vector in new.domain():
+                state[vector] = new[vector]
+        for agent in self.agents.values():
+            for model in agent.models.values():
+                if isinstance(model.get('beliefs'),VectorDistribution):
+                    model['beliefs'] = self.translateModels(model['beliefs'],mapping)
+                if model.has_key('V'):
+                    # Drop values (and their variances) of worlds containing deleted models
+                    for tables in [model['V'].table,model['V'].variances]:
+                        for horizon in range(len(tables)):
+                            if tables[horizon]:
+                                table = {}
+                                for vector,entry in tables[horizon].items():
+                                    vector = self.translateModels(vector,mapping)
+                                    if not vector is None:
+                                        table[vector] = entry
+                                tables[horizon] = table
+        # Memoized transitions, projections, and belief updates may be indexed by worlds that no longer exist
+        self.transitions.clear(False)
+        self.invalidate()
+
+    def vectorModels(self,vector,real=False):
+        """
+        @param real: if C{True}, then the given vector is a real world, where agents with no model specified are using their C{True} model (default is C{False})
+        @type real: bool
+        @return: the models specified in the given world, as a list of agent name and model label
+        @rtype: list
+        """
+        result = []
+        for name,agent in self.agents.items():
+            key = modelKey(name)
+            if vector.has_key(key):
+                # This world specifies an active model
+                result.append((name,agent.index2model(vector[key])))
+            elif real:
+                # No explicit specification, so assume True
+                result.append((name,True))
+        return result
+
+    def translateModels(self,element,mapping):
+        """
+        @param element: a state vector or distribution over them
+        @type element: L{KeyedVector} or L{VectorDistribution}
+        @param mapping: the new model index for each old model index that has changed (C{None} if the model no longer exists), by agent
+        @type mapping: strS{->}intS{->}int
+        @return: the same state, but with the new model indices (C{None} for a vector that refers to a model that no longer exists, and any such vectors are dropped from a distribution)
+        """
+        if isinstance(element,VectorDistribution):
+            result = copy.copy(element)
+            result.clear()
+            for vector in element.domain():
+                new = self.translateModels(vector,mapping)
+                if not new is None:
+                    result.addProb(new,element[vector])
+            return result
+        result = None
+        for name,table in mapping.items():
+            key = modelKey(name)
+            if element.has_key(key):
+                index = int(element[key]+0.5)
+                if table.has_key(index):
+                    if table[index] is None:
+                        return None
+                    elif result is None:
+                        result = element.__class__(element)
+                    result[key] = table[index]
+        if result is None:
+            # Nothing to translate
+            return element
+        else:
+            return result
 
     def updateModels(self,outcome,vector):
         for agent in self.agents.values():
@@ -1035,7 +1439,7 @@ class World:
                             hypothesis = self.agents[actor].models[self.agents[actor].index2model(index)]
                             denominator = 0.
                             V = {}
-                            state = KeyedVector(outcome['old'])
+                            state = outcome['old'].__class__(outcome['old'])
                             state[actorKey] = index
                             for alternative in self.agents[actor].getActions(outcome['old']):
                                 # Evaluate all available actions with respect to the hypothesized mental model
@@ -1065,7 +1469,7 @@ class World:
         @rtype: L{KeyedVector}
         """
         result = vector.__class__()
-        remaining = dict(vector)
+        remaining = dict(vector.items())
         # Handle defined state features
         for key,entry in self.variables.items():
             if remaining.has_key(key):
@@ -1481,6 +1885,65 @@ class World:
     """Serialization methods"""
     """---------------------"""
 
+    def __copy__(self):
+        """
+        @return: a new world sharing my PWL functions (dynamics, termination conditions, and the agents' reward and observation functions), but with its own state, variables, agents (see L{Agent.__copy__}), and an empty history, and with none of my memoized results
+        @rtype: L{World}
+        """
+        if type(self) is types.InstanceType:
+            # Old-style class, so there is no __new__
+            result = types.InstanceType(self.__class__)
+        else:
+            result = self.__class__.__new__(self.__class__)
+        result.__dict__.update(self.__dict__)
+        result.agents = {}
+        for name,agent in self.agents.items():
+            result.agents[name] = copy.copy(agent)
+            result.agents[name].world = result
+        result.state = {}
+        for label,state in self.state.items():
+            result.state[label] = copy.copy(state)
+        result.variables = dict([(key,dict(entry)) for key,entry in self.variables.items()])
+        result.locals = dict([(name,dict(table)) for name,table in self.locals.items()])
+        result.relations = dict([(name,dict(table)) for name,table in self.relations.items()])
+        result.symbols = dict(self.symbols)
+        result.symbolList = list(self.symbolList)
+        result.termination = list(self.termination)
+        result.terminals = LRUCache(self.terminals.size)
+        result.turnKeys = dict(self.turnKeys)
+        if not self.turnDefaults is None:
+            result.turnDefaults = dict(self.turnDefaults)
+        result.turnDeltas = {}
+        result.dynamics = dict([(key,dict(table)) for key,table in self.dynamics.items()])
+        result.triggers = None
+        result.instantiated = LRUCache(self.instantiated.size)
+        result.transitions = LRUCache(self.transitions.size)
+        result.transpositions = LRUCache(self.transpositions.size)
+        result.deadline = None
+        result.dependency = dict([(key,dict(table)) for key,table in self.dependency.items()])
+        result.graph = {}
+        result.evaluationOrder = [set(layer) for layer in self.evaluationOrder]
+        if isinstance(self.history,History):
+            result.history = History(self.history.size)
+        else:
+            result.history = []
+        return result
+
+    def __deepcopy__(self,memo):
+        """
+        @return: a copy as in L{__copy__}, except that the state vectors (including those in the agents' beliefs) are copied as well
+        @rtype: L{World}
+        """
+        result = self.__copy__()
+        memo[id(self)] = result
+        for label,state in self.state.items():
+            result.state[label] = copy.deepcopy(state,memo)
+        for agent in result.agents.values():
+            for model in agent.models.values():
+                if isinstance(model.get('beliefs'),Distribution):
+                    model['beliefs'] = copy.deepcopy(model['beliefs'],memo)
+        return result
+
     def __xml__(self):
         doc = Document()
         root = doc.createElement('world')
@@ -1659,6 +2122,7 @@ class World:
                             assert subnode.tagName == 'table'
                             key = str(subnode.getAttribute('key'))
                             self.dynamics[key] = {}
+                            self.triggers = None
                             subsubnode = subnode.firstChild
                             action = True
                             while subsubnode: